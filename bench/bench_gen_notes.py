@@ -0,0 +1,222 @@
+"""
+Scaling benchmarks for the note-generation pipeline.
+
+Times cleanse_text(), _poemlines_from_textlines() and add_notes() separately
+on synthetic texts of several lengths and across grouping, context and
+recitation settings, so that superlinear behavior shows up here before it
+reaches users. Results can be saved as JSON and compared against a stored
+baseline:
+
+    python -m bench.bench_gen_notes --save bench_output.json
+    python -m bench.bench_gen_notes --compare bench/baseline.json --threshold 1.5
+
+The comparison exits with status 1 if any timing regressed by more than
+--threshold times the baseline (ignoring differences under --min-seconds),
+or if any stage grows faster than --max-exponent with the length of the text.
+"""
+
+import argparse
+import itertools
+import json
+import math
+import platform
+import sys
+import time
+from typing import Any, Callable, Dict, Iterable, List, Sequence, Tuple
+
+# pylint: disable=wrong-import-position
+from src.gen_notes import add_notes, cleanse_text, _poemlines_from_textlines
+
+CONFIG = {'endOfStanzaMarker': " ⊗", 'endOfTextMarker': " □"}
+SIZES = (1000, 10000, 100000)
+GROUPS = (1, 3)
+CONTEXTS = (2, 10)
+RECITES = (1, 5)
+
+
+class BenchModel:
+    "Note type stand-in; add_notes() only needs to look it up."
+    def by_name(self, name):
+        return self
+
+
+class BenchCollection:
+    """
+    Collection stand-in that accepts notes and throws them away, so that the
+    add_notes() timings measure LPCG's own work rather than Anki's database.
+    """
+    models = BenchModel()
+
+    def __init__(self):
+        self.added = 0
+
+    def add_notes(self, requests):
+        self.added += len(requests)
+
+    def add_custom_undo_entry(self, name):
+        return 1
+
+    def merge_undo_entries(self, target):
+        pass
+
+
+class BenchNote(dict):
+    "Note stand-in: just a dictionary of fields, plus tags and an id."
+    def __init__(self, col, model):
+        super().__init__()
+        self.id = 0
+        self.tags: List[str] = []
+
+
+def synthetic_text(lines: int) -> str:
+    """
+    Return a poem of /lines/ text lines using all of LPCG's markup: stanzas of
+    varying length, indented lines, comment lines, and trailing comments.
+    """
+    out = ["# A synthetic poem for benchmarking"]
+    stanza_lengths = itertools.cycle((4, 6, 8, 5))
+    written = 0
+    while written < lines:
+        for i in range(min(next(stanza_lengths), lines - written)):
+            written += 1
+            text = f"This is line {written}, which scans about as well as it can"
+            if i % 2:
+                text = "    " + text
+            if written % 7 == 0:
+                text += "  # with a note about it"
+            out.append(text)
+        out.append("")
+        if written % 50 == 0:
+            out.append("# A comment between stanzas")
+    return "\n".join(out)
+
+
+def best_time(func: Callable[[], Any], repeat: int) -> float:
+    "Return the fastest of /repeat/ runs of func(), in seconds."
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(sizes: Sequence[int], repeat: int) -> Dict[str, float]:
+    "Run every benchmark and return a mapping from benchmark name to seconds."
+    results = {}
+    for size in sizes:
+        raw = synthetic_text(size)
+        # Long texts take a while; there's less noise to average out anyway.
+        reps = repeat if size < 100000 else 1
+        results[f"cleanse_text/lines={size}"] = best_time(
+            lambda: cleanse_text(raw, CONFIG), reps)
+        text = cleanse_text(raw, CONFIG)
+        assert len(text) == size
+
+        for group in GROUPS:
+            results[f"poemlines/lines={size}/group={group}"] = best_time(
+                lambda: _poemlines_from_textlines(text, group), reps)
+            for context, recite in itertools.product(CONTEXTS, RECITES):
+                results[f"add_notes/lines={size}/group={group}"
+                        f"/context={context}/recite={recite}"] = best_time(
+                    lambda: add_notes(BenchCollection(), BenchNote, "Title", "Author",
+                                      ["tag"], text, 1, context, group, recite),
+                    reps)
+        print(f"finished {size} lines", file=sys.stderr)
+    return results
+
+
+def _size_of(name: str) -> Tuple[str, int]:
+    "Split a benchmark name into (name without the size, size)."
+    parts = name.split('/')
+    size_part = next(i for i in parts if i.startswith('lines='))
+    rest = '/'.join(i for i in parts if i != size_part)
+    return rest, int(size_part[len('lines='):])
+
+
+def scaling_exponents(results: Dict[str, float],
+                      min_seconds: float) -> Dict[str, float]:
+    """
+    For each benchmark run at more than one size, estimate k in time ~ n^k
+    between the smallest and largest sizes. k is about 1 for linear behavior.
+    Benchmarks too fast to time meaningfully (under min_seconds at the
+    largest size) are left out.
+    """
+    by_name: Dict[str, List[Tuple[int, float]]] = {}
+    for name, seconds in results.items():
+        rest, size = _size_of(name)
+        by_name.setdefault(rest, []).append((size, seconds))
+    exponents = {}
+    for rest, points in by_name.items():
+        points.sort()
+        (n1, t1), (n2, t2) = points[0], points[-1]
+        if n2 > n1 and t1 > 0 and t2 >= min_seconds:
+            exponents[rest] = math.log(t2 / t1) / math.log(n2 / n1)
+    return exponents
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float],
+            threshold: float, min_seconds: float) -> List[str]:
+    "Return a description of each result that regressed against the baseline."
+    regressions = []
+    for name in sorted(results.keys() & baseline.keys()):
+        new, old = results[name], baseline[name]
+        if new > old * threshold and new - old > min_seconds:
+            regressions.append(f"{name}: {old:.4f} s -> {new:.4f} s ({new / old:.2f}x)")
+    return regressions
+
+
+def report(results: Dict[str, float]) -> Iterable[str]:
+    "Describe the results as lines of text."
+    for name, seconds in results.items():
+        size = _size_of(name)[1]
+        yield f"{name:<58} {seconds:10.4f} s {seconds / size * 1e6:8.2f} us/line"
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m bench.bench_gen_notes",
+                                     description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help="text lengths to benchmark, in lines")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="runs of each benchmark; the fastest is kept")
+    parser.add_argument('--save', metavar='FILE', help="write results to this JSON file")
+    parser.add_argument('--compare', metavar='FILE', help="compare to this baseline JSON file")
+    parser.add_argument('--threshold', type=float, default=1.5,
+                        help="ratio to the baseline counted as a regression")
+    parser.add_argument('--min-seconds', type=float, default=0.02,
+                        help="ignore regressions smaller than this many seconds")
+    parser.add_argument('--max-exponent', type=float, default=1.3,
+                        help="fail if any stage scales worse than n^this")
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.repeat)
+    exponents = scaling_exponents(results, args.min_seconds)
+    for line in report(results):
+        print(line)
+    print()
+    for name, exponent in exponents.items():
+        print(f"{name:<58} scales as n^{exponent:.2f}")
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'results': results}, f, indent=2)
+
+    failed = False
+    superlinear = {k: v for k, v in exponents.items() if v > args.max_exponent}
+    for name, exponent in superlinear.items():
+        print(f"SUPERLINEAR: {name} scales as n^{exponent:.2f}")
+        failed = True
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+        for line in compare(results, baseline, args.threshold, args.min_seconds):
+            print(f"REGRESSION: {line}")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+"""
+Measure how long the add-on takes to load when Anki starts, and how much of
+its import cost is deferred until the dialog is first opened.
+
+Anki itself isn't started; instead, a stub aqt package just big enough for
+the add-on to register its menu action and hook is put on the path, and the
+anki package (which Anki has always loaded by the time add-ons are) is
+imported up front so its cost isn't counted. The add-on is then imported
+under `python -X importtime`:
+
+    python -m bench.bench_startup
+    python -m bench.bench_startup --repeat 20
+
+The anki package must be installed. The generated Qt forms aren't needed.
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List
+
+STUB_AQT = {
+    '__init__.py': '''
+class _Menu:
+    def addAction(self, action):
+        pass
+
+class _Form:
+    menuTools = _Menu()
+
+class _MainWindow:
+    form = _Form()
+
+mw = _MainWindow()
+from . import gui_hooks
+''',
+    'gui_hooks.py': '''
+profile_did_open = []
+browser_menus_did_init = []
+''',
+    'qt.py': '''
+qtmajor = 6
+
+class _Widget:
+    def __init__(self, *args, **kwargs):
+        pass
+
+class _Signal:
+    def connect(self, slot):
+        pass
+
+class QAction(_Widget):
+    triggered = _Signal()
+    def setText(self, text):
+        pass
+
+QDialog = QDesktopServices = QFileDialog = QMenu = QPoint = QTimer = QUrl = _Widget
+''',
+    'utils.py': '''
+def _dialog(*args, **kwargs):
+    pass
+
+askUser = getFile = showInfo = showText = showWarning = tooltip = _dialog
+''',
+    'deckchooser.py': '''
+class DeckChooser:
+    pass
+''',
+    'operations.py': '''
+class CollectionOp:
+    pass
+
+class QueryOp:
+    pass
+''',
+}
+
+MEASURE = '''
+import sys, types
+import anki.collection, anki.notes, anki.consts, anki.models
+import aqt, aqt.qt, aqt.utils, aqt.deckchooser, aqt.operations
+sys.modules['src.import_dialog6'] = types.ModuleType('src.import_dialog6')
+import src
+import src.lpcg_dialog, src.models
+'''
+
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def measure_once(stub_dir: str) -> Dict[str, float]:
+    """
+    Import the add-on once in a fresh interpreter, and return the number of
+    milliseconds spent at startup (importing the add-on package) and on first
+    use (importing the dialog and note type modules, if startup didn't).
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([stub_dir, root]))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', MEASURE],
+                          env=env, capture_output=True, text=True, check=True)
+    cumulative = {}
+    for line in proc.stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match and len(match.group(3)) == 1:  # top-level imports only
+            cumulative[match.group(4)] = int(match.group(2)) / 1000
+    return {
+        'startup': cumulative['src'],
+        'first use': cumulative.get('src.lpcg_dialog', 0.0) + cumulative.get('src.models', 0.0),
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m bench.bench_startup",
+                                     description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=10,
+                        help="number of interpreters to start; the median is reported")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as stub_dir:
+        os.mkdir(os.path.join(stub_dir, 'aqt'))
+        for name, source in STUB_AQT.items():
+            with open(os.path.join(stub_dir, 'aqt', name), 'w', encoding='utf-8') as f:
+                f.write(source)
+        runs: List[Dict[str, float]] = [measure_once(stub_dir) for _ in range(args.repeat)]
+
+    for stage in ('startup', 'first use'):
+        print(f"{stage:<10} {statistics.median(i[stage] for i in runs):8.2f} ms")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
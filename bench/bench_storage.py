@@ -0,0 +1,67 @@
+"""
+Report how many bytes compact storage (the compactStorage option) saves.
+
+For each text file given, works out the total size of the fields of the
+poem's notes in normal and in compact storage, and the size of the media
+file compact storage writes instead, without creating a collection:
+
+    python -m bench.bench_storage poems/*.txt
+    python -m bench.bench_storage --context 4 --recite 2 poems/*.txt
+
+Media files don't count toward the collection's size, but they do have to
+be synced once, so the net saving counts them against compact storage.
+"""
+
+import argparse
+import os
+import sys
+from typing import Iterable, List, Tuple
+
+# pylint: disable=wrong-import-position
+from src.compact import StorageReport, storage_report
+from src.gen_notes import cleanse_text
+
+CONFIG = {'endOfStanzaMarker': " ⊗", 'endOfTextMarker': " □"}
+
+
+def run(paths: Iterable[str], context_lines: int, group_lines: int,
+        recite_lines: int) -> List[Tuple[str, StorageReport]]:
+    "Return the storage report of each file."
+    results = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            text_lines = cleanse_text(f.read(), CONFIG)
+        title = os.path.splitext(os.path.basename(path))[0]
+        results.append((title, storage_report(title, "", text_lines, context_lines,
+                                              group_lines, recite_lines)))
+    return results
+
+
+def report(results: List[Tuple[str, StorageReport]]) -> Iterable[str]:
+    "Describe the results as lines of text, with a total if there's more than one."
+    yield f"{'poem':<30} {'full':>10} {'compact':>10} {'file':>10} {'saved':>10} {'net':>7}"
+    rows = list(results)
+    if len(rows) > 1:
+        rows.append(("TOTAL", StorageReport(*(sum(i) for i in zip(*(r for _, r in results))))))
+    for title, r in rows:
+        yield (f"{title[:30]:<30} {r.full_bytes:>10} {r.compact_bytes:>10} "
+               f"{r.file_bytes:>10} {r.saved_bytes:>10} "
+               f"{r.net_saved_bytes / r.full_bytes:>6.0%}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m bench.bench_storage",
+                                     description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('files', nargs='+', help="UTF-8 text files to measure")
+    parser.add_argument('--context', type=int, default=2, help="lines of context")
+    parser.add_argument('--group', type=int, default=1, help="lines in groups of")
+    parser.add_argument('--recite', type=int, default=1, help="lines to recite")
+    args = parser.parse_args(argv)
+
+    for line in report(run(args.files, args.context, args.group, args.recite)):
+        print(line)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,19 +9,28 @@ See LICENSE file or <http://www.gnu.org/licenses/agpl.html> for details.
 
 import sys
 
-# don't try to set up the UI if running unit tests
-if 'pytest' not in sys.modules:
+# don't try to set up the UI if running unit tests or the command-line
+# interface (see cli.py), neither of which is run from within Anki
+if 'pytest' not in sys.modules and 'aqt' in sys.modules:
     # pylint: disable=import-error, no-name-in-module
-    # pylint: disable=invalid-name
+    # pylint: disable=invalid-name, import-outside-toplevel
     import aqt
     from aqt.qt import QAction  # type: ignore
-    from aqt.utils import showWarning
 
-    from .lpcg_dialog import LPCGDialog
-    from . import models
+    # Only the menu action and the hooks are set up when Anki starts. The
+    # dialog, the note generator, and the note type definitions are imported
+    # the first time they're needed, to keep them out of Anki's startup time
+    # (see bench/bench_startup.py).
 
     def open_dialog():
         "Launch the add-poem dialog."
+        from aqt.utils import showWarning
+        from .lpcg_dialog import LPCGDialog
+        from . import models
+
+        if not models.LpcgOne.in_collection():
+            # deleted since the note type was last checked
+            models.ensure_note_type()
         current_version = aqt.mw.col.get_config('lpcg_model_version', default="none")
         if not models.LpcgOne.is_at_version(current_version):
             showWarning(
@@ -32,10 +41,21 @@ if 'pytest' not in sys.modules:
         dialog = LPCGDialog(aqt.mw)
         dialog.exec()
 
+    def on_browser_menus(browser):
+        "Add the LPCG poem actions to the browser's Notes menu."
+        from .browser_actions import setup_menu
+        setup_menu(browser)
+
+    def on_profile_open():
+        "Check the LPCG note type in the newly opened profile."
+        from . import models
+        models.check_note_type()
+
     if aqt.mw is not None:
         action = QAction(aqt.mw)
         action.setText("Import &Lyrics/Poetry")
         aqt.mw.form.menuTools.addAction(action)
         action.triggered.connect(open_dialog)
 
-        aqt.gui_hooks.profile_did_open.append(models.ensure_note_type)
+        aqt.gui_hooks.profile_did_open.append(on_profile_open)
+        aqt.gui_hooks.browser_menus_did_init.append(on_browser_menus)
@@ -0,0 +1,365 @@
+"""
+Import many poems at once from a selection of text files or a directory.
+
+Each file becomes one poem. Its title and author are taken from the file name
+(according to a configurable pattern) or from header comments at the top of
+the file:
+
+    # Title: Winter
+    # Author: Samuel Longfellow
+
+Parsing and rendering the notes' fields doesn't need a collection, so the
+command-line tool farms it out to a pool of worker processes; in Anki, and
+always when creating and adding the notes, it happens in the current process,
+in batches, as a single undo step.
+"""
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+import os
+import re
+import time
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, NamedTuple,
+                    Optional, Pattern, Sequence)
+
+from .compact import new_poem_key, trash_poem_file, write_poem_file
+from .gen_notes import (ImportCancelled, Poem, cleanse_lines, cleanse_text,
+                        discard_undo_entry, insert_notes)
+from .poem_store import (Checkpoint, PoemRecord, clear_checkpoint, committed_sequence,
+                         find_poem, import_fingerprint, load_checkpoint, register_notes,
+                         register_poem, save_checkpoint, save_record)
+
+HEADER_RE = re.compile(r'^#\s*(?P<key>title|author)\s*:\s*(?P<value>.*?)\s*$', re.IGNORECASE)
+
+
+class PoemFile(NamedTuple):
+    "A text file to be imported, and the title and author it will be given."
+    path: str
+    title: str
+    author: str
+
+
+class RenderedPoem(NamedTuple):
+    """
+    The text of a PoemFile and the rendered fields of each of its notes,
+    or, if the file couldn't be read or rendered, an error saying why.
+    """
+    source: PoemFile
+    text: str
+    fields: List[Dict[str, str]]
+    seconds: float
+    error: Optional[str] = None
+
+
+class FileResult(NamedTuple):
+    "Summary of what happened to one file during a batch import."
+    source: PoemFile
+    notes_added: int
+    skipped: Optional[str]
+    parse_seconds: float
+    insert_seconds: float
+
+
+class BatchResult(NamedTuple):
+    """
+    The FileResult of each file in a batch import, in order, and the undo
+    entry the notes were merged into (None if no notes were added).
+    """
+    files: List[FileResult]
+    undo_entry: Optional[int]
+
+
+def find_text_files(paths: Iterable[str], extension: str = '.txt') -> List[str]:
+    """
+    Expand the given files and directories into a sorted list of files.
+    Directories are searched recursively for files with /extension/;
+    files named explicitly are always included.
+    """
+    found: List[str] = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                found.extend(os.path.join(dirpath, i) for i in sorted(filenames)
+                             if i.lower().endswith(extension))
+        else:
+            found.append(path)
+    return found
+
+
+def filename_regex(pattern: str) -> Pattern:
+    """
+    Compile a file name pattern like "{author} - {title}" into a regex with
+    'title' and 'author' groups, matched against the name without extension.
+    """
+    parts = re.split(r'\{(title|author)\}', pattern)
+    regex = ''.join(
+        re.escape(part) if n % 2 == 0 else f'(?P<{part}>.+?)'
+        for n, part in enumerate(parts))
+    return re.compile(f'^{regex}$')
+
+
+def identify(path: str, pattern: Pattern, default_author: str = "") -> PoemFile:
+    """
+    Work out the title and author of the poem in /path/. Title and Author
+    header comments at the top of the file take precedence over values
+    matched from the file name by /pattern/; if neither gives a title, the
+    file name itself is used.
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    match = pattern.match(stem)
+    info = {k: v.strip() for k, v in match.groupdict().items()} if match else {}
+
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            header = HEADER_RE.match(line)
+            if header:
+                info[header.group('key').lower()] = header.group('value')
+
+    return PoemFile(path, info.get('title') or stem, info.get('author') or default_author)
+
+
+def _render_file(source: PoemFile, config: Dict[str, Any], context_lines: int,
+                 group_lines: int, recite_lines: int,
+                 poem_key: Optional[str] = None) -> RenderedPoem:
+    """
+    Parse /source/ and render the fields of its notes (for compact storage,
+    using the media file with the key /poem_key/, if it's given; see
+    compact.py). This runs in a worker process, so it must be a module-level
+    function with picklable arguments.
+    """
+    start = time.perf_counter()
+    with open(source.path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    poem = Poem(list(cleanse_lines(text, config)), group_lines)
+    fields = [line.fields(context_lines, recite_lines, poem_key) for line in poem]
+    return RenderedPoem(source, text, fields, time.perf_counter() - start)
+
+
+def _render_or_report(source: PoemFile, config: Dict[str, Any], context_lines: int,
+                      group_lines: int, recite_lines: int,
+                      poem_key: Optional[str] = None) -> RenderedPoem:
+    """
+    Like _render_file(), but if anything goes wrong with this file, return
+    a RenderedPoem with the error instead of raising it, so one bad file
+    doesn't stop the rest of a batch.
+    """
+    try:
+        return _render_file(source, config, context_lines, group_lines, recite_lines,
+                            poem_key)
+    except Exception as e:  # pylint: disable=broad-except
+        return RenderedPoem(source, "", [], 0.0, str(e) or type(e).__name__)
+
+
+def render_files(sources: Sequence[PoemFile], config: Dict[str, Any],
+                 context_lines: int, group_lines: int, recite_lines: int,
+                 max_workers: Optional[int] = 0,
+                 poem_keys: Optional[Dict[str, str]] = None) -> Iterator[RenderedPoem]:
+    """
+    Render each of /sources/, yielding the results as they're ready, which
+    isn't necessarily in the original order. Files that can't be read or
+    rendered are yielded with an error rather than raising. Files whose
+    paths are in /poem_keys/ are rendered for compact storage with that key.
+
+    By default, the files are rendered one after another in the current
+    process. Otherwise, they're rendered in a pool of /max_workers/ processes
+    (one per CPU if it's None), with only a couple of files per worker
+    waiting at a time, so finished poems don't pile up in memory if they're
+    consumed slowly. If the processes can't be started or die, the files not
+    yet rendered are rendered in the current process instead.
+
+    Worker processes re-import the program that started them on platforms
+    that spawn them, which in Anki means starting another copy of Anki, so
+    only the command-line tool uses them.
+    """
+    args = (config, context_lines, group_lines, recite_lines)
+    keys = poem_keys or {}
+    todo = deque(sources)
+    if max_workers != 0 and len(sources) > 1:
+        workers = max_workers or os.cpu_count() or 1
+        running: Dict[Future, PoemFile] = {}
+        pool = ProcessPoolExecutor(max_workers=workers)
+        try:
+            while todo or running:
+                while todo and len(running) < 2 * workers:
+                    running[pool.submit(_render_or_report, todo[0], *args,
+                                        keys.get(todo[0].path))] = todo[0]
+                    todo.popleft()
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    result = future.result()
+                    del running[future]
+                    yield result
+        except (BrokenProcessPool, OSError, NotImplementedError):
+            # Render whatever the workers didn't finish here instead.
+            todo.extendleft(reversed(running.values()))
+        finally:
+            pool.shutdown(cancel_futures=True)
+    for source in todo:
+        yield _render_or_report(source, *args, keys.get(source.path))
+
+
+def import_files(col: Any, note_constructor: Callable, sources: Sequence[PoemFile],
+                 config: Dict[str, Any], tags: List[str], deck_id: int,
+                 context_lines: int, group_lines: int, recite_lines: int,
+                 max_workers: Optional[int] = 0,
+                 on_file: Optional[Callable[[int, int], None]] = None,
+                 want_cancel: Optional[Callable[[], bool]] = None) -> BatchResult:
+    """
+    Import each of /sources/ as a separate poem and return a BatchResult with
+    a FileResult for each, in order. Files whose title is already used by a poem in the
+    collection (or by an earlier file in the batch), which can't be read, or
+    which contain no text, are skipped. Files are rendered with
+    render_files() and /max_workers/, and added in the order they're
+    rendered, one at a time. All the notes added are merged into one undo step.
+    The text and settings of each poem imported are saved with save_record(),
+    so it can be edited and re-imported later, and the poem is registered.
+
+    A checkpoint is saved after each batch of notes is committed, so if the
+    import is interrupted, running it again picks up each poem where it
+    stopped rather than skipping it as a duplicate. Files whose text or
+    settings don't match an interrupted import of the same title are skipped.
+
+    If given, on_file(done, total) is called after each file is processed,
+    and want_cancel() is checked before each file and each batch of notes
+    within it; if it returns True, the import's undo step is discarded (see
+    discard_undo_entry()), which removes the notes added so far and puts back
+    the checkpoints it started from, the media files of poems newly added in
+    compact storage are trashed, and ImportCancelled is raised.
+
+    Raises KeyError if the note type is missing fields, like add_notes().
+    """
+    results: Dict[str, FileResult] = {}
+    to_render = []
+    seen_titles = set()
+    for source in sources:
+        # find_poem() also brings the registry up to date before the imports
+        # register their notes, so it's called even for a resumed import.
+        entry = find_poem(col, source.title)
+        if source.title in seen_titles or (entry is not None
+                                           and load_checkpoint(col, source.title) is None):
+            results[source.path] = FileResult(
+                source, 0, "a poem with this title already exists", 0.0, 0.0)
+        else:
+            to_render.append(source)
+        seen_titles.add(source.title)
+
+    poem_keys: Dict[str, str] = {}
+    if config.get('compactStorage', False):
+        for source in to_render:
+            # A resumed import's notes must all use the same media file.
+            checkpoint = load_checkpoint(col, source.title)
+            poem_keys[source.path] = (checkpoint.poem_key if checkpoint is not None
+                                      and checkpoint.poem_key else new_poem_key())
+
+    model = col.models.by_name("LPCG 1.0")
+    undo_entry: Optional[int] = None
+    new_files: List[str] = []
+    rendered = render_files(to_render, config, context_lines, group_lines,
+                            recite_lines, max_workers, poem_keys)
+    for done, poem in enumerate(rendered, start=1):
+        if want_cancel is not None and want_cancel():
+            if undo_entry is not None:
+                discard_undo_entry(col, undo_entry)
+            for key in new_files:
+                trash_poem_file(col, key)
+            raise ImportCancelled()
+
+        if poem.error is not None:
+            results[poem.source.path] = FileResult(
+                poem.source, 0, f"couldn't read the file: {poem.error}", 0.0, 0.0)
+            if on_file is not None:
+                on_file(done, len(to_render))
+            continue
+
+        start = time.perf_counter()
+        title = poem.source.title
+        key = poem_keys.get(poem.source.path)
+        fingerprint = import_fingerprint([poem.text], context_lines, recite_lines,
+                                         group_lines, config)
+        checkpoint = load_checkpoint(col, title)
+        start_seq = 0
+        if checkpoint is not None:
+            if checkpoint.fingerprint != fingerprint:
+                results[poem.source.path] = FileResult(
+                    poem.source, 0, "an interrupted import of this title used a "
+                    "different text or settings", poem.seconds, 0.0)
+                if on_file is not None:
+                    on_file(done, len(to_render))
+                continue
+            start_seq = committed_sequence(col, checkpoint)
+
+        def save_progress(added: int, total: Optional[int]) -> None:
+            # pylint: disable=cell-var-from-loop
+            save_checkpoint(col, Checkpoint(
+                title, start_seq + added,
+                start_seq + total if total is not None else None, fingerprint, key))
+
+        notes = []
+        for fields in poem.fields[start_seq:]:
+            n = note_constructor(col, model)
+            n.tags = tags
+            n['Title'] = poem.source.title
+            n['Author'] = poem.source.author
+            for field, value in fields.items():
+                n[field] = value
+            notes.append(n)
+        if notes:
+            if key is not None:
+                write_poem_file(col, key, cleanse_text(poem.text, config),
+                                group_lines, context_lines)
+                if not start_seq:
+                    new_files.append(key)
+            if undo_entry is None:
+                undo_entry = col.add_custom_undo_entry("Import Lyrics/Poetry")
+            try:
+                insert_notes(col, notes, deck_id, on_batch=save_progress,
+                             want_cancel=want_cancel, undo_entry=undo_entry)
+            except ImportCancelled:
+                for new_key in new_files:
+                    trash_poem_file(col, new_key)
+                raise
+        if poem.fields:
+            if start_seq:
+                # The poem also consists of the notes added before.
+                register_poem(col, title, poem.source.author,
+                              context_lines, recite_lines, group_lines)
+            else:
+                register_notes(col, title, poem.source.author, [n.id for n in notes],
+                               context_lines, recite_lines, group_lines)
+            save_record(col, PoemRecord.create(
+                poem.source.title, poem.source.author, fingerprint,
+                context_lines, recite_lines, group_lines, config, key))
+        clear_checkpoint(col, title)
+        results[poem.source.path] = FileResult(
+            poem.source, len(notes), None if poem.fields else "no text to import",
+            poem.seconds, time.perf_counter() - start)
+        if on_file is not None:
+            on_file(done, len(to_render))
+
+    if undo_entry is not None:
+        # Fold in the checkpoints cleared since the last batch of notes.
+        col.merge_undo_entries(undo_entry)
+    return BatchResult([results[i.path] for i in sources], undo_entry)
+
+
+def format_summary(results: Sequence[FileResult], total_seconds: float) -> str:
+    "Describe the results of a batch import as plain text, one line per file."
+    imported = [i for i in results if not i.skipped]
+    lines = [
+        "Imported %i of %i files (%i notes) in %.2f seconds."
+        % (len(imported), len(results), sum(i.notes_added for i in results), total_seconds),
+        "",
+    ]
+    for result in results:
+        name = os.path.basename(result.source.path)
+        if result.skipped:
+            lines.append(f"{name}: skipped \"{result.source.title}\" ({result.skipped})")
+        else:
+            lines.append(
+                f"{name}: \"{result.source.title}\" - {result.notes_added} notes "
+                f"(parse {result.parse_seconds:.3f} s, insert {result.insert_seconds:.3f} s)")
+    return '\n'.join(lines)
@@ -0,0 +1,139 @@
+"""
+Actions in the browser's Notes menu that act on the whole poem the selected
+notes belong to: showing its text, renaming it, moving it to another deck,
+retagging it, and deleting it. The work is done by poem_ops. There's also
+an action for re-rendering every poem in the collection, done by rerender.
+"""
+
+from typing import Callable, List
+
+# pylint: disable=no-name-in-module
+from aqt.operations import CollectionOp
+from aqt.qt import QMenu
+from aqt.studydeck import StudyDeck
+from aqt.utils import askUser, getOnlyText, getText, showText, showWarning, tooltip
+from anki.collection import OpChangesWithCount
+from anki.notes import Note
+
+from .poem_ops import (delete_poem, fetch_poem, move_poem, poem_text, rename_poem,
+                       retag_poem, titles_of_notes)
+from .rerender import rerender_all
+
+
+def setup_menu(browser) -> None:
+    "Add the LPCG Poem submenu to /browser/'s Notes menu."
+    menu = QMenu("LPCG &Poem", browser)
+    for label, action in (("Show Poem &Text", show_text),
+                          ("&Rename Poem...", rename),
+                          ("&Move Poem to Deck...", move),
+                          ("Re&tag Poem...", retag),
+                          ("&Delete Poem", delete)):
+        menu.addAction(label).triggered.connect(
+            lambda _, action=action: _with_poem(browser, action))
+    menu.addSeparator()
+    menu.addAction("Re-render &All Poems...").triggered.connect(
+        lambda: rerender_all_poems(browser))
+    browser.form.menu_Notes.addSeparator()
+    browser.form.menu_Notes.addMenu(menu)
+
+
+def _with_poem(browser, action: Callable) -> None:
+    "Call action(browser, title) for the poem of the selected notes, if there's just one."
+    titles = titles_of_notes(browser.mw.col, browser.selected_notes())
+    if len(titles) != 1:
+        showWarning("Please select notes from a single LPCG poem.", parent=browser)
+        return
+    action(browser, titles[0])
+
+
+def _run(browser, op: Callable, message: str) -> None:
+    """
+    Run op(col), which returns a number of notes or cards, in the
+    background, then show /message/ formatted with that number.
+    """
+    def run(col) -> OpChangesWithCount:
+        result = OpChangesWithCount(count=op(col))
+        # Merging the operation's undo step into itself gives back its changes.
+        result.changes.CopyFrom(col.merge_undo_entries(col.undo_status().last_step))
+        return result
+
+    def on_failure(exc: Exception) -> None:
+        if isinstance(exc, ValueError):
+            showWarning(str(exc), parent=browser)
+        else:
+            raise exc
+
+    CollectionOp(parent=browser, op=run) \
+        .success(lambda result: tooltip(message % result.count, parent=browser)) \
+        .failure(on_failure) \
+        .run_in_background()
+
+
+def show_text(browser, title: str) -> None:
+    config = browser.mw.addonManager.getConfig(__name__)
+    showText(poem_text(browser.mw.col, title, config), parent=browser, title=title,
+             copyBtn=True)
+
+
+def rename(browser, title: str) -> None:
+    new_title = getOnlyText("New title:", parent=browser, default=title).strip()
+    if new_title and new_title != title:
+        _run(browser, lambda col: rename_poem(col, title, new_title), "%i notes renamed.")
+
+
+def move(browser, title: str) -> None:
+    def on_chosen(chooser: StudyDeck) -> None:
+        if chooser.name:
+            _run(browser, lambda col: move_poem(col, title, col.decks.id(chooser.name)),
+                 "%i cards moved.")
+
+    StudyDeck(browser.mw, current=None, accept="Move", title=f'Move "{title}" to Deck',
+              parent=browser, callback=on_chosen)
+
+
+def retag(browser, title: str) -> None:
+    old_tags = sorted({tag for n in fetch_poem(browser.mw.col, title) for tag in n.tags})
+    new_text, ok = getText("Tags (separated by spaces):", parent=browser,
+                           default=' '.join(old_tags))
+    new_tags = new_text.split()
+    if ok and set(new_tags) != set(old_tags):
+        _run(browser, lambda col: retag_poem(
+            col, title, add=[i for i in new_tags if i not in old_tags],
+            remove=[i for i in old_tags if i not in new_tags]), "%i notes retagged.")
+
+
+def delete(browser, title: str) -> None:
+    count = len(fetch_poem(browser.mw.col, title))
+    if askUser(f'Delete all {count} notes of "{title}"?', parent=browser):
+        _run(browser, lambda col: delete_poem(col, title), "%i notes deleted.")
+
+
+def rerender_all_poems(browser) -> None:
+    """
+    Re-render the notes of every poem in the collection with the markers in
+    the add-on's config, as one undo step, and list any poems that had to
+    be skipped.
+    """
+    if not askUser("Re-render the notes of all your LPCG poems with the end-of-stanza "
+                   "and end-of-poem markers in the add-on's config? Only notes that "
+                   "change are updated, and review history is kept.", parent=browser):
+        return
+    config = browser.mw.addonManager.getConfig(__name__)
+    skipped: List[str] = []
+
+    def run(col) -> OpChangesWithCount:
+        undo_entry = col.add_custom_undo_entry("Re-render Lyrics/Poetry")
+        results = rerender_all(col, Note, config,
+                               on_skip=lambda entry, reason: skipped.append(reason))
+        result = OpChangesWithCount(count=sum(
+            r.updated + r.added + r.removed for _, r in results))
+        result.changes.CopyFrom(col.merge_undo_entries(undo_entry))
+        return result
+
+    def on_success(result: OpChangesWithCount) -> None:
+        tooltip(f"{result.count} notes re-rendered.", parent=browser)
+        if skipped:
+            showText("These poems were left alone:\n\n" + "\n".join(skipped),
+                     parent=browser, title="Re-render All Poems")
+
+    CollectionOp(parent=browser, op=run).success(on_success).run_in_background()
@@ -0,0 +1,185 @@
+"""
+Headless interface for generating LPCG notes into a collection file,
+without starting Anki's GUI -- for instance, to pre-build decks for many texts
+on a build server. Only the anki package (not aqt or Qt) needs to be installed.
+
+From the directory containing the add-on (or this repository):
+
+    python -m src.cli collection.anki2 poem.txt --title "My Poem" --deck Poetry
+    python -m src.cli collection.anki2 poems/ --filename-pattern "{author} - {title}"
+
+The same thing can be done from Python with generate_notes().
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+from .batch_import import (FileResult, PoemFile, filename_regex, find_text_files,
+                           format_summary, identify, import_files)
+
+
+def default_config() -> Dict[str, Any]:
+    "Return the add-on's default configuration from config.json."
+    with open(os.path.join(os.path.dirname(__file__), 'config.json'),
+              encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_config(path: Optional[str] = None, stanza_marker: Optional[str] = None,
+                text_marker: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Return the add-on's default configuration, overridden by the options in
+    the JSON file at /path/ if given, and by the end-of-stanza and
+    end-of-text markers if given. The file can be a copy of config.json or
+    the add-on's meta.json, where Anki keeps the options the user has
+    changed under "config".
+
+    Raises OSError or ValueError if the file can't be read.
+    """
+    config = default_config()
+    if path is not None:
+        with open(path, encoding='utf-8') as f:
+            overrides = json.load(f)
+        if not isinstance(overrides, dict):
+            raise ValueError(f"{path} doesn't contain LPCG options")
+        config.update(overrides.get('config', overrides))
+    if stanza_marker is not None:
+        config['endOfStanzaMarker'] = stanza_marker
+    if text_marker is not None:
+        config['endOfTextMarker'] = text_marker
+    return config
+
+
+def add_config_arguments(parser: argparse.ArgumentParser) -> None:
+    "Add the options load_config() takes to /parser/."
+    parser.add_argument('--config', dest='config_path', metavar='PATH',
+                        help="JSON file of add-on options, e.g. the add-on's meta.json")
+    parser.add_argument('--stanza-marker',
+                        help="end-of-stanza marker (default: from the config)")
+    parser.add_argument('--text-marker',
+                        help="end-of-text marker (default: from the config)")
+
+
+def config_from_args(args: argparse.Namespace) -> Dict[str, Any]:
+    "Return the load_config() for the options add_config_arguments() added."
+    return load_config(args.config_path, args.stanza_marker, args.text_marker)
+
+
+def generate_notes(collection_path: str, paths: Sequence[str],
+                   title: Optional[str] = None, author: str = "",
+                   tags: Sequence[str] = (), deck: str = "Default",
+                   context_lines: Optional[int] = None,
+                   recite_lines: Optional[int] = None,
+                   group_lines: Optional[int] = None,
+                   filename_pattern: Optional[str] = None,
+                   config: Optional[Dict[str, Any]] = None,
+                   max_workers: Optional[int] = None,
+                   compact: Optional[bool] = None) -> List[FileResult]:
+    """
+    Import each text file in /paths/ (directories are searched for .txt files)
+    as a poem in the collection at /collection_path/, which is created if it
+    doesn't exist, and return a FileResult for each file.
+
+    /title/ may only be given if there's exactly one file; otherwise, titles
+    and authors are found as for a batch import in the GUI, using
+    /filename_pattern/ and Title/Author header comments, with /author/ as the
+    default author. Settings that aren't given come from /config/, which
+    defaults to the add-on's config.json; /compact/ overrides its
+    compactStorage option. Files are rendered in /max_workers/ processes,
+    one per CPU by default (see render_files()).
+
+    Raises ValueError if the collection's LPCG note type is out of date
+    (it must be upgraded by opening the collection in Anki first).
+    """
+    # pylint: disable=import-outside-toplevel
+    from anki.collection import Collection
+    from anki.notes import Note
+    from . import models
+
+    config = config or default_config()
+    if compact is not None:
+        config = dict(config, compactStorage=compact)
+    files = find_text_files(paths)
+    if title is not None:
+        if len(files) != 1:
+            raise ValueError("A title can only be given when importing a single file.")
+        sources = [PoemFile(files[0], title, author)]
+    else:
+        pattern = filename_regex(filename_pattern or config['batchFilenamePattern'])
+        sources = [identify(i, pattern, author) for i in files]
+
+    col = Collection(collection_path)
+    try:
+        if not models.LpcgOne.in_collection(col):
+            models.add_note_type(col)
+        elif not models.LpcgOne.is_at_version(
+                col.get_config('lpcg_model_version', default="none")):
+            raise ValueError("The LPCG note type in this collection is out of date. "
+                             "Open the collection in Anki to upgrade it first.")
+
+        return import_files(
+            col, Note, sources, config, list(tags), col.decks.id(deck),
+            context_lines if context_lines is not None else config['defaultLinesOfContext'],
+            group_lines if group_lines is not None else config['defaultLinesInGroupsOf'],
+            recite_lines if recite_lines is not None else config['defaultLinesToRecite'],
+            max_workers).files
+    finally:
+        col.close()
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    "Entry point for the command-line interface. Returns the exit status."
+    parser = argparse.ArgumentParser(
+        prog="python -m src.cli",
+        description="Generate LPCG notes from text files into an Anki collection.")
+    parser.add_argument('collection', help="path to the collection (.anki2) file")
+    parser.add_argument('paths', nargs='+', metavar='path',
+                        help="text files, or directories containing .txt files")
+    parser.add_argument('--title', help="title of the poem (single file only)")
+    parser.add_argument('--author', default="", help="author, or default author")
+    parser.add_argument('--tags', default="", help="space-separated tags to add")
+    parser.add_argument('--deck', default="Default", help="deck to add notes to")
+    parser.add_argument('--context', type=int, dest='context_lines',
+                        help="lines of context")
+    parser.add_argument('--recite', type=int, dest='recite_lines',
+                        help="lines to recite")
+    parser.add_argument('--group', type=int, dest='group_lines',
+                        help="lines in groups of")
+    parser.add_argument('--filename-pattern',
+                        help='pattern for titles in file names, e.g. "{author} - {title}"')
+    parser.add_argument('--workers', type=int, dest='max_workers',
+                        help="number of worker processes (0 to render in-process)")
+    parser.add_argument('--compact', action='store_true', default=None,
+                        help="store poems compactly (see compactStorage in config.md)")
+    add_config_arguments(parser)
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    try:
+        config = config_from_args(args)
+        results = generate_notes(
+            args.collection, args.paths, title=args.title, author=args.author,
+            tags=args.tags.split(), deck=args.deck, context_lines=args.context_lines,
+            recite_lines=args.recite_lines, group_lines=args.group_lines,
+            filename_pattern=args.filename_pattern, config=config,
+            max_workers=args.max_workers, compact=args.compact)
+    except (OSError, UnicodeDecodeError, ValueError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    except KeyError as e:
+        print(f"error: the field {e} is missing from the LPCG note type", file=sys.stderr)
+        return 1
+    elapsed = time.perf_counter() - start
+
+    print(format_summary(results, elapsed))
+    added = sum(i.notes_added for i in results)
+    print(f"{added / elapsed:.0f} notes/second overall.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""
+Compact storage of poems, an alternative to the usual self-contained notes
+(turned on with the compactStorage option).
+
+Normally each note keeps its own copy of the lines of context before it, so
+a poem takes up about (1 + context + recite) times its own size in the
+collection, all of which has to be synced. In compact storage, the cleansed
+lines of the poem and its grouping and context settings are written once, to
+a JSON file in the collection's media folder, and each note's Context field
+is only a short comment with the file's key (see
+gen_notes.context_placeholder()). A script in the card template fetches the
+file and renders the context from it using the note's Sequence number,
+exactly as LPCG would have (see models.CONTEXT_SCRIPT).
+
+Media files don't count toward the size of the collection, and are synced
+separately, only when they change. Each poem's key is chosen at random when
+it's first imported in compact storage, and kept in its PoemRecord (and any
+Checkpoint) so the poem keeps its file when it's re-imported or renamed.
+The file's name starts with an underscore, so Check Media never considers
+it unused; deleting the poem trashes it (see poem_ops.delete_poem()).
+
+The Line field is still stored in full, since the poem registry, editing
+and re-rendering poems, and searching in the browser all rely on it.
+"""
+
+import json
+import os
+import re
+import secrets
+from typing import Any, List, NamedTuple, Optional, Sequence
+
+from .gen_notes import BEGINNING_TEXT, NotePlan, plan_notes
+
+_PLACEHOLDER_RE = re.compile(r'^<!--lpcg:(?P<key>[0-9a-f]+)-->$')
+
+
+def new_poem_key() -> str:
+    "Return a new random key for the media file holding the lines of a poem."
+    return secrets.token_hex(6)
+
+
+def poem_file_name(key: str) -> str:
+    "Return the name of the media file with the key /key/."
+    return f"_lpcg-{key}.json"
+
+
+def poem_file_data(text_lines: Sequence[str], group_lines: int, context_lines: int) -> bytes:
+    "Return the contents of the media file for a poem with the given cleansed lines and settings."
+    return json.dumps({'lines': list(text_lines), 'group': group_lines,
+                       'context': context_lines, 'beginning': BEGINNING_TEXT},
+                      ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def write_poem_file(col: Any, key: str, text_lines: Sequence[str], group_lines: int,
+                    context_lines: int) -> str:
+    """
+    Write the media file with the key /key/, replacing any older version,
+    and return the key, to be passed to add_notes() or reimport_notes().
+    """
+    name = poem_file_name(key)
+    data = poem_file_data(text_lines, group_lines, context_lines)
+    if col.media.have(name):
+        with open(os.path.join(col.media.dir(), name), 'rb') as f:
+            if f.read() == data:
+                return key
+        # Otherwise Anki would keep the old file and give this one another name.
+        col.media.trash_files([name])
+    col.media.write_data(name, data)
+    return key
+
+
+def poem_key_of(context: str) -> Optional[str]:
+    "Return the key in a Context field in compact storage, or None if it isn't one."
+    match = _PLACEHOLDER_RE.match(context)
+    return match.group('key') if match else None
+
+
+def trash_poem_file(col: Any, key: Optional[str]) -> None:
+    "Move the media file with the key /key/ to the media trash, if there is one."
+    if key is not None and col.media.have(poem_file_name(key)):
+        col.media.trash_files([poem_file_name(key)])
+
+
+class StorageReport(NamedTuple):
+    "Bytes a poem's notes take up in each storage mode; see storage_report()."
+    full_bytes: int
+    compact_bytes: int
+    file_bytes: int
+
+    @property
+    def saved_bytes(self) -> int:
+        "Bytes saved in the collection by compact storage."
+        return self.full_bytes - self.compact_bytes
+
+    @property
+    def net_saved_bytes(self) -> int:
+        "Bytes saved by compact storage, counting the media file against it."
+        return self.saved_bytes - self.file_bytes
+
+
+def storage_report(title: str, author: str, text_lines: List[str], context_lines: int,
+                   group_lines: int, recite_lines: int) -> StorageReport:
+    """
+    Work out how big the fields of a poem's notes would be in normal and in
+    compact storage, and how big its media file would be, without rendering
+    any notes (see NotePlan.field_bytes()).
+    """
+    def plan(key: Optional[str]) -> NotePlan:
+        return plan_notes(title, author, [], text_lines, 0, context_lines, group_lines,
+                          recite_lines, key)
+
+    return StorageReport(plan(None).field_bytes(), plan(new_poem_key()).field_bytes(),
+                         len(poem_file_data(text_lines, group_lines, context_lines)))
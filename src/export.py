@@ -0,0 +1,114 @@
+"""
+Export the notes LPCG would generate for a text to a CSV or TSV file, rather
+than adding them to a collection, for use by other tools.
+
+The columns are the fields of the LPCG 1.0 note type in order, followed by
+the tags and, if a deck is given, the deck, and the file starts with the
+header lines Anki's importer uses to pick the note type and separator and
+find the tags and deck columns, so the file can also be imported
+back into Anki with File -> Import. Notes are rendered and written one row
+at a time as the text is read, so memory use doesn't depend on its length.
+
+    python -m src.export poem.txt poem.csv --title "My Poem"
+    python -m src.export poem.txt poem.tsv --title "My Poem" --deck Poetry
+"""
+
+import argparse
+import csv
+import sys
+from typing import Any, Dict, Iterable, Optional, Sequence, TextIO
+
+from .gen_notes import NoteSpec, cleanse_lines, read_text_file, stream_notes
+
+#: The fields of the LPCG 1.0 note type, in order (see models.LpcgOne).
+FIELDS = ("Line", "Context", "Title", "Author", "Sequence", "Prompt")
+
+SEPARATOR_NAMES = {',': "Comma", '\t': "Tab"}
+
+
+def write_notes(out: TextIO, specs: Iterable[NoteSpec], delimiter: str = ',',
+                deck: Optional[str] = None) -> int:
+    """
+    Write /specs/ to /out/ (opened with newline='') as CSV, or TSV if
+    /delimiter/ is a tab, and return the number of notes written. If /deck/
+    is given, Anki will import the notes into that deck. It goes in a column
+    of its own on every row rather than in a #deck header, which Anki ignores
+    if the deck doesn't exist yet; a deck column creates it.
+    """
+    columns = FIELDS + ('Tags',) + (('Deck',) if deck is not None else ())
+    out.write(f"#separator:{SEPARATOR_NAMES[delimiter]}\n")
+    out.write("#html:true\n")
+    out.write("#notetype:LPCG 1.0\n")
+    out.write(f"#columns:{delimiter.join(columns)}\n")
+    out.write(f"#tags column:{columns.index('Tags') + 1}\n")
+    if deck is not None:
+        out.write(f"#deck column:{columns.index('Deck') + 1}\n")
+
+    writer = csv.writer(out, delimiter=delimiter, lineterminator='\n')
+    count = 0
+    for spec in specs:
+        writer.writerow([spec.fields.get(field, "") for field in FIELDS]
+                        + [' '.join(spec.tags)] + ([deck] if deck is not None else []))
+        count += 1
+    return count
+
+
+def export_file(source_path: str, out_path: str, title: str, author: str,
+                tags: Sequence[str], config: Dict[str, Any], context_lines: int,
+                group_lines: int, recite_lines: int, deck: Optional[str] = None,
+                delimiter: Optional[str] = None) -> int:
+    """
+    Generate the notes for the text file at /source_path/ and write them to
+    /out_path/, returning the number of notes written. The file is written
+    as TSV if /delimiter/ is a tab, or if it's None and /out_path/ ends in
+    .tsv or .txt; otherwise, as CSV.
+    """
+    if delimiter is None:
+        delimiter = '\t' if out_path.lower().endswith(('.tsv', '.txt')) else ','
+    lines = cleanse_lines(read_text_file(source_path), config)
+    specs = stream_notes(title, author, list(tags), lines, 0,
+                         context_lines, group_lines, recite_lines)
+    with open(out_path, 'w', encoding='utf-8', newline='') as out:
+        return write_notes(out, specs, delimiter, deck)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    "Entry point for the command-line exporter. Returns the exit status."
+    # pylint: disable=import-outside-toplevel
+    from .cli import add_config_arguments, config_from_args
+
+    parser = argparse.ArgumentParser(
+        prog="python -m src.export",
+        description="Export the LPCG notes for a text file to CSV or TSV.")
+    parser.add_argument('source', help="text file to generate notes from")
+    parser.add_argument('output', help="file to write (.csv, or .tsv/.txt for TSV)")
+    parser.add_argument('--title', required=True, help="title of the poem")
+    parser.add_argument('--author', default="", help="author of the poem")
+    parser.add_argument('--tags', default="", help="space-separated tags to add")
+    parser.add_argument('--deck', help="deck for Anki to import the notes into")
+    parser.add_argument('--context', type=int, dest='context_lines',
+                        help="lines of context")
+    parser.add_argument('--recite', type=int, dest='recite_lines',
+                        help="lines to recite")
+    parser.add_argument('--group', type=int, dest='group_lines',
+                        help="lines in groups of")
+    add_config_arguments(parser)
+    args = parser.parse_args(argv)
+
+    try:
+        config = config_from_args(args)
+        count = export_file(
+            args.source, args.output, args.title, args.author, args.tags.split(), config,
+            args.context_lines if args.context_lines is not None else config['defaultLinesOfContext'],
+            args.group_lines if args.group_lines is not None else config['defaultLinesInGroupsOf'],
+            args.recite_lines if args.recite_lines is not None else config['defaultLinesToRecite'],
+            args.deck)
+    except (OSError, UnicodeDecodeError, ValueError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    print(f"Wrote {count} notes to {args.output}.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
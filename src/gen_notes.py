@@ -1,52 +1,243 @@
-from itertools import zip_longest
+import codecs
+from bisect import bisect_right
+import difflib
+from itertools import islice
+import mmap
 import re
-from typing import Any, Callable, Dict, Iterable, List, Optional, TYPE_CHECKING
+import time
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, NamedTuple,
+                    Optional, Sequence, Sized, Tuple, TYPE_CHECKING, Union, overload)
+
+from .timing import NULL_TIMER, StageTimer
 
 if TYPE_CHECKING:
     from anki.notes import Note
 
+try:
+    from anki.collection import AddNoteRequest
+except ImportError:
+    # Running outside Anki (e.g., unit tests), or in an Anki older than 23.10,
+    # which has no batch add API (see _add_batch()). The batch add API only
+    # needs the note and deck ID of each request.
+    class AddNoteRequest(NamedTuple):  # type: ignore[no-redef]
+        note: Any
+        deck_id: int
+
+
+BEGINNING_TEXT = "[Beginning]"
+
+#: Number of notes sent to the collection in the first call to its batch add
+#: API; later batches are resized by BatchSizer.
+ADD_BATCH_SIZE = 500
+#: Bounds on the batch size, and the time BatchSizer aims for each batch to take.
+MIN_BATCH_SIZE = 50
+MAX_BATCH_SIZE = 5000
+TARGET_BATCH_SECONDS = 0.25
+
+#: Number of bytes of a text file decoded at a time by read_text_file().
+READ_CHUNK_SIZE = 1 << 20
+
+
+class ImportCancelled(Exception):
+    """
+    Raised by add_notes() when the caller asks for the import to be cancelled.
+    By the time it's raised, the import's undo step has been discarded with
+    discard_undo_entry(), so any notes already added, and anything else merged
+    into the step (like checkpoints), are gone without leaving an empty step
+    in the undo queue or the import in the redo queue.
+    """
+
+
+class AddResult(NamedTuple):
+    """
+    The ids of the notes added by add_notes() or insert_notes(), and the
+    custom undo entry they were merged into (None if nothing was added and
+    no entry was given). Once the caller has made the rest of its changes,
+    merging into this entry again gives the OpChanges of the whole import.
+    """
+    note_ids: List[int]
+    undo_entry: Optional[int]
+
+
+class ReimportResult(NamedTuple):
+    """
+    Numbers of notes affected by reimport_notes(), the poem's notes afterwards,
+    and the undo entry the changes were merged into (None if nothing changed).
+    """
+    added: int
+    updated: int
+    removed: int
+    unchanged: int
+    notes: List['Note']
+    undo_entry: Optional[int] = None
+
+
+class Poem(Sequence['PoemLine']):
+    """
+    Compact, array-backed representation of a cleansed poem.
+
+    The poem is stored as nothing more than the flat list of its text lines
+    and the number of lines in each group; PoemLine objects are lightweight
+    views created on demand when the poem is indexed or iterated. Line 0 is
+    the [Beginning] marker, and line k (its sequence number) consists of the
+    text lines from offset (k-1) * group_lines up to the start of line k+1,
+    so predecessors, successors, and the context and recitation windows of
+    any line are found by arithmetic and taken with a single slice, with no
+    recursion and no per-line allocations.
+    """
+    __slots__ = ('text_lines', 'group_lines', 'beginning_text')
+
+    def __init__(self, text_lines: Sequence[str], group_lines: int = 1,
+                 beginning_text: str = BEGINNING_TEXT) -> None:
+        assert group_lines >= 1, "Lines must be grouped in groups of at least 1!"
+        self.text_lines = text_lines
+        self.group_lines = group_lines
+        self.beginning_text = beginning_text
+
+    def __len__(self) -> int:
+        "Number of PoemLines in the poem, not including the Beginning."
+        return -(-len(self.text_lines) // self.group_lines)
+
+    @overload
+    def __getitem__(self, index: int) -> 'PoemLine': ...
+    @overload
+    def __getitem__(self, index: slice) -> List['PoemLine']: ...
+    def __getitem__(self, index: Union[int, slice]) -> Union['PoemLine', List['PoemLine']]:
+        if isinstance(index, slice):
+            return [self.line_at(i + 1) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("poem line index out of range")
+        return self.line_at(index + 1)
+
+    def __iter__(self) -> Iterator['PoemLine']:
+        for seq in range(1, len(self) + 1):
+            yield self.line_at(seq)
+
+    def line_at(self, seq: int) -> 'PoemLine':
+        "Return a view of the line with sequence number /seq/ (0 = Beginning)."
+        if seq == 0:
+            return Beginning(self)
+        elif self.group_lines == 1:
+            return SingleLine(self, seq)
+        else:
+            return GroupedLine(self, seq)
+
+    def _offset(self, seq: int) -> int:
+        "Index into text_lines of the first text line of line /seq/."
+        return min((seq - 1) * self.group_lines, len(self.text_lines))
+
+    def unit(self, seq: int) -> List[str]:
+        "Return the text lines making up the line with sequence number /seq/."
+        if seq == 0:
+            return [self.beginning_text]
+        return list(self.text_lines[self._offset(seq):self._offset(seq + 1)])
+
+    def context(self, seq: int, lines: int) -> List[str]:
+        """
+        Return the text lines of the (lines) PoemLines preceding /seq/, going
+        no further back than the Beginning. If /lines/ is 0, the line itself
+        serves as its own context.
+        """
+        if lines == 0:
+            return self.unit(seq)
+        start = seq - lines
+        window = list(self.text_lines[self._offset(max(start, 1)):self._offset(seq)])
+        if start <= 0:
+            window.insert(0, self.beginning_text)
+        return window
+
+    def text(self, seq: int, lines: int) -> List[str]:
+        """
+        Return the text lines of line /seq/ and its (lines - 1) successors,
+        stopping early at the end of the poem.
+        """
+        end = len(self) + 1
+        if lines >= 1:
+            end = min(seq + lines, end)
+        return list(self.text_lines[self._offset(seq):self._offset(end)])
+
 
 class PoemLine:
-    def __init__(self) -> None:
-        self.predecessor = self  # so it's the right type...
-        self.successor: Optional['PoemLine'] = None
-        self.seq = -1
+    """
+    View of a single line of a Poem, identified by its sequence number.
+    Instances hold only a reference to the poem and an index, so they are
+    cheap to create and can be discarded as soon as their note is populated.
+    """
+    __slots__ = ('poem', 'seq')
+
+    def __init__(self, poem: Poem, seq: int) -> None:
+        self.poem = poem
+        self.seq = seq
+
+    @property
+    def predecessor(self) -> 'PoemLine':
+        return self.poem.line_at(self.seq - 1)
+
+    @property
+    def successor(self) -> Optional['PoemLine']:
+        if self.seq >= len(self.poem):
+            return None
+        return self.poem.line_at(self.seq + 1)
 
     def populate_note(self, note: 'Note', title: str, author: str, tags: List[str],
-                      context_lines: int, recite_lines: int, deck_id: int) -> None:
+                      context_lines: int, recite_lines: int,
+                      poem_key: Optional[str] = None) -> None:
         """
         Fill the _note_ with content testing on the current line.
         """
-        note.note_type()['did'] = deck_id  # type: ignore
         note.tags = tags
         note['Title'] = title
         note['Author'] = author
-        note['Sequence'] = str(self.seq)
-        note['Context'] = self._format_context(context_lines)
-        note['Line'] = self._format_text(recite_lines)
-        prompt = self._get_prompt(recite_lines)
+        for field, value in self.fields(context_lines, recite_lines, poem_key).items():
+            note[field] = value
+
+    def fields(self, context_lines: int, recite_lines: int,
+               poem_key: Optional[str] = None) -> Dict[str, str]:
+        """
+        Return the contents of the fields that depend on this line's position
+        in the poem (Sequence, Context, Line, and Prompt if needed), as plain
+        strings which can be computed and passed around without a collection.
+
+        If /poem_key/ is given, the poem is in compact storage, and the
+        Context field is only a placeholder; see context_placeholder().
+        """
+        recitation = self._get_text(recite_lines)
+        fields = {
+            'Sequence': str(self.seq),
+            'Context': (context_placeholder(poem_key) if poem_key is not None
+                        else self._format_context(context_lines)),
+            'Line': self._format_lines(recitation),
+        }
+        prompt = self._prompt_for(recitation)
         if prompt is not None:
-            note['Prompt'] = prompt
+            fields['Prompt'] = prompt
+        return fields
+
+    @staticmethod
+    def _format_lines(lines: List[str]) -> str:
+        return ''.join("<p>%s</p>" % i for i in lines)
 
     def _format_context(self, context_lines: int):
-        return ''.join("<p>%s</p>" % i for i in self._get_context(context_lines))
+        return self._format_lines(self._get_context(context_lines))
 
     def _format_text(self, recitation_lines: int):
-        return ''.join("<p>%s</p>" % i for i in self._get_text(recitation_lines))
+        return self._format_lines(self._get_text(recitation_lines))
 
-    def _get_context(self, _lines: int, _recursing=False) -> List[str]:
+    def _get_context(self, lines: int) -> List[str]:
         """
-        Return a list of context lines, including the current line and
-        (lines - 1) of its predecessors.
+        Return a list of context lines: the text of the (lines) PoemLines
+        before this one, or this line itself if /lines/ is 0.
         """
-        raise NotImplementedError
+        return self.poem.context(self.seq, lines)
 
-    def _get_text(self, _lines: int) -> List[str]:
+    def _get_text(self, lines: int) -> List[str]:
         """
         Return a list of recitation lines, including the current line and
         (lines - 1) of its successors.
         """
-        raise NotImplementedError
+        return self.poem.text(self.seq, lines)
 
     def _get_prompt(self, configured_recitation_lines: int) -> Optional[str]:
         """
@@ -55,7 +246,34 @@ class PoemLine:
         is currently used to let the user know how many lines to recite, but
         could plausibly be used for other things as well in the future.
         """
-        raise NotImplementedError
+        return self._prompt_for(self._get_text(configured_recitation_lines))
+
+    @staticmethod
+    def _prompt_for(recitation: List[str]) -> Optional[str]:
+        # It's important to count the lines actually being recited instead of
+        # just using the configuration parameter, as if we're at the end
+        # there may be fewer.
+        return prompt_for(len(recitation))
+
+
+def context_placeholder(poem_key: str) -> str:
+    """
+    Return the Context field of a note whose poem is in compact storage: an
+    HTML comment with the key of the media file holding the poem's lines,
+    which the card template renders the context from (see compact.py).
+    """
+    return f'<!--lpcg:{poem_key}-->'
+
+
+def prompt_for(lines_to_recite: int) -> Optional[str]:
+    """
+    Return the contents of the Prompt field for a note that recites
+    /lines_to_recite/ lines, or None if the template's default [...] will do.
+    """
+    if lines_to_recite == 1:
+        return None
+    else:
+        return f"[...{lines_to_recite}]"
 
 
 class Beginning(PoemLine):
@@ -64,15 +282,23 @@ class Beginning(PoemLine):
     it can polymorphically have its context and sequence retrieved.
     Attempting to do anything else with the node is an error.
     """
-    def __init__(self):
-        super().__init__()
-        self.seq = 0
-        self.text = "[Beginning]"
+    __slots__ = ()
 
-    def _get_context(self, _lines: int, _recursing=False) -> List[str]:
+    def __init__(self, poem: Poem) -> None:
+        super().__init__(poem, 0)
+
+    @property
+    def text(self) -> str:
+        return self.poem.beginning_text
+
+    @property
+    def predecessor(self) -> 'PoemLine':
+        return self
+
+    def _get_context(self, lines: int) -> List[str]:
         return [self.text]
 
-    def _get_text(self, _lines: int) -> List[str]:
+    def _get_text(self, lines: int) -> List[str]:
         """
         The Beginning node has no defined successors, as it's not a line
         we'll ever be asked to recite and thus we never need to know what its
@@ -82,7 +308,12 @@ class Beginning(PoemLine):
         raise NotImplementedError
 
     def populate_note(self, note: 'Note', title: str, author: str, tags: List[str],
-                      context_lines: int, recite_lines: int, deck_id: int) -> None:
+                      context_lines: int, recite_lines: int,
+                      poem_key: Optional[str] = None) -> None:
+        raise AssertionError("The Beginning node cannot be used to populate a note.")
+
+    def fields(self, context_lines: int, recite_lines: int,
+               poem_key: Optional[str] = None) -> Dict[str, str]:
         raise AssertionError("The Beginning node cannot be used to populate a note.")
 
 
@@ -92,35 +323,11 @@ class SingleLine(PoemLine):
     predecessor (possibly the Beginning node, but never None), and if it's
     not the last line of the poem, a successor.
     """
-    def __init__(self, text: str, predecessor: 'PoemLine') -> None:
-        super().__init__()
-        self.text = text
-        self.predecessor = predecessor
-        self.seq = self.predecessor.seq + 1
+    __slots__ = ()
 
-    def _get_context(self, lines: int, recursing=False) -> List[str]:
-        if lines == 0:
-            return [self.text]
-        elif not recursing:
-            return self.predecessor._get_context(lines - 1, True)
-        else:
-            return self.predecessor._get_context(lines - 1, True) + [self.text]
-
-    def _get_text(self, lines: int) -> List[str]:
-        if lines == 1 or self.successor is None:
-            return [self.text]
-        else:
-            return [self.text] + self.successor._get_text(lines - 1)
-
-    def _get_prompt(self, configured_recitation_lines: int) -> Optional[str]:
-        # It's important to calculate the lines_to_recite for _this_ instance
-        # instead of just getting the configuration parameter, as if we're at
-        # the end it may be fewer.
-        lines_to_recite = len(self._get_text(configured_recitation_lines))
-        if lines_to_recite == 1:
-            return None
-        else:
-            return f"[...{lines_to_recite}]"
+    @property
+    def text(self) -> str:
+        return self.poem.text_lines[self.seq - 1]
 
 
 class GroupedLine(PoemLine):
@@ -140,67 +347,321 @@ class GroupedLine(PoemLine):
         /E
         \F
     """
-    def __init__(self, text: List[str], predecessor: 'PoemLine') -> None:
-        super().__init__()
-        self.text_lines = text
-        self.predecessor = predecessor
-        self.seq = self.predecessor.seq + 1
+    __slots__ = ()
 
-    def _get_context(self, lines: int, recursing=False) -> List[str]:
-        if lines == 0:
-            return self.text_lines
-        elif not recursing:
-            return self.predecessor._get_context(lines - 1, True)
-        else:
-            return self.predecessor._get_context(lines - 1, True) + self.text_lines
+    @property
+    def text_lines(self) -> List[str]:
+        return self.poem.unit(self.seq)
 
-    def _get_text(self, lines: int) -> List[str]:
-        if lines == 1 or self.successor is None:
-            return self.text_lines
-        else:
-            return self.text_lines + self.successor._get_text(lines - 1)
 
-    def _get_prompt(self, configured_recitation_lines: int) -> Optional[str]:
-        lines_to_recite = len(self._get_text(configured_recitation_lines))
-        if lines_to_recite == 1:
-            return None
-        else:
-            return f"[...{lines_to_recite}]"
+def _poemlines_from_textlines(text_lines: List[str], group_lines: int) -> Poem:
+    """
+    Given a list of cleansed text lines, create a Poem from it. Its items are
+    PoemLine objects, each capable of constructing a correct note testing
+    itself when the populate_note() method is called on it.
+    """
+    return Poem(text_lines, group_lines)
+
+
+class NoteSpec(NamedTuple):
+    """
+    Everything needed to create one LPCG note, as plain data that doesn't
+    depend on Anki and can be pickled (e.g., to pass between processes).
+    """
+    sequence: int
+    #: Title, Author, Sequence, Context, Line, and Prompt if needed.
+    fields: Dict[str, str]
+    tags: List[str]
+    deck_id: int
+
+    def apply(self, note: 'Note') -> None:
+        "Fill in /note/'s fields and tags from this spec."
+        note.tags = self.tags
+        for field, value in self.fields.items():
+            note[field] = value
+
+
+class NotePlan(Sequence[NoteSpec]):
+    """
+    The notes that will be generated for a poem with given settings, as
+    NoteSpecs rendered on demand when the plan is indexed or iterated.
+    Finding out how many notes there will be, or how large they'll be,
+    doesn't require rendering any of them.
+
+    If /poem_key/ is given, the notes are for compact storage; see
+    PoemLine.fields().
+    """
+    __slots__ = ('poem', 'title', 'author', 'tags', 'deck_id',
+                 'context_lines', 'recite_lines', 'poem_key')
+
+    def __init__(self, poem: Poem, title: str, author: str, tags: List[str],
+                 deck_id: int, context_lines: int, recite_lines: int,
+                 poem_key: Optional[str] = None) -> None:
+        self.poem = poem
+        self.title = title
+        self.author = author
+        self.tags = tags
+        self.deck_id = deck_id
+        self.context_lines = context_lines
+        self.recite_lines = recite_lines
+        self.poem_key = poem_key
+
+    def __len__(self) -> int:
+        return len(self.poem)
+
+    @overload
+    def __getitem__(self, index: int) -> NoteSpec: ...
+    @overload
+    def __getitem__(self, index: slice) -> List[NoteSpec]: ...
+    def __getitem__(self, index: Union[int, slice]) -> Union[NoteSpec, List[NoteSpec]]:
+        if isinstance(index, slice):
+            return [self.spec(i + 1) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("note plan index out of range")
+        return self.spec(index + 1)
+
+    def __iter__(self) -> Iterator[NoteSpec]:
+        for seq in range(1, len(self) + 1):
+            yield self.spec(seq)
 
+    def spec(self, seq: int) -> NoteSpec:
+        "Render the NoteSpec for the line with sequence number /seq/."
+        fields = {'Title': self.title, 'Author': self.author}
+        fields.update(self.poem.line_at(seq).fields(self.context_lines, self.recite_lines,
+                                                    self.poem_key))
+        return NoteSpec(seq, fields, self.tags, self.deck_id)
 
-def groups_of_n(iterable: Iterable, n: int) -> Iterable:
+    def field_bytes(self) -> int:
+        """
+        Return the total size in bytes (encoded as UTF-8) of the fields of all
+        the notes in the plan, without rendering them. This takes one pass
+        over the lengths of the text lines, and constant time per note.
+        """
+        poem = self.poem
+        # prefix[i] = size of the first i text lines, each formatted as <p>...</p>
+        prefix = [0]
+        for text_line in poem.text_lines:
+            prefix.append(prefix[-1] + len(text_line.encode('utf-8')) + len("<p></p>"))
+        beginning = len(poem.beginning_text.encode('utf-8')) + len("<p></p>")
+        fixed = len(self.title.encode('utf-8')) + len(self.author.encode('utf-8'))
+        placeholder = (len(context_placeholder(self.poem_key).encode('utf-8'))
+                       if self.poem_key is not None else None)
+
+        total = 0
+        for seq in range(1, len(poem) + 1):
+            if placeholder is not None:
+                context = placeholder
+            elif self.context_lines == 0:
+                context = prefix[poem._offset(seq + 1)] - prefix[poem._offset(seq)]
+            else:
+                start = seq - self.context_lines
+                context = prefix[poem._offset(seq)] - prefix[poem._offset(max(start, 1))]
+                if start <= 0:
+                    context += beginning
+            end = len(poem) + 1
+            if self.recite_lines >= 1:
+                end = min(seq + self.recite_lines, end)
+            line = prefix[poem._offset(end)] - prefix[poem._offset(seq)]
+            recited = poem._offset(end) - poem._offset(seq)
+            prompt = len(f"[...{recited}]") if recited != 1 else 0
+            total += fixed + len(str(seq)) + context + line + prompt
+        return total
+
+
+class _SlidingLines(Sequence[str]):
+    """
+    The text lines of a poem that's being read one line at a time, of which
+    only a window is kept in memory. Indices are positions in the whole
+    poem; lines before the window can no longer be retrieved, and its
+    length is the number of lines read so far.
+    """
+    def __init__(self, source: Iterable[str]) -> None:
+        self._source = iter(source)
+        self._start = 0
+        self._lines: List[str] = []
+        self.exhausted = False
+
+    def __len__(self) -> int:
+        return self._start + len(self._lines)
+
+    @overload
+    def __getitem__(self, index: int) -> str: ...
+    @overload
+    def __getitem__(self, index: slice) -> List[str]: ...
+    def __getitem__(self, index: Union[int, slice]) -> Union[str, List[str]]:
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            assert start >= self._start and step == 1, "line no longer in window"
+            return self._lines[start - self._start:stop - self._start]
+        assert index >= self._start, "line no longer in window"
+        return self._lines[index - self._start]
+
+    def fill(self, count: Optional[int]) -> None:
+        "Read lines until there are /count/ of them (or all of them if None)."
+        while not self.exhausted and (count is None or len(self) < count):
+            try:
+                self._lines.append(next(self._source))
+            except StopIteration:
+                self.exhausted = True
+
+    def discard_before(self, index: int) -> None:
+        "Forget the lines before /index/."
+        if index > self._start:
+            del self._lines[:index - self._start]
+            self._start = index
+
+
+def stream_notes(title: str, author: str, tags: List[str], text: Iterable[str],
+                 deck_id: int, context_lines: int, group_lines: int,
+                 recite_lines: int, poem_key: Optional[str] = None) -> Iterator[NoteSpec]:
     """
-    s -> (s0,s1,s2,...sn-1), (sn,sn+1,sn+2,...s2n-1), (s2n,s2n+1,s2n+2,...s3n-1), ...
+    Yield the same NoteSpecs as plan_notes(), but reading the cleansed lines
+    of /text/ (e.g., from cleanse_lines()) as they're needed and keeping
+    only the lines still needed for context and recitation, so memory use
+    doesn't depend on the length of the text. (With recite_lines set to 0,
+    every note recites the rest of the poem, so the rest of the poem must be
+    held in memory anyway.)
+    """
+    window = _SlidingLines(text)
+    plan = NotePlan(Poem(window, group_lines), title, author, tags, deck_id,
+                    context_lines, recite_lines, poem_key)
+    seq = 1
+    while True:
+        window.fill((seq - 1 + recite_lines) * group_lines
+                    if recite_lines >= 1 else None)
+        if len(window) <= (seq - 1) * group_lines:
+            return
+        yield plan.spec(seq)
+        seq += 1
+        window.discard_before(plan.poem._offset(max(seq - context_lines, 1)))
+
 
-    Credit: https://stackoverflow.com/questions/5389507/iterating-over-every-two-elements-in-a-list
+def plan_notes(title: str, author: str, tags: List[str], text: List[str],
+               deck_id: int, context_lines: int, group_lines: int,
+               recite_lines: int, poem_key: Optional[str] = None) -> NotePlan:
     """
-    return zip_longest(*[iter(iterable)]*n)
+    Plan the notes for the poem with the given cleansed /text/ and settings,
+    without needing a collection. The notes are rendered only as the plan
+    is iterated; see NotePlan.
+    """
+    return NotePlan(Poem(text, group_lines), title, author, tags, deck_id,
+                    context_lines, recite_lines, poem_key)
 
 
-def _poemlines_from_textlines(text_lines: List[str], group_lines: int) -> List[PoemLine]:
+def read_text_file(path: str, chunk_size: Optional[int] = None) -> Iterator[str]:
     """
-    Given a list of cleansed text lines, create a list of PoemLine objects
-    from it. These are each capable of constructing a correct note testing
-    themselves when the to_note() method is called on them.
+    Yield the contents of the UTF-8 text file at /path/ as a series of strings,
+    each ending at a line break (except possibly the last), suitable for
+    passing to cleanse_lines().
+
+    The file is memory-mapped and decoded incrementally, chunk_size bytes at a
+    time (READ_CHUNK_SIZE by default), so even a very large file is never
+    held in memory in its entirety, either as bytes or as text.
     """
-    beginning = Beginning()
-    lines: List[PoemLine] = []  # does not include beginning, as it's not actually a line
-    pred: PoemLine = beginning
-    poem_line: PoemLine
+    chunk_size = chunk_size or READ_CHUNK_SIZE
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    with open(path, 'rb') as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty files can't be mapped
+            return
+        with mapped:
+            remainder = ""
+            for start in range(0, len(mapped), chunk_size):
+                text = remainder + decoder.decode(mapped[start:start+chunk_size])
+                # Only break after a \n, so a \r\n pair is never split
+                # and no line is divided between two chunks.
+                cut = text.rfind('\n') + 1
+                if cut:
+                    yield text[:cut]
+                remainder = text[cut:]
+            remainder += decoder.decode(b'', final=True)
+            if remainder:
+                yield remainder
 
-    if group_lines == 1:
-        for text_line in text_lines:
-            poem_line = SingleLine(text_line, pred)
-            lines.append(poem_line)
-            pred.successor = poem_line
-            pred = poem_line
+
+def _split_source(source: Union[str, Iterable[str]]) -> Iterator[str]:
+    """
+    Yield the lines of /source/, which may be a string or any iterable of
+    strings (e.g., an open text file), without their line endings.
+    Line boundaries are the same as for str.splitlines(), except that an
+    empty string in an iterable is a blank line of its own, so a list of
+    lines without endings (like ['a', '', 'b']) keeps its stanza breaks.
+    """
+    if isinstance(source, str):
+        yield from source.splitlines()
     else:
-        for line_set in groups_of_n(text_lines, group_lines):
-            poem_line = GroupedLine([i for i in line_set if i is not None], pred)
-            lines.append(poem_line)
-            pred.successor = poem_line
-            pred = poem_line
-    return lines
+        for chunk in source:
+            yield from chunk.splitlines() or ['']
+
+
+def _lex_line(line: str) -> Optional[str]:
+    """
+    Apply the per-line markup rules to a raw line: record a level of
+    indentation, strip whitespace, and remove comments. A # preceded by a
+    backslash doesn't start a comment, and is kept as a literal #, so lyrics
+    can include chord names or hashtags. Return None if the whole line is a
+    comment and should be dropped; an empty string means the line is blank.
+
+    Each step is a single scan of the line from left to right, so even long
+    lines of nothing but whitespace or #s take linear time.
+    """
+    if line[:1] in (' ', '\t'):
+        line = '<indent>' + line.lstrip(' \t')
+    elif line.startswith('#'):
+        return None
+    line = line.strip()
+    comment_start = line.find('#')
+    while comment_start > 0 and line[comment_start - 1] == '\\':
+        comment_start = line.find('#', comment_start + 1)
+    if comment_start != -1:
+        line = line[:comment_start].rstrip()
+    if '\\#' in line:
+        line = line.replace('\\#', '#')
+    return line
+
+
+def _finish_line(line: str) -> str:
+    "Replace a recorded <indent> with valid CSS."
+    if line.startswith('<indent>'):
+        return '<span class="indent">%s</span>' % line[len('<indent>'):]
+    return line
+
+
+def cleanse_lines(source: Union[str, Iterable[str]],
+                  config: Dict[str, Any]) -> Iterator[str]:
+    """
+    Munge raw text into lines that can be directly made into notes, yielding
+    each line as soon as it's finished.
+
+    /source/ may be a string or any iterable of lines, such as an open text
+    file. It is read in a single pass, holding only one line of lookahead, so
+    memory use doesn't depend on the length of the text: a line is yielded
+    once the next non-blank line is seen (at which point we know whether it
+    ends a stanza) or the source is exhausted (in which case it ends the text).
+    """
+    stanza_marker = config['endOfStanzaMarker']
+    text_marker = config['endOfTextMarker']
+
+    pending: Optional[str] = None
+    ends_stanza = False
+    for raw_line in _split_source(source):
+        line = _lex_line(raw_line)
+        if line is None:
+            continue
+        if not line:
+            # Blank lines at the start of the text are simply ignored; any
+            # number of them after a line mark the end of a stanza.
+            ends_stanza = pending is not None
+            continue
+        if pending is not None:
+            yield _finish_line(pending + stanza_marker if ends_stanza else pending)
+        pending = line
+        ends_stanza = False
+    if pending is not None:
+        yield _finish_line(pending + text_marker)
 
 
 def cleanse_text(string: str, config: Dict[str, Any]) -> List[str]:
@@ -208,59 +669,398 @@ def cleanse_text(string: str, config: Dict[str, Any]) -> List[str]:
     Munge raw text from the poem editor into a list of lines that can be
     directly made into notes.
     """
-    def _normalize_blank_lines(text_lines):
-        # remove consecutive lone newlines
-        new_text = []
-        last_line = ""
-        for i in text_lines:
-            if last_line.strip() or i.strip():
-                new_text.append(i)
-            last_line = i
-        # remove lone newlines at beginning and end
-        for i in (0, -1):
-            if not new_text[i].strip():
-                del new_text[i]
-        return new_text
-
-    text = string.splitlines()
-    # record a level of indentation if appropriate
-    text = [re.sub(r'^[ \t]+', r'<indent>', i) for i in text]
-    # remove comments and normalize blank lines
-    text = [i.strip() for i in text if not i.startswith("#")]
-    text = [re.sub(r'\s*\#.*$', '', i) for i in text]
-    text = _normalize_blank_lines(text)
-    # add end-of-stanza/poem markers where appropriate
-    for i in range(len(text)):
-        if i == len(text) - 1:
-            text[i] += config['endOfTextMarker']
-        elif not text[i+1].strip():
-            text[i] += config['endOfStanzaMarker']
-    # entirely remove all blank lines
-    text = [i for i in text if i.strip()]
-    # replace <indent>s with valid CSS
-    text = [re.sub(r'^<indent>(.*)$', r'<span class="indent">\1</span>', i)
-            for i in text]
-    return text
+    return list(cleanse_lines(string, config))
+
+
+#: Matches the line breaks between stanzas (and any further empty lines).
+_STANZA_BREAK_RE = re.compile(r'(\n(?:\r?\n)+)')
+
+
+class _LexedBlock(NamedTuple):
+    "A block of lines cached by IncrementalCleanser."
+    body: List[str]
+    end_of_stanza: Optional[str]
+    end_of_text: Optional[str]
+    #: Number of lines in the block before each of its newline-separated raw lines.
+    counts: List[int]
+
+
+class IncrementalCleanser:
+    """
+    Cleanses the text in the poem editor again and again while it's edited,
+    producing the same lines as cleanse_text() but only redoing the work for
+    stanzas that have changed since the last call to update().
+
+    The text is split into blocks at empty lines. The lines within a block
+    can be lexed without looking at the rest of the text; only the marker
+    at the end of its last line depends on what comes after it, so both
+    possibilities are kept. Lexed blocks are cached by their raw text, so an edit
+    in one stanza leaves the cached lines of all the others in place.
+    """
+    def __init__(self, config: Dict[str, Any]) -> None:
+        self.stanza_marker = config['endOfStanzaMarker']
+        self.text_marker = config['endOfTextMarker']
+        self.lines: List[str] = []
+        self._cache: Dict[str, _LexedBlock] = {}
+        # For each block with lines in it: its first line number in the raw
+        # text, the index of its first line in self.lines, and the number of
+        # its lines that come before each of its raw lines.
+        self._block_starts: List[int] = []
+        self._blocks: List[Tuple[int, List[int]]] = []
+
+    def _lex_block(self, block: str) -> _LexedBlock:
+        """
+        Lex the raw text of a block. Its last line is finished both with the
+        end-of-stanza marker and with the end-of-text marker, since which one
+        it needs depends on whether any lines come after the block.
+        """
+        lines: List[str] = []
+        counts = [0]
+        pending: Optional[str] = None
+        ends_stanza = False
+        for raw_line in block.split('\n'):
+            # A line may contain other line breaks that splitlines() honors.
+            for line in raw_line.splitlines() or ['']:
+                lexed = _lex_line(line)
+                if lexed is None:
+                    continue
+                if not lexed:
+                    ends_stanza = pending is not None
+                    continue
+                if pending is not None:
+                    lines.append(_finish_line(
+                        pending + self.stanza_marker if ends_stanza else pending))
+                pending = lexed
+                ends_stanza = False
+            counts.append(len(lines) + (pending is not None))
+        if pending is None:
+            return _LexedBlock(lines, None, None, counts)
+        return _LexedBlock(lines, _finish_line(pending + self.stanza_marker),
+                           _finish_line(pending + self.text_marker), counts)
+
+    def update(self, string: str) -> List[str]:
+        "Cleanse /string/, the entire current text, and return its lines."
+        parts = _STANZA_BREAK_RE.split(string)
+        cache = {}
+        lines: List[str] = []
+        block_starts, blocks = [], []
+        last_block: Optional[_LexedBlock] = None
+        raw_line = 0
+        for n in range(0, len(parts), 2):
+            block = parts[n]
+            lexed = cache.get(block) or self._cache.get(block) or self._lex_block(block)
+            cache[block] = lexed
+            if lexed.end_of_stanza is not None:
+                if last_block is not None:
+                    lines.append(last_block.end_of_stanza)
+                block_starts.append(raw_line)
+                blocks.append((len(lines), lexed.counts))
+                lines.extend(lexed.body)
+                last_block = lexed
+            if n + 1 < len(parts):
+                raw_line += len(lexed.counts) - 2 + parts[n + 1].count('\n')
+        if last_block is not None:
+            lines.append(last_block.end_of_text)
+
+        self._cache = cache
+        self._block_starts, self._blocks = block_starts, blocks
+        self.lines = lines
+        return lines
+
+    def line_index(self, raw_line: int) -> int:
+        """
+        Return the index in the cleansed lines of the line at /raw_line/
+        (0-based) of the text last passed to update(), or of the next line
+        with text if that one is blank or a comment. Returns -1 if there are
+        no lines at all.
+        """
+        if not self.lines:
+            return -1
+        block = bisect_right(self._block_starts, raw_line) - 1
+        if block < 0:
+            return 0
+        first_line, counts = self._blocks[block]
+        offset = min(raw_line - self._block_starts[block], len(counts) - 1)
+        return min(first_line + counts[offset], len(self.lines) - 1)
 
 
 def add_notes(col: Any, note_constructor: Callable,
-              title: str, author:str, tags: List[str], text: List[str],
+              title: str, author:str, tags: List[str], text: Iterable[str],
               deck_id: int, context_lines: int, group_lines: int, 
-              recite_lines: int):
+              recite_lines: int,
+              on_batch: Optional[Callable[[int, Optional[int]], None]] = None,
+              want_cancel: Optional[Callable[[], bool]] = None,
+              timer: StageTimer = NULL_TIMER,
+              on_added: Optional[Callable[[List['Note']], None]] = None,
+              start_seq: int = 0, poem_key: Optional[str] = None) -> AddResult:
     """
     Generate notes from the given title, author, tags, poem text, and number of
-    lines of context. Return the number of notes added.
+    lines of context. Return an AddResult with the ids of the notes added and
+    the undo entry they were merged into.
+
+    The notes are planned with plan_notes(), or, if /text/ is a lazy iterable
+    of cleansed lines (e.g., from cleanse_lines()), streamed through
+    stream_notes(). This function only creates Anki notes from the resulting
+    NoteSpecs and adds them to the collection a batch at a time, sized by a
+    BatchSizer, so only the notes of the current batch (and, when streaming,
+    the lines they need) are in memory at once, however long the text.
+    The note type is looked up once, and all the batches are merged into a
+    single undo step, so the whole poem can be undone at once from the Edit
+    menu.
 
-    Return the number of notes added.
+    If given, on_batch(added, total) is called after each batch is added,
+    and want_cancel() is checked before each batch; if it returns True, the
+    undo step is discarded (see discard_undo_entry()) and ImportCancelled is
+    raised. Both may be called from a background thread. /total/ is the number of notes that
+    will be added, or None if /text/ is an iterator, whose length isn't known
+    until it's been read. Time spent building and inserting the notes is
+    recorded in /timer/. If given, on_added(notes) is called with each batch
+    of notes once it's been added.
+
+    Notes for the lines up to and including sequence number /start_seq/ are
+    assumed to be in the collection already, and aren't added again; this
+    is used to resume an interrupted import (see poem_store.Checkpoint).
+
+    If /poem_key/ is given, the notes are for compact storage (see
+    compact.py), and the caller must have written the poem's media file.
 
     Raises KeyError if the note type is missing fields, which I've seen
     happen a couple times when users accidentally edited the note type. The
     caller should offer an appropriate error message in this case.
     """
-    added = 0
-    for line in _poemlines_from_textlines(text, group_lines):
-        n = note_constructor(col, col.models.by_name("LPCG 1.0"))
-        line.populate_note(n, title, author, tags, context_lines, recite_lines, deck_id)
-        col.addNote(n)
-        added += 1
-    return added
+    if isinstance(text, Sized):
+        # Already in memory, so skip the bookkeeping of a sliding window.
+        plan = plan_notes(title, author, tags, text, deck_id, context_lines,  # type: ignore
+                          group_lines, recite_lines, poem_key)
+        total: Optional[int] = max(len(plan) - start_seq, 0)
+        specs = (plan.spec(seq) for seq in range(start_seq + 1, len(plan) + 1))
+    else:
+        total = None
+        specs = islice(stream_notes(title, author, tags, text, deck_id, context_lines,
+                                    group_lines, recite_lines, poem_key),
+                       start_seq, None)
+    model = col.models.by_name("LPCG 1.0")
+
+    def build() -> Iterator['Note']:
+        for spec in specs:
+            n = note_constructor(col, model)
+            spec.apply(n)
+            yield n
+
+    return _insert_stream(col, build(), deck_id, total, on_batch, want_cancel,
+                          None, timer, on_added)
+
+
+def insert_notes(col: Any, notes: List['Note'], deck_id: int,
+                 on_batch: Optional[Callable[[int, Optional[int]], None]] = None,
+                 want_cancel: Optional[Callable[[], bool]] = None,
+                 undo_entry: Optional[int] = None) -> AddResult:
+    """
+    Add the fully populated /notes/ to /deck_id/ in batches sized by a
+    BatchSizer, all merged into one undo step, and return an AddResult as for
+    add_notes(). If /undo_entry/ is given, the notes are merged into that
+    existing custom undo entry instead of starting a new one.
+
+    on_batch and want_cancel work as described for add_notes().
+    """
+    return _insert_stream(col, iter(notes), deck_id, len(notes), on_batch,
+                          want_cancel, undo_entry)
+
+
+class BatchSizer:
+    """
+    Decides how many notes to send to the collection at once. Every batch
+    costs a backend call and an undo merge however few notes are in it, but
+    while a batch is being added, the progress bar doesn't move and Cancel
+    can't take effect. So starting from ADD_BATCH_SIZE, the size is adjusted
+    after each batch to the number of notes that would have taken
+    TARGET_BATCH_SECONDS to add at the rate just measured, changing by no
+    more than a factor of two at a time and staying within MIN_BATCH_SIZE
+    and MAX_BATCH_SIZE.
+    """
+    def __init__(self) -> None:
+        self.size = ADD_BATCH_SIZE
+
+    def record(self, count: int, seconds: float) -> None:
+        "Adjust the size after a batch of /count/ notes took /seconds/ to add."
+        ideal = count * TARGET_BATCH_SECONDS / seconds if seconds > 0 else self.size * 2
+        ideal = min(max(ideal, self.size / 2), self.size * 2)
+        self.size = int(min(max(ideal, MIN_BATCH_SIZE), MAX_BATCH_SIZE))
+
+
+def _add_batch(col: Any, notes: List['Note'], deck_id: int) -> None:
+    """
+    Add /notes/ to /deck_id/ with a single call to the collection's batch add
+    API, or, in Anki versions before 23.10, which don't have it, one at a
+    time. Either way, the caller merges them into its undo step.
+    """
+    if hasattr(col, 'add_notes'):
+        col.add_notes([AddNoteRequest(note=n, deck_id=deck_id) for n in notes])
+    else:
+        for n in notes:
+            col.add_note(n, deck_id)
+
+
+def discard_undo_entry(col: Any, undo_entry: int) -> None:
+    """
+    Revert everything merged into the custom undo entry /undo_entry/, which
+    must be the last undo step, without leaving it behind to be redone.
+    """
+    col.merge_undo_entries(undo_entry)
+    col.undo()
+    # Any undoable operation empties the redo queue, and one that changes
+    # nothing doesn't become an undo step of its own.
+    col.remove_notes([])
+
+
+def _insert_stream(col: Any, notes: Iterator['Note'], deck_id: int,
+                   total: Optional[int],
+                   on_batch: Optional[Callable[[int, Optional[int]], None]],
+                   want_cancel: Optional[Callable[[], bool]],
+                   undo_entry: Optional[int], timer: StageTimer = NULL_TIMER,
+                   on_added: Optional[Callable[[List['Note']], None]] = None) -> AddResult:
+    "Add /notes/ as they're generated; see add_notes() and insert_notes()."
+    sizer = BatchSizer()
+    added_ids: List[int] = []
+    while True:
+        with timer.span("build notes"):
+            batch = list(islice(notes, sizer.size))
+        if not batch:
+            return AddResult(added_ids, undo_entry)
+        if want_cancel is not None and want_cancel():
+            if undo_entry is not None:
+                discard_undo_entry(col, undo_entry)
+            raise ImportCancelled()
+
+        with timer.span("insert notes"):
+            if undo_entry is None:
+                undo_entry = col.add_custom_undo_entry("Import Lyrics/Poetry")
+            start = time.perf_counter()
+            _add_batch(col, batch, deck_id)
+            col.merge_undo_entries(undo_entry)
+            sizer.record(len(batch), time.perf_counter() - start)
+        added_ids.extend(n.id for n in batch)
+        if on_batch is not None:
+            on_batch(len(added_ids), total)
+        if on_added is not None:
+            on_added(batch)
+
+
+def match_units(old_units: Sequence[Sequence[str]],
+                new_units: Sequence[Sequence[str]]) -> List[Optional[int]]:
+    """
+    Given the units (PoemLine texts) of an old and a revised version of a poem,
+    decide which old unit's note each new unit should reuse. Return a list
+    with, for each new unit, the index of an old unit, or None if the new
+    unit needs a note of its own.
+
+    Units that didn't change keep their notes. Within a run of changed units,
+    old notes are reused in order, so correcting a typo updates the existing
+    note (keeping its review history) rather than replacing it; notes are
+    only added or left over where units were inserted or deleted.
+    """
+    matcher = difflib.SequenceMatcher(None, [tuple(i) for i in old_units],
+                                      [tuple(i) for i in new_units], autojunk=False)
+    matches: List[Optional[int]] = [None] * len(new_units)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag in ('equal', 'replace'):
+            for offset in range(min(i2 - i1, j2 - j1)):
+                matches[j1 + offset] = i1 + offset
+    return matches
+
+
+def reimport_notes(col: Any, note_constructor: Callable,
+                   title: str, author: str, tags: List[str], text: List[str],
+                   old_text: List[str], deck_id: int, context_lines: int,
+                   group_lines: int, recite_lines: int,
+                   old_group_lines: int,
+                   note_ids: Optional[List[int]] = None,
+                   poem_key: Optional[str] = None) -> ReimportResult:
+    """
+    Bring the existing notes of the poem /title/, generated from the cleansed
+    lines /old_text/ grouped by /old_group_lines/, up to date with the revised
+    lines /text/ and the given settings, changing as few notes as possible.
+
+    Notes whose fields would come out the same are left alone; notes for
+    changed lines are updated in place, ADD_BATCH_SIZE at a time; notes are
+    added (to /deck_id/, with /tags/) or removed only where lines were
+    inserted or deleted. Tags and decks of existing notes aren't changed.
+    All changes are one undo step.
+
+    The existing notes are found with a search by title, unless their ids
+    are given in /note_ids/. /poem_key/ is as for add_notes().
+
+    Raises KeyError if the note type is missing fields, like add_notes().
+    """
+    if note_ids is None:
+        note_ids = find_poem_notes(col, title)
+    existing: Dict[int, 'Note'] = {}
+    for nid in note_ids:
+        note = col.get_note(nid)
+        try:
+            existing[int(note['Sequence'])] = note
+        except ValueError:
+            pass  # not a note LPCG generated; leave it alone
+
+    old_poem = Poem(old_text, old_group_lines)
+    new_poem = Poem(text, group_lines)
+    matches = match_units([old_poem.unit(i) for i in range(1, len(old_poem) + 1)],
+                          [new_poem.unit(i) for i in range(1, len(new_poem) + 1)])
+
+    model = col.models.by_name("LPCG 1.0")
+    to_add, to_update, reused, notes = [], [], set(), []
+    for line, old_index in zip(new_poem, matches):
+        if old_index is None or old_index + 1 not in existing:
+            n = note_constructor(col, model)
+            line.populate_note(n, title, author, tags, context_lines, recite_lines,
+                               poem_key)
+            to_add.append(n)
+            notes.append(n)
+            continue
+        note = existing[old_index + 1]
+        notes.append(note)
+        reused.add(old_index + 1)
+        fields = {'Title': title, 'Author': author, 'Prompt': ''}
+        fields.update(line.fields(context_lines, recite_lines, poem_key))
+        if any(note[field] != value for field, value in fields.items()):
+            for field, value in fields.items():
+                note[field] = value
+            to_update.append(note)
+    to_remove = [note.id for seq, note in existing.items() if seq not in reused]
+
+    undo_entry = None
+    if to_add or to_update or to_remove:
+        undo_entry = col.add_custom_undo_entry("Update Lyrics/Poetry")
+        for start in range(0, len(to_update), ADD_BATCH_SIZE):
+            col.update_notes(to_update[start:start + ADD_BATCH_SIZE])
+            col.merge_undo_entries(undo_entry)
+        if to_remove:
+            col.remove_notes(to_remove)
+            col.merge_undo_entries(undo_entry)
+        insert_notes(col, to_add, deck_id, undo_entry=undo_entry)
+    return ReimportResult(len(to_add), len(to_update), len(to_remove),
+                          len(new_poem) - len(to_add) - len(to_update), notes,
+                          undo_entry)
+
+
+def _title_search(title: str) -> str:
+    "Return an Anki search for the LPCG notes of the poem called /title/."
+    # Backslash first, so the escapes added for the others aren't doubled.
+    escaped_title = title
+    for special in '\\"*_':
+        escaped_title = escaped_title.replace(special, '\\' + special)
+    return f'"note:LPCG 1.0" "Title:{escaped_title}"'
+
+
+def find_poem_notes(col: Any, title: str) -> List[int]:
+    """
+    Return the ids of the LPCG notes for the poem called /title/. This
+    searches the fields of every LPCG note; when the poem registry is up to
+    date, poem_store.find_poem() is much faster.
+    """
+    return col.find_notes(_title_search(title))
+
+
+def poem_exists(col: Any, title: str) -> bool:
+    "Return True if the collection already has LPCG notes for a poem called /title/."
+    return bool(find_poem_notes(col, title))
@@ -3,11 +3,19 @@ Dialog box for importing texts.
 """
 
 import codecs
+from itertools import islice
+import os
+from threading import Event
+import time
+from typing import Iterable, Iterator, List, Optional, Tuple
 
 # pylint: disable=no-name-in-module
 from aqt.deckchooser import DeckChooser
-from aqt.qt import QDesktopServices, QDialog, QUrl, qtmajor
-from aqt.utils import getFile, showWarning, askUser, tooltip
+from aqt.operations import CollectionOp, QueryOp
+from aqt.qt import (QDesktopServices, QDialog, QFileDialog, QMenu, QPoint, QTimer, QUrl,
+                    qtmajor)
+from aqt.utils import getFile, showText, showWarning, askUser, tooltip
+from anki.collection import OpChangesWithCount
 from anki.notes import Note
 
 if qtmajor > 5:
@@ -16,10 +24,49 @@ else:
     from . import import_dialog5 as lpcg_form  # type: ignore
 
 # pylint: disable=wrong-import-position
-from .gen_notes import add_notes, cleanse_text
+from .batch_import import filename_regex, find_text_files, format_summary, identify, import_files
+from .compact import new_poem_key, poem_key_of, trash_poem_file, write_poem_file
+from .gen_notes import (add_notes, cleanse_lines, cleanse_text, find_poem_notes,
+                        read_text_file, reimport_notes, ImportCancelled,
+                        IncrementalCleanser, Poem)
+from .poem_ops import poem_text
+from .poem_store import (Checkpoint, PoemRecord, RegistryEntry, clear_checkpoint,
+                         committed_sequence, digest_fingerprint, find_poem,
+                         load_checkpoint, load_record, register_notes,
+                         register_poem, save_checkpoint, save_record,
+                         text_digest, TextDigest)
+from .rerender import poem_units
+from .timing import StageTimer, log_timings, profile_path, profiled, user_files_path
 from . import models
 
 
+#: Number of lines of a directly imported file shown in the poem editor.
+PREVIEW_LINES = 30
+#: Number of cards from the start of the poem shown in the preview pane.
+PREVIEW_CARDS = 3
+#: Milliseconds to wait after the last keystroke before updating the preview.
+PREVIEW_DELAY_MS = 250
+
+
+def _import_changes(col, undo_entry: Optional[int], count: int) -> OpChangesWithCount:
+    """
+    Return the result of an import operation that changed /count/ notes.
+    Every import is merged into a single custom undo step, /undo_entry/, as
+    it goes along, and merging into that step once more gives back the
+    OpChanges of the whole import, so Anki can refresh only the screens it
+    affected (the deck list's counts, an open browser, and so on) instead of
+    redrawing the entire main window.
+
+    This must be the entry the import returned, not the last undo step:
+    saving the poem's record and registry entry afterwards moves the last
+    step on without creating an entry that can be merged into.
+    """
+    result = OpChangesWithCount(count=count)
+    if count and undo_entry is not None:
+        result.changes.CopyFrom(col.merge_undo_entries(undo_entry))
+    return result
+
+
 class LPCGDialog(QDialog):
     """
     Import Lyrics/Poetry dialog, the core of the add-on. The user can either
@@ -40,6 +87,7 @@ class LPCGDialog(QDialog):
         self.form.addCardsButton.clicked.connect(self.accept)
         self.form.cancelButton.clicked.connect(self.reject)
         self.form.openFileButton.clicked.connect(self.onOpenFile)
+        self.form.importManyButton.clicked.connect(self.onImportMany)
         self.form.helpButton.clicked.connect(self.onHelp)
 
         self.addonConfig = self.mw.addonManager.getConfig(__name__)
@@ -47,57 +95,431 @@ class LPCGDialog(QDialog):
         self.form.reciteLinesSpin.setValue(self.addonConfig['defaultLinesToRecite'])
         self.form.groupLinesSpin.setValue(self.addonConfig['defaultLinesInGroupsOf'])
 
+        self.form.progressBar.hide()
+        self._importing = False
+        self._source_path: Optional[str] = None
+        self._source_line_count = 0
+        # The text_digest() of the attached file, and the (mtime, size) it had.
+        self._source_digest: Optional[str] = None
+        self._source_stamp: Optional[Tuple[int, int]] = None
+        self._cancel_requested = Event()
+
+        self._cleanser = IncrementalCleanser(self.addonConfig)
+        self._preview_timer = QTimer(self)
+        self._preview_timer.setSingleShot(True)
+        self._preview_timer.setInterval(PREVIEW_DELAY_MS)
+        self._preview_timer.timeout.connect(self._update_preview)
+        for signal in (self.form.textBox.textChanged,
+                       self.form.textBox.cursorPositionChanged,
+                       self.form.titleBox.textChanged,
+                       self.form.contextLinesSpin.valueChanged,
+                       self.form.reciteLinesSpin.valueChanged,
+                       self.form.groupLinesSpin.valueChanged):
+            signal.connect(self._schedule_preview)
+        self._update_preview()
+
     def accept(self):
-        "On close, create notes from the contents of the poem editor."
+        """
+        On close, create notes from the contents of the poem editor. The notes
+        are generated and added in the background, with a progress bar, so
+        Anki stays responsive while long texts are imported. If an earlier
+        import of the poem was interrupted, offer to resume it.
+        """
+        if self._importing:
+            return
+
         title = self.form.titleBox.text().strip()
+        timer = StageTimer(enabled=self.addonConfig['logImportTimings']
+                           or self.addonConfig['showImportTimings'])
 
         if not title:
             showWarning("You must enter a title for this poem.")
             return
-        escaped_title = title.replace('"', '\\"')
-        if self.mw.col.find_notes(f'"note:{models.LpcgOne.name}" '  # pylint: disable=no-member
-                                  f'"Title:{escaped_title}"'):
+        # Looking the poem up also brings the registry up to date, which the
+        # import relies on when it registers the notes, so it's done even
+        # when resuming.
+        with timer.span("duplicate check"):
+            entry = find_poem(self.mw.col, title)
+        checkpoint = load_checkpoint(self.mw.col, title)
+        if checkpoint is not None:
+            # An interrupted import leaves a partial poem, which isn't a duplicate.
+            entry = None
+        record = load_record(self.mw.col, title) if entry else None
+        if entry and record is None:
             showWarning("You already have a poem by that title in your "
                         "database. Please check to see if you've already "
                         "added it, or use a different name.")
             return
-        if not self.form.textBox.toPlainText().strip():
+        if self._source_path is None and not self.form.textBox.toPlainText().strip():
+            if record is not None:
+                self._load_record(record)
+                return
             showWarning("There's nothing to generate cards from! "
                         "Please type a poem in the box, or use the "
                         '"Open File" button to import a text file.')
             return
+        fingerprint = self._fingerprint()
+        if record is not None:
+            if (fingerprint == record.fingerprint
+                    and self.form.authorBox.text().strip() == record.author):
+                tooltip(f'"{title}" is already up to date with this text.', parent=self)
+                return
+            if askUser(f'You already have a poem called "{title}". Update its '
+                       "notes to match the text in the editor? Notes for lines "
+                       "you haven't changed will be left alone, and edited "
+                       "lines will keep their review history."):
+                self._update_poem(record, entry, fingerprint)
+            return
 
         author = self.form.authorBox.text().strip()
         tags = self.mw.col.tags.split(self.form.tagsBox.text())
-        text = cleanse_text(self.form.textBox.toPlainText().strip(), self.addonConfig)
+        source_path = self._source_path
+        raw_text = "" if source_path else self.form.textBox.toPlainText().strip()
         context_lines = self.form.contextLinesSpin.value()
         recite_lines = self.form.reciteLinesSpin.value()
         group_lines = self.form.groupLinesSpin.value()
         did = self.deckChooser.selectedId()
+        prof_path = profile_path(title) if self.addonConfig['profileImports'] else None
+        compact = self.addonConfig['compactStorage']
 
-        try:
-            notes_generated = add_notes(self.mw.col, Note, title, author, tags, text, did,
-                                        context_lines, group_lines, recite_lines)
-        except KeyError as e:
+        start_seq = 0
+        if checkpoint is not None:
+            start_seq = self._resume_point(checkpoint, fingerprint)
+            if start_seq is None:
+                return
+        # A resumed import's notes must all use the same media file.
+        key = None
+        if compact:
+            key = (checkpoint.poem_key if start_seq and checkpoint.poem_key
+                   else new_poem_key())
+
+        def op(col) -> OpChangesWithCount:
+            with profiled(prof_path):
+                with timer.span("parse"):
+                    text: Iterable[str]
+                    if source_path and not compact:
+                        # Streamed: lines are read and cleansed as notes are built,
+                        # so that time is counted under "build notes".
+                        text = cleanse_lines(read_text_file(source_path), self.addonConfig)
+                    else:
+                        if source_path:
+                            # The whole poem goes in its media file, so it's needed
+                            # anyway.
+                            lines = list(cleanse_lines(read_text_file(source_path),
+                                                       self.addonConfig))
+                        else:
+                            lines = cleanse_text(raw_text, self.addonConfig)
+                        if key is not None:
+                            write_poem_file(col, key, lines, group_lines, context_lines)
+                        text = lines
+
+                def on_batch(added: int, total: Optional[int]) -> None:
+                    if total is not None:
+                        total += start_seq
+                    save_checkpoint(col, Checkpoint(title, start_seq + added, total,
+                                                    fingerprint, key))
+                    self._on_batch_added(start_seq + added, total)
+
+                # If this is cancelled, undoing the import also puts the
+                # checkpoint back as it was.
+                try:
+                    added = add_notes(col, Note, title, author, tags, text, did,
+                                      context_lines, group_lines, recite_lines,
+                                      on_batch=on_batch,
+                                      want_cancel=self._cancel_requested.is_set,
+                                      timer=timer, start_seq=start_seq, poem_key=key)
+                except ImportCancelled:
+                    if not start_seq:
+                        # No notes are left that use the media file.
+                        trash_poem_file(col, key)
+                    raise
+                count = len(added.note_ids)
+                if start_seq:
+                    # The poem also consists of the notes added before.
+                    register_poem(col, title, author, context_lines, recite_lines,
+                                  group_lines)
+                else:
+                    register_notes(col, title, author, added.note_ids, context_lines,
+                                   recite_lines, group_lines)
+                if count or start_seq:
+                    save_record(col, PoemRecord.create(
+                        title, author, fingerprint, context_lines, recite_lines,
+                        group_lines, self.addonConfig, key))
+                clear_checkpoint(col, title)
+            return _import_changes(col, added.undo_entry, count)
+
+        started = time.monotonic()
+
+        def on_success(result: OpChangesWithCount) -> None:
+            self._set_importing(False)
+            if result.count or start_seq:
+                elapsed = max(time.monotonic() - started, 0.001)
+                super(LPCGDialog, self).accept()
+                self.deckChooser.cleanup()
+                message = "%i notes added (%i notes/second)." % (
+                    result.count, result.count / elapsed)
+                tooltip(message + self._report_timings(title, timer, prof_path))
+
+        self._start_import(op, on_success, "%v of %m notes added", resumed=bool(start_seq))
+
+    def _resume_point(self, checkpoint: Checkpoint, fingerprint: str) -> Optional[int]:
+        """
+        Ask whether to resume the interrupted import in /checkpoint/, given
+        the /fingerprint/ of the text and settings now in the dialog. Return
+        the sequence number to add notes after, or None to do nothing.
+        """
+        col = self.mw.col
+        done = committed_sequence(col, checkpoint)
+        of_total = f" of {checkpoint.total}" if checkpoint.total is not None else ""
+        progress = (f'An import of "{checkpoint.title}" was interrupted after '
+                    f"{done}{of_total} notes were added")
+        if checkpoint.fingerprint == fingerprint:
+            if askUser(f"{progress}. Add the remaining notes now?"):
+                return done
+            return None
+        if askUser(f"{progress}, using a different text or settings than those "
+                   "in the dialog. Delete the notes it added, and import this "
+                   "text from the beginning?"):
+            undo_entry = col.add_custom_undo_entry("Delete Interrupted Import")
+            col.remove_notes(find_poem_notes(col, checkpoint.title))
+            clear_checkpoint(col, checkpoint.title)
+            col.merge_undo_entries(undo_entry)
+            trash_poem_file(col, checkpoint.poem_key)
+            return 0
+        return None
+
+    def _load_record(self, record: PoemRecord) -> None:
+        """
+        Fill in the dialog with the text and stored settings of a poem that
+        has already been imported, ready to be edited and re-imported. The
+        text is rebuilt from the poem's notes, so any comments it had are gone.
+        """
+        self._source_path = None
+        self.form.textBox.setReadOnly(False)
+        self.form.textBox.setPlainText(poem_text(self.mw.col, record.title, self.addonConfig))
+        self.form.authorBox.setText(record.author)
+        self.form.contextLinesSpin.setValue(record.context_lines)
+        self.form.reciteLinesSpin.setValue(record.recite_lines)
+        self.form.groupLinesSpin.setValue(record.group_lines)
+        tooltip("Loaded the text of this poem. Edit it and choose Add Notes "
+                "again to update its notes.", parent=self)
+
+    def _fingerprint(self) -> str:
+        """
+        Return the import_fingerprint() of the text and settings in the dialog.
+        The digest of an attached file is worked out while _attach_file() reads
+        it, and only read again if the file has changed since.
+        """
+        if self._source_path is None:
+            digest = text_digest([self.form.textBox.toPlainText()])
+        else:
+            stat = os.stat(self._source_path)
+            digest = self._source_digest
+            if digest is None or (stat.st_mtime_ns, stat.st_size) != self._source_stamp:
+                digest = self._source_digest = text_digest(read_text_file(self._source_path))
+                self._source_stamp = (stat.st_mtime_ns, stat.st_size)
+        return digest_fingerprint(
+            digest, self.form.contextLinesSpin.value(), self.form.reciteLinesSpin.value(),
+            self.form.groupLinesSpin.value(), self.addonConfig)
+
+    def _update_poem(self, record: PoemRecord, entry: RegistryEntry,
+                     fingerprint: str) -> None:
+        """
+        Update the notes of the already-imported poem described by /record/
+        to match the current contents of the dialog, changing as few notes
+        as possible. /fingerprint/ is the dialog's _fingerprint().
+        """
+        title = record.title
+        author = self.form.authorBox.text().strip()
+        tags = self.mw.col.tags.split(self.form.tagsBox.text())
+        source_path = self._source_path
+        context_lines = self.form.contextLinesSpin.value()
+        recite_lines = self.form.reciteLinesSpin.value()
+        group_lines = self.form.groupLinesSpin.value()
+        raw_text = "" if source_path else self.form.textBox.toPlainText().strip()
+        did = self.deckChooser.selectedId()
+        results = []
+
+        def op(col) -> OpChangesWithCount:
+            if source_path:
+                text = list(cleanse_lines(read_text_file(source_path), self.addonConfig))
+            else:
+                text = cleanse_text(raw_text, self.addonConfig)
+            old_key = (record.poem_key
+                       or poem_key_of(col.get_note(entry.first_note_id)['Context']))
+            key = None
+            if self.addonConfig['compactStorage']:
+                key = write_poem_file(col, old_key or new_poem_key(), text, group_lines,
+                                      context_lines)
+            note_ids = find_poem_notes(col, title)
+            old_text = [line for unit in poem_units(col, entry, note_ids) for line in unit]
+            result = reimport_notes(
+                col, Note, title, author, tags, text, old_text, did,
+                context_lines, group_lines, recite_lines, record.group_lines,
+                note_ids=note_ids, poem_key=key)
+            register_notes(col, title, author, [n.id for n in result.notes],
+                           context_lines, recite_lines, group_lines)
+            save_record(col, PoemRecord.create(
+                title, author, fingerprint, context_lines, recite_lines, group_lines,
+                self.addonConfig, key))
+            if key is None:
+                # The poem has left compact storage.
+                trash_poem_file(col, old_key)
+            results.append(result)
+            return _import_changes(col, result.undo_entry,
+                                   result.added + result.updated + result.removed)
+
+        def on_success(_: OpChangesWithCount) -> None:
+            self._set_importing(False)
+            super(LPCGDialog, self).accept()
+            self.deckChooser.cleanup()
+            tooltip("Poem updated: %i notes added, %i updated, %i removed."
+                    % results[0][:3])
+
+        self._start_import(op, on_success, "Updating notes...")
+
+    def _schedule_preview(self, *_) -> None:
+        """
+        Update the preview once the user stops typing for PREVIEW_DELAY_MS.
+        (Connecting the signals straight to QTimer.start() would pass the
+        spin boxes' new values to it as the interval.)
+        """
+        self._preview_timer.start()
+
+    def _update_preview(self) -> None:
+        """
+        Show how many notes will be created and render the first few cards and
+        the one at the cursor. This runs once typing pauses, and only the
+        stanzas changed since the last time are parsed again.
+        """
+        group_lines = self.form.groupLinesSpin.value()
+        if self._source_path is not None:
+            self.form.previewLabel.setText("%i notes will be created." % (
+                -(-self._source_line_count // group_lines)))
+            self.form.previewBox.setHtml(
+                "<i>Files this long are imported straight from disk, "
+                "so they can't be previewed.</i>")
+            return
+
+        raw_text = self.form.textBox.toPlainText()
+        text = raw_text.strip()
+        poem = Poem(self._cleanser.update(text), group_lines)
+        self.form.previewLabel.setText(
+            "%i note%s will be created." % (len(poem), "" if len(poem) == 1 else "s"))
+        if not poem:
+            self.form.previewBox.clear()
+            return
+
+        leading_lines = raw_text[:len(raw_text) - len(raw_text.lstrip())].count('\n')
+        cursor_line = self.form.textBox.textCursor().blockNumber() - leading_lines
+        cursor_seq = self._cleanser.line_index(max(cursor_line, 0)) // group_lines + 1
+        seqs = list(range(1, min(PREVIEW_CARDS, len(poem)) + 1))
+        if cursor_seq not in seqs:
+            seqs.append(cursor_seq)
+        self.form.previewBox.setHtml("<hr>".join(
+            self._render_preview_card(poem, seq) for seq in seqs))
+
+    def _render_preview_card(self, poem: Poem, seq: int) -> str:
+        "Return HTML resembling the back of the card for unit /seq/ of /poem/."
+        fields = poem.line_at(seq).fields(self.form.contextLinesSpin.value(),
+                                          self.form.reciteLinesSpin.value())
+        return (f'<div style="text-align: center; font-size: small">'
+                f'{self.form.titleBox.text().strip()} {fields["Sequence"]}</div>'
+                f'{fields["Context"]}'
+                f'<div style="font-weight: bold; color: blue">{fields["Line"]}</div>')
+
+    def _report_timings(self, title: str, timer: StageTimer, prof_path) -> str:
+        """
+        Log the timings of the import of /title/ if the user wants them, and
+        return any extra text to show in the completion tooltip.
+        """
+        if self.addonConfig['logImportTimings']:
+            log_timings(user_files_path('import_timings.log'), title, timer)
+        if not self.addonConfig['showImportTimings']:
+            return ""
+        extra = "<br>" + timer.format()
+        if prof_path is not None:
+            extra += f"<br>Profile saved to {prof_path}."
+        return extra
+
+    def _start_import(self, op, on_success, progress_format: str,
+                      resumed: bool = False) -> None:
+        """
+        Run /op/ as a background collection operation, with a progress bar.
+        /resumed/ says whether it resumes an interrupted import, so some notes
+        stay in the collection even if it's cancelled.
+        """
+        self._set_importing(True, progress_format)
+        CollectionOp(parent=self, op=op) \
+            .success(on_success) \
+            .failure(lambda exc: self._on_import_failed(exc, resumed)) \
+            .run_in_background()
+
+    def reject(self):
+        "Cancel the import if one is running, otherwise close the dialog."
+        if self._importing:
+            self._cancel_requested.set()
+            self.form.cancelButton.setEnabled(False)
+            self.form.progressBar.setFormat("Cancelling...")
+            return
+        super(LPCGDialog, self).reject()
+
+    def _set_importing(self, importing: bool, progress_format: str = "") -> None:
+        "Lock or unlock the dialog's inputs while an import is running."
+        self._importing = importing
+        self._cancel_requested.clear()
+        for widget in (self.form.addCardsButton, self.form.openFileButton,
+                       self.form.importManyButton,
+                       self.form.textBox, self.form.titleBox, self.form.authorBox,
+                       self.form.tagsBox, self.form.contextLinesSpin,
+                       self.form.reciteLinesSpin, self.form.groupLinesSpin):
+            widget.setEnabled(not importing)
+        self.form.cancelButton.setEnabled(True)
+        self.form.progressBar.setVisible(importing)
+        self.form.progressBar.setRange(0, 0)  # busy indicator until first batch
+        self.form.progressBar.setFormat(progress_format)
+
+    def _on_batch_added(self, added: int, total: Optional[int]) -> None:
+        """
+        Called on the background thread after each batch of notes or files.
+        /total/ is None while a file is being streamed, as its length isn't
+        known until it's been read, so the bar stays a busy indicator.
+        """
+        def update():
+            if self._cancel_requested.is_set():
+                return
+            if total is None:
+                self.form.progressBar.setFormat(f"{added:,} notes added")
+            else:
+                self.form.progressBar.setRange(0, total)
+                self.form.progressBar.setValue(added)
+        self.mw.taskman.run_on_main(update)
+
+    def _on_import_failed(self, exc: Exception, resumed: bool = False) -> None:
+        self._set_importing(False)
+        if isinstance(exc, ImportCancelled) and resumed:
+            tooltip("Import cancelled. No more notes were added; the notes added "
+                    "before the import was interrupted are still there, "
+                    "so it can be resumed later.")
+        elif isinstance(exc, ImportCancelled):
+            tooltip("Import cancelled. No notes were added.")
+        elif isinstance(exc, KeyError):
             showWarning(
                 "The field {field} was not found on the {name} note type"
                 " in your collection. If you don't have any LPCG notes"
                 " yet, you can delete the note type in Tools -> Manage"
                 " Note Types and restart Anki to fix this problem."
                 " Otherwise, please add the field back to the note type. "
-                .format(field=str(e), name=models.LpcgOne.name))  # pylint: disable=no-member
-            return
-
-        if notes_generated:
-            super(LPCGDialog, self).accept()
-            self.deckChooser.cleanup()
-            self.mw.reset()
-            tooltip("%i notes added." % notes_generated)
+                .format(field=str(exc), name=models.LpcgOne.name))  # pylint: disable=no-member
+        else:
+            showWarning(f"The import failed: {exc}", parent=self)
 
     def onOpenFile(self):
         """
         Read a text file (in UTF-8 encoding) and replace the contents of the
-        poem editor with the contents of the file.
+        poem editor with the contents of the file. Files of at least
+        directImportMinBytes are instead imported straight from disk when
+        notes are added, with only a preview shown in the editor.
         """
         if (self.form.textBox.toPlainText().strip()
                 and not askUser("Importing a file will replace the current "
@@ -106,10 +528,138 @@ class LPCGDialog(QDialog):
         filename = getFile(self, "Import file", None, key="import")
         if not filename: # canceled
             return
+        if os.path.getsize(filename) >= self.addonConfig['directImportMinBytes']:
+            self._attach_file(filename)
+            return
         with codecs.open(filename, 'r', 'utf-8') as f:
             text = f.read()
+        self._source_path = None
+        self.form.textBox.setReadOnly(False)
         self.form.textBox.setPlainText(text)
 
+    def _attach_file(self, path: str) -> None:
+        """
+        Arrange for the poem to be read directly from /path/ rather than from
+        the poem editor, since loading a very long text into the editor and
+        copying it back out again takes a long time and a lot of memory. The
+        editor shows the start of the file and some statistics instead. The
+        file is read in the background, since counting its lines takes a while.
+        """
+        def scan(_col) -> Tuple[int, str, Tuple[int, int], List[str]]:
+            stat = os.stat(path)
+            digest = TextDigest()
+            preview: List[str] = []
+
+            def chunks() -> Iterator[str]:
+                # One pass counts the lines, hashes the text, and keeps the preview.
+                for chunk in digest.feed(read_text_file(path)):
+                    if len(preview) < PREVIEW_LINES:
+                        preview.extend(islice(chunk.splitlines(),
+                                              PREVIEW_LINES - len(preview)))
+                    yield chunk
+
+            line_count = sum(1 for _ in cleanse_lines(chunks(), self.addonConfig))
+            return (line_count, digest.hexdigest(), (stat.st_mtime_ns, stat.st_size),
+                    preview)
+
+        def on_success(result: Tuple[int, str, Tuple[int, int], List[str]]) -> None:
+            line_count, digest, stamp, preview = result
+            if not line_count:
+                showWarning("There's nothing to generate cards from in that file!",
+                            parent=self)
+                return
+            self._source_path = path
+            self._source_line_count = line_count
+            self._source_digest = digest
+            self._source_stamp = stamp
+            self.form.textBox.setPlainText('\n'.join([
+                "# This file is too long to edit here, so it will be imported directly from:",
+                f"#     {path}",
+                f"# {stamp[1] / 1024:,.0f} KB, {line_count:,} lines of text. "
+                f"The first {len(preview)} lines are shown below.",
+                "",
+                *preview,
+            ]))
+            self.form.textBox.setReadOnly(True)
+
+        def on_failure(exc: Exception) -> None:
+            if isinstance(exc, UnicodeDecodeError):
+                showWarning("That file isn't a UTF-8 text file, so LPCG can't import it.",
+                            parent=self)
+            else:
+                showWarning(f"LPCG couldn't read that file: {exc}", parent=self)
+
+        QueryOp(parent=self, op=scan, success=on_success) \
+            .failure(on_failure) \
+            .with_progress("Reading file...") \
+            .run_in_background()
+
+    def onImportMany(self):
+        """
+        Import several text files, or every .txt file in a folder, each as a
+        separate poem, using the deck, tags, and settings chosen in the dialog.
+        Titles and authors come from the file names (as described by the
+        batchFilenamePattern option) or Title/Author header comments; the
+        Author box supplies a default author.
+        """
+        button = self.form.importManyButton
+        menu = QMenu(self)
+        files_action = menu.addAction("Choose &Files...")
+        folder_action = menu.addAction("Choose a F&older...")
+        chosen = menu.exec(button.mapToGlobal(QPoint(0, button.height())))
+        if chosen is files_action:
+            paths = getFile(self, "Import files", None, key="import", multi=True)
+        elif chosen is folder_action:
+            folder = QFileDialog.getExistingDirectory(self, "Import folder")
+            paths = [folder] if folder else []
+        else:
+            return
+        if not paths: # canceled
+            return
+
+        pattern = filename_regex(self.addonConfig['batchFilenamePattern'])
+        default_author = self.form.authorBox.text().strip()
+        try:
+            sources = [identify(i, pattern, default_author) for i in find_text_files(paths)]
+        except (OSError, UnicodeDecodeError) as e:
+            showWarning(f"Unable to read the files to import: {e}")
+            return
+        if not sources:
+            showWarning("There are no text files in that folder.")
+            return
+
+        tags = self.mw.col.tags.split(self.form.tagsBox.text())
+        context_lines = self.form.contextLinesSpin.value()
+        recite_lines = self.form.reciteLinesSpin.value()
+        group_lines = self.form.groupLinesSpin.value()
+        did = self.deckChooser.selectedId()
+        results = []
+
+        def op(col) -> OpChangesWithCount:
+            batch = import_files(
+                col, Note, sources, self.addonConfig, tags, did,
+                context_lines, group_lines, recite_lines, max_workers=0,
+                on_file=self._on_batch_added,
+                want_cancel=self._cancel_requested.is_set)
+            results.extend(batch.files)
+            return _import_changes(col, batch.undo_entry,
+                                   sum(i.notes_added for i in results))
+
+        started = time.monotonic()
+
+        def on_success(result: OpChangesWithCount) -> None:
+            self._set_importing(False)
+            summary = format_summary(results, time.monotonic() - started)
+            if result.count:
+                super(LPCGDialog, self).accept()
+                self.deckChooser.cleanup()
+                showText(summary, parent=self.mw, title="LPCG Batch Import")
+            else:
+                showText(summary, parent=self, title="LPCG Batch Import")
+
+        resumed = any(load_checkpoint(self.mw.col, i.title) is not None for i in sources)
+        self._start_import(op, on_success, "%v of %m files imported", resumed=resumed)
+
     def onHelp(self):
         """
         Open the documentation on importing files in a browser.
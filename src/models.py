@@ -22,18 +22,41 @@ presented in slightly altered form here. The third project should combine the
 two versions and create a standardized system!
 """
 from abc import ABC
+import hashlib
 import inspect
 import re
 from textwrap import dedent
-from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Type
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Type, TYPE_CHECKING
 import sys
 
-import aqt
-from aqt.utils import askUser, showInfo
 from anki.consts import MODEL_CLOZE
 from anki.models import TemplateDict as AnkiTemplate
 from anki.models import NotetypeDict as AnkiModel
 
+from .gen_notes import prompt_for
+
+if TYPE_CHECKING:
+    from anki.collection import Collection
+    from anki.notes import Note
+
+#: A note-level migration step: update an existing note of an older version of
+#: the model in place, returning True if anything was changed.
+NoteMigration = Callable[['Note'], bool]
+
+
+def _collection(col: Optional['Collection'] = None) -> 'Collection':
+    """
+    Return /col/, or if it's None, the collection open in the Anki GUI.
+
+    aqt is only imported when the GUI's collection is needed, so that note
+    types can also be created without a GUI (see cli.py).
+    """
+    if col is not None:
+        return col
+    import aqt  # pylint: disable=import-outside-toplevel
+    assert aqt.mw is not None, "Tried to use models before Anki is initialized!"
+    return aqt.mw.col
+
 
 class TemplateData(ABC):
     """
@@ -44,10 +67,9 @@ class TemplateData(ABC):
     back: str
 
     @classmethod
-    def to_template(cls) -> AnkiTemplate:
+    def to_template(cls, col: Optional['Collection'] = None) -> AnkiTemplate:
         "Create and return an Anki template object for this model definition."
-        assert aqt.mw is not None, "Tried to use models before Anki is initialized!"
-        mm = aqt.mw.col.models
+        mm = _collection(col).models
         t = mm.new(cls.name)
         t['qfmt'] = dedent(cls.front).strip()
         t['afmt'] = dedent(cls.back).strip()
@@ -65,22 +87,21 @@ class ModelData(ABC):
     sort_field: str
     is_cloze: bool
     version: str
-    upgrades: Tuple[Tuple[str, str, Callable[[AnkiModel], None]], ...]
+    upgrades: Tuple[Tuple[str, str, Callable[[AnkiModel], None], Optional[NoteMigration]], ...]
 
     @classmethod
-    def to_model(cls) -> Tuple[AnkiModel, str]:
+    def to_model(cls, col: Optional['Collection'] = None) -> Tuple[AnkiModel, str]:
         """
         Create and return a pair of (Anki model object, version spec)
         for this model definition.
         """
-        assert aqt.mw is not None, "Tried to use models before Anki is initialized!"
-        mm = aqt.mw.col.models
+        mm = _collection(col).models
         model = mm.new(cls.name)
         for i in cls.fields:
             field = mm.new_field(i)
             mm.add_field(model, field)
         for template in cls.templates:
-            t = template.to_template()
+            t = template.to_template(col)
             mm.addTemplate(model, t)
         model['css'] = dedent(cls.styling).strip()
         model['sortf'] = cls.fields.index(cls.sort_field)
@@ -94,35 +115,52 @@ class ModelData(ABC):
         Given that the model is at version current_version (typically stored
         in the add-on config), run all functions possible in the updates tuple
         of the model. The updates tuple must be presented in chronological order;
-        each element is itself a 3-element tuple:
+        each element is itself a 4-element tuple:
 
         [0] Version number to upgrade from
         [1] Version number to upgrade to
         [2] Function taking one argument, the model, and mutating it as required;
             raises an exception if update failed.
+        [3] NoteMigration to run on each existing note once the model has been
+            upgraded, or None if the notes don't need to change. These are
+            run separately, by migrate_notes() (see note_migrations()).
 
         Returns the new version the model is at.
         """
-        assert aqt.mw is not None, "Tried to use models before Anki is initialized!"
-        model = aqt.mw.col.models.by_name(cls.name)
+        col = _collection()
+        model = col.models.by_name(cls.name)
 
         at_version = current_version
-        for cur_ver, new_ver, func in cls.upgrades:
+        for cur_ver, new_ver, func, _ in cls.upgrades:
             if at_version == cur_ver:
                 func(model)
                 at_version = new_ver
         if at_version != current_version:
-            aqt.mw.col.models.save(model)
+            col.models.save(model)
         return at_version
 
     @classmethod
-    def in_collection(cls) -> bool:
+    def note_migrations(cls, notes_version: str) -> List[NoteMigration]:
+        """
+        Return, in order, the note-level migration steps of the upgrades from
+        notes_version (the version the notes were last migrated to) onwards.
+        """
+        steps = []
+        at_version = notes_version
+        for cur_ver, new_ver, _, migrate in cls.upgrades:
+            if at_version == cur_ver:
+                if migrate is not None:
+                    steps.append(migrate)
+                at_version = new_ver
+        return steps
+
+    @classmethod
+    def in_collection(cls, col: Optional['Collection'] = None) -> bool:
         """
         Determine if a model by this name exists already in the current
         Anki collection.
         """
-        assert aqt.mw is not None, "Tried to use models before Anki is initialized!"
-        mm = aqt.mw.col.models
+        mm = _collection(col).models
         model = mm.by_name(cls.name)
         return model is not None
 
@@ -133,7 +171,7 @@ class ModelData(ABC):
         """
         if cls.is_at_version(current_version):
             return False
-        for cur_ver, _, __ in cls.upgrades:
+        for cur_ver, _, __, ___ in cls.upgrades:
             if current_version == cur_ver:
                 return True
         return False
@@ -143,10 +181,25 @@ class ModelData(ABC):
         "Return True if this model is at the version current_version."
         return current_version == cls.version
 
+    @classmethod
+    def fingerprint(cls) -> str:
+        """
+        Return a hash of everything in this model definition: its name,
+        fields, templates, styling, and version. If the fingerprint stored in
+        the collection matches, the note type was verified against exactly
+        this definition and there's no need to check it again.
+        """
+        parts = [cls.name, *cls.fields, dedent(cls.styling).strip(), cls.sort_field,
+                 str(cls.is_cloze), cls.version]
+        for template in cls.templates:
+            parts.extend((template.name, dedent(template.front).strip(),
+                          dedent(template.back).strip()))
+        return hashlib.sha1('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
 
 def upgrade_none_to_onethreeoh(mod):
     "Upgrade LPCG model from unversioned to version 1.3.0."
-    mm = aqt.mw.col.models
+    mm = _collection().models
     field = mm.new_field("Prompt")
     mm.add_field(mod, field)
 
@@ -175,9 +228,23 @@ def upgrade_none_to_onethreeoh(mod):
     )
 
 
+def migrate_fill_prompt(note: 'Note') -> bool:
+    """
+    Fill in the Prompt field added in 1.3.0 for a note that recites more than
+    one line, counting the paragraphs of its Line field as LPCG does now.
+    """
+    if note['Prompt']:
+        return False
+    prompt = prompt_for(note['Line'].count('<p>'))
+    if prompt is None:
+        return False
+    note['Prompt'] = prompt
+    return True
+
+
 def upgrade_onethreeoh_to_onefouroh(mod):
     "Upgrade LPCG model from 1.3.0 to version 1.4.0."
-    mm = aqt.mw.col.models
+    mm = _collection().models
     mm.add_field(mod, mm.new_field("Author"))
 
     mod['css'] = mod['css'].replace('.title {', '.title, .author {')
@@ -193,6 +260,69 @@ def upgrade_onethreeoh_to_onefouroh(mod):
         )
 
 
+#: Renders the Context field of a note in compact storage (see compact.py),
+#: which is just a comment naming its poem's media file, from that file, the
+#: same way gen_notes.Poem.context() does. Other notes have no such comment,
+#: so it leaves them alone.
+CONTEXT_SCRIPT = """
+            <script>
+                (function () {
+                    var walker = document.createTreeWalker(document.body,
+                                                           NodeFilter.SHOW_COMMENT);
+                    var marker = null;
+                    while (walker.nextNode()) {
+                        if (/^lpcg:[0-9a-f]+$/.test(walker.currentNode.nodeValue)) {
+                            marker = walker.currentNode;
+                            break;
+                        }
+                    }
+                    if (marker === null) {
+                        return;
+                    }
+                    var render = function (html) {
+                        var template = document.createElement('template');
+                        template.innerHTML = html;
+                        marker.parentNode.replaceChild(template.content, marker);
+                    };
+                    var seq = parseInt('{{Sequence}}', 10);
+                    fetch('_lpcg-' + marker.nodeValue.slice(5) + '.json', {cache: 'no-cache'})
+                        .then(function (response) {
+                            return response.json();
+                        })
+                        .then(function (poem) {
+                            var offset = function (s) {
+                                return Math.min((s - 1) * poem.group, poem.lines.length);
+                            };
+                            var start = seq - poem.context;
+                            var lines;
+                            if (poem.context === 0) {
+                                lines = poem.lines.slice(offset(seq), offset(seq + 1));
+                            } else {
+                                lines = poem.lines.slice(offset(Math.max(start, 1)),
+                                                         offset(seq));
+                                if (start <= 0) {
+                                    lines.unshift(poem.beginning);
+                                }
+                            }
+                            render(lines.map(function (line) {
+                                return '<p>' + line + '</p>';
+                            }).join(''));
+                        })
+                        .catch(function () {
+                            render('<p>[Context unavailable]</p>');
+                        });
+                })();
+            </script>
+"""
+
+
+def upgrade_onefouroh_to_onefiveoh(mod):
+    "Upgrade LPCG model from 1.4.0 to version 1.5.0."
+    assert len(mod['tmpls']) == 1, "LPCG note type has extra templates!"
+    for side in ['qfmt', 'afmt']:
+        mod['tmpls'][0][side] += "\n\n" + dedent(CONTEXT_SCRIPT).strip()
+
+
 class LpcgOne(ModelData):
     class LpcgOneTemplate(TemplateData):
         name = "LPCG1"
@@ -209,7 +339,7 @@ class LpcgOne(ModelData):
                     {{^Prompt}}[...]{{/Prompt}}
                 </div>
             </div>
-        """
+        """ + CONTEXT_SCRIPT
         back = """
             <div class="title">{{Title}} {{Sequence}}</div>
             {{#Author}}<div class="author">{{Author}}</div>{{/Author}}
@@ -220,7 +350,7 @@ class LpcgOne(ModelData):
                 {{Context}}
                 <div class="cloze">{{Line}}</div>
             </div>
-        """
+        """ + CONTEXT_SCRIPT
 
     name = "LPCG 1.0"
     fields = ("Line", "Context", "Title", "Author", "Sequence", "Prompt")
@@ -265,28 +395,67 @@ class LpcgOne(ModelData):
     """
     sort_field = "Sequence"
     is_cloze = False
-    version = "1.4.0"
+    version = "1.5.0"
     upgrades = (
-        ("none", "1.3.0", upgrade_none_to_onethreeoh),
-        ("1.3.0", "1.4.0", upgrade_onethreeoh_to_onefouroh),
+        ("none", "1.3.0", upgrade_none_to_onethreeoh, migrate_fill_prompt),
+        ("1.3.0", "1.4.0", upgrade_onethreeoh_to_onefouroh, None),
+        ("1.4.0", "1.5.0", upgrade_onefouroh_to_onefiveoh, None),
     )
 
 
+#: Collection config key for the fingerprint of the last verified LpcgOne.
+FINGERPRINT_KEY = 'lpcg_model_fingerprint'
+#: Collection config key for the version the LPCG notes were last migrated to.
+#: It's separate from the model version, as notes are migrated in the background
+#: after the model is upgraded, and weren't migrated at all before LPCG 1.5.
+NOTES_VERSION_KEY = 'lpcg_notes_version'
+#: Number of notes read, migrated, and written back at a time by migrate_notes().
+MIGRATION_BATCH_SIZE = 1000
+
+
+def add_note_type(col: Optional['Collection'] = None) -> None:
+    "Create the LPCG note type in a collection that doesn't have it yet."
+    col = _collection(col)
+    model_data, new_version = LpcgOne.to_model(col)
+    col.models.add(model_data)
+    col.set_config('lpcg_model_version', new_version)
+    col.set_config(NOTES_VERSION_KEY, new_version)
+    col.set_config(FINGERPRINT_KEY, LpcgOne.fingerprint())
+
+
+def check_note_type() -> None:
+    """
+    Run when a profile is opened. If the note type was last verified against
+    the current definition and the notes are up to date, do nothing;
+    otherwise, schedule ensure_note_type() to run once the profile has
+    finished opening, rather than holding it up.
+    """
+    # pylint: disable=import-outside-toplevel
+    import aqt
+    col = _collection()
+    if (col.get_config(FINGERPRINT_KEY, default=None) == LpcgOne.fingerprint()
+            and LpcgOne.is_at_version(col.get_config(NOTES_VERSION_KEY, default="none"))):
+        return
+    aqt.mw.progress.single_shot(0, ensure_note_type)
+
+
 def ensure_note_type() -> None:
     """
-    Create or update the LPCG note type as needed.
+    Create or update the LPCG note type as needed, and record its fingerprint
+    once it's known to be up to date. Then migrate the existing notes if
+    they need it.
     """
-    assert aqt.mw is not None, "Tried to use models before Anki is initialized!"
+    # pylint: disable=import-outside-toplevel
+    from aqt.utils import askUser, showInfo
+    col = _collection()
     mod = LpcgOne
 
-    if not mod.in_collection():
-        model_data, new_version = mod.to_model()
-        aqt.mw.col.models.add(model_data)
-        aqt.mw.col.set_config('lpcg_model_version', new_version)
+    if not mod.in_collection(col):
+        add_note_type(col)
         return
 
     # "none": the "version number" pre-versioning
-    current_version = aqt.mw.col.get_config('lpcg_model_version', default="none")
+    current_version = col.get_config('lpcg_model_version', default="none")
     if mod.can_upgrade(current_version):
         r = askUser("In order to import new notes in this version of LPCG, "
                     "your LPCG note type needs to be upgraded. "
@@ -295,14 +464,92 @@ def ensure_note_type() -> None:
                     "If you say no, you will be asked again next time you start Anki.")
         if r:
             new_version = mod.upgrade_from(current_version)
-            aqt.mw.col.set_config('lpcg_model_version', new_version)
-            showInfo("Your LPCG note type was upgraded successfully. "
+            col.set_config('lpcg_model_version', new_version)
+            if mod.is_at_version(new_version):
+                col.set_config(FINGERPRINT_KEY, mod.fingerprint())
+            upgrade_notes(lambda: showInfo(
+                    "Your LPCG note type was upgraded successfully. "
                     "Please take a moment to ensure your LPCG cards "
                     "are still displaying as expected so you can restore from a backup "
-                    "in the event something is not working correctly.")
+                    "in the event something is not working correctly."))
         return
 
-    assert mod.is_at_version(aqt.mw.col.get_config('lpcg_model_version')), \
+    assert mod.is_at_version(col.get_config('lpcg_model_version')), \
         "Your LPCG model is out of date, but I couldn't find a valid upgrade path. " \
         "You are likely to encounter issues. " \
         "Please contact the developer for assistance resolving this problem."
+    col.set_config(FINGERPRINT_KEY, mod.fingerprint())
+    upgrade_notes()
+
+
+def migrate_notes(col: 'Collection', model: Type[ModelData], steps: List[NoteMigration],
+                  on_batch: Optional[Callable[[int, int], None]] = None) -> int:
+    """
+    Run the note-level migration /steps/ on every note of /model/, and return
+    the number of notes changed. Notes are read MIGRATION_BATCH_SIZE at a
+    time, and those that changed are written back with one bulk update per
+    batch, all merged into a single undo step, so only one batch of notes is
+    in memory at once however big the collection is.
+
+    If given, on_batch(done, total) is called after each batch.
+    """
+    mid = col.models.id_for_name(model.name)
+    note_ids = col.db.list("select id from notes where mid = ? order by id", mid)
+    undo_entry = None
+    changed_count = 0
+    for start in range(0, len(note_ids), MIGRATION_BATCH_SIZE):
+        changed = []
+        for nid in note_ids[start:start + MIGRATION_BATCH_SIZE]:
+            note = col.get_note(nid)
+            if any([step(note) for step in steps]):  # every step must run
+                changed.append(note)
+        if changed:
+            if undo_entry is None:
+                undo_entry = col.add_custom_undo_entry("Upgrade LPCG Notes")
+            col.update_notes(changed)
+            col.merge_undo_entries(undo_entry)
+            changed_count += len(changed)
+        if on_batch is not None:
+            on_batch(min(start + MIGRATION_BATCH_SIZE, len(note_ids)), len(note_ids))
+    return changed_count
+
+
+def upgrade_notes(on_done: Optional[Callable[[], None]] = None) -> None:
+    """
+    If the LPCG notes in the GUI's collection were last migrated at an older
+    version of the note type, run the migrations needed in the background
+    with a progress window, then record that they're up to date. on_done()
+    is called on the main thread once the notes are up to date.
+    """
+    # pylint: disable=import-outside-toplevel
+    import aqt
+    from aqt.operations import CollectionOp
+    from aqt.utils import tooltip
+    from anki.collection import OpChangesWithCount
+
+    col = _collection()
+    steps = LpcgOne.note_migrations(col.get_config(NOTES_VERSION_KEY, default="none"))
+    if not steps:
+        col.set_config(NOTES_VERSION_KEY, LpcgOne.version)
+        if on_done is not None:
+            on_done()
+        return
+
+    def on_batch(done: int, total: int) -> None:
+        aqt.mw.taskman.run_on_main(lambda: aqt.mw.progress.update(
+            label=f"Upgrading LPCG notes ({done} of {total})...", value=done, max=total))
+
+    def op(col: 'Collection') -> OpChangesWithCount:
+        result = OpChangesWithCount(count=migrate_notes(col, LpcgOne, steps, on_batch))
+        if result.count:
+            result.changes.CopyFrom(col.merge_undo_entries(col.undo_status().last_step))
+        col.set_config(NOTES_VERSION_KEY, LpcgOne.version)
+        return result
+
+    def on_success(result: OpChangesWithCount) -> None:
+        if result.count:
+            tooltip(f"Upgraded {result.count} LPCG notes.")
+        if on_done is not None:
+            on_done()
+
+    CollectionOp(parent=aqt.mw, op=op).success(on_success).run_in_background()
@@ -0,0 +1,188 @@
+"""
+Operations on a whole poem at once, keyed by its title: reading its notes in
+order, rebuilding its text, and renaming, moving, retagging, or deleting it.
+
+Each one checks the poem exists with the registry (see poem_store), finds
+its notes with one search, and then reads or changes them all with a single
+query or collection operation, rather than editing notes one at a time.
+Every change is a single undo step; renaming and deleting a poem also move
+or remove its record and registry entry (see poem_store), and undoing them
+puts those back too. Deleting a poem in compact storage trashes its media
+file, which undoing doesn't bring back (see delete_poem()).
+
+The Sequence field is text as far as Anki is concerned, so notes are always
+returned in numeric order here (10 comes after 9, not after 1).
+"""
+
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional
+
+from .compact import poem_key_of, trash_poem_file
+from .gen_notes import find_poem_notes
+from .poem_store import (NOTE_TYPE, RegistryEntry, find_poem, forget_poem, load_record,
+                         rename_poem_data)
+from .rerender import FIELD_SEPARATOR, Markers, units_from_lines
+
+
+class PoemNote(NamedTuple):
+    "One note of a poem, as read by fetch_poem()."
+    id: int
+    sequence: int
+    fields: Dict[str, str]
+    tags: List[str]
+
+
+def _require_poem(col: Any, title: str) -> RegistryEntry:
+    entry = find_poem(col, title)
+    if entry is None:
+        raise ValueError(f'There\'s no poem called "{title}".')
+    return entry
+
+
+def _id_list(note_ids: Iterable[int]) -> str:
+    return ','.join(str(i) for i in note_ids)
+
+
+def fetch_poem(col: Any, title: str) -> List[PoemNote]:
+    """
+    Return the notes of the poem called /title/ in sequence order.
+    Raises ValueError if there's no such poem.
+    """
+    _require_poem(col, title)
+    return _read_notes(col, title)
+
+
+def _read_notes(col: Any, title: str) -> List[PoemNote]:
+    names = col.models.field_names(col.models.by_name(NOTE_TYPE))
+    notes = []
+    note_ids = find_poem_notes(col, title)
+    for nid, flds, tags in col.db.all(
+            f"select id, flds, tags from notes where id in ({_id_list(note_ids)})"):
+        fields = dict(zip(names, flds.split(FIELD_SEPARATOR)))
+        notes.append(PoemNote(nid, int(fields['Sequence']), fields, tags.split()))
+    notes.sort(key=lambda n: n.sequence)
+    return notes
+
+
+def source_text(lines: List[str], markers: Markers) -> str:
+    """
+    Turn cleansed /lines/ back into text that can be edited in the poem
+    editor and cleansed again to get the same lines: indents become tabs,
+    lines ending in the end-of-stanza marker are followed by a blank line,
+    the markers are removed, and #s are escaped so they aren't comments.
+    """
+    indent_start, indent_end = '<span class="indent">', '</span>'
+    source = []
+    for n, line in enumerate(lines):
+        indented = line.startswith(indent_start) and line.endswith(indent_end)
+        if indented:
+            line = line[len(indent_start):-len(indent_end)]
+        marker = markers.text if n == len(lines) - 1 else markers.stanza
+        ends_stanza = bool(marker) and line.endswith(marker)
+        if ends_stanza:
+            line = line[:-len(marker)]
+        source.append(('\t' if indented else '') + line.replace('#', '\\#'))
+        if ends_stanza and n != len(lines) - 1:
+            source.append('')
+    return '\n'.join(source)
+
+
+def poem_text(col: Any, title: str, config: Dict[str, Any]) -> str:
+    """
+    Rebuild the text of the poem called /title/ from the Line fields of its
+    notes, as it would be typed into the poem editor (see source_text()).
+    The markers are those the poem was imported with if it has a record,
+    otherwise the ones in /config/. Raises ValueError if there's no such poem.
+    """
+    entry = _require_poem(col, title)
+    record = load_record(col, title)
+    markers = (Markers(record.stanza_marker, record.text_marker) if record is not None
+               else Markers.from_config(config))
+    units = units_from_lines([n.fields['Line'] for n in _read_notes(col, title)],
+                             entry.group_lines)
+    return source_text([line for unit in units for line in unit], markers)
+
+
+def rename_poem(col: Any, title: str, new_title: str) -> int:
+    """
+    Change the Title field of every note of the poem /title/ to /new_title/
+    and return the number of notes changed. Raises ValueError if there's no
+    such poem or /new_title/ is already taken.
+    """
+    _require_poem(col, title)
+    if not new_title or find_poem(col, new_title) is not None:
+        raise ValueError(f'There\'s already a poem called "{new_title}".')
+    # Searching fields ignores case, so make sure each note really has the title.
+    notes = [note for note in (col.get_note(nid) for nid in find_poem_notes(col, title))
+             if note['Title'] == title]
+    for note in notes:
+        note['Title'] = new_title
+    undo_entry = col.add_custom_undo_entry("Rename Poem")
+    col.update_notes(notes)
+    rename_poem_data(col, title, new_title)
+    col.merge_undo_entries(undo_entry)
+    return len(notes)
+
+
+def move_poem(col: Any, title: str, deck_id: int) -> int:
+    """
+    Move all the cards of the poem /title/ to the deck /deck_id/ and return
+    the number of cards moved. Raises ValueError if there's no such poem.
+    """
+    _require_poem(col, title)
+    card_ids = col.db.list(
+        f"select id from cards where nid in ({_id_list(find_poem_notes(col, title))})")
+    undo_entry = col.add_custom_undo_entry("Move Poem")
+    col.set_deck(card_ids, deck_id)
+    col.merge_undo_entries(undo_entry)
+    return len(card_ids)
+
+
+def retag_poem(col: Any, title: str, add: Optional[List[str]] = None,
+               remove: Optional[List[str]] = None) -> int:
+    """
+    Add the tags /add/ to, and remove the tags /remove/ from, every note of
+    the poem /title/, and return the number of notes. Raises ValueError if
+    there's no such poem.
+    """
+    _require_poem(col, title)
+    note_ids = find_poem_notes(col, title)
+    undo_entry = col.add_custom_undo_entry("Retag Poem")
+    if remove:
+        col.tags.bulk_remove(note_ids, ' '.join(remove))
+    if add:
+        col.tags.bulk_add(note_ids, ' '.join(add))
+    col.merge_undo_entries(undo_entry)
+    return len(note_ids)
+
+
+def delete_poem(col: Any, title: str) -> int:
+    """
+    Delete every note of the poem /title/, along with its record and registry
+    entry, and return the number of notes deleted. Raises ValueError if
+    there's no such poem.
+
+    If the poem is in compact storage, its media file is moved to the media
+    trash, since Check Media never counts it as unused. Media changes can't
+    be undone, so if the deletion is, the file has to be restored from the
+    trash (with Check Media) or the poem re-rendered to write it again.
+    """
+    entry = _require_poem(col, title)
+    note_ids = find_poem_notes(col, title)
+    key = poem_key_of(col.get_note(entry.first_note_id)['Context'])
+    undo_entry = col.add_custom_undo_entry("Delete Poem")
+    col.remove_notes(note_ids)
+    forget_poem(col, title)
+    col.merge_undo_entries(undo_entry)
+    trash_poem_file(col, key)
+    return len(note_ids)
+
+
+def titles_of_notes(col: Any, note_ids: Iterable[int]) -> List[str]:
+    "Return the titles of the poems that any of the LPCG notes /note_ids/ belong to, sorted."
+    mid = col.models.id_for_name(NOTE_TYPE)
+    if mid is None:
+        return []
+    title_ord = col.models.field_names(col.models.by_name(NOTE_TYPE)).index('Title')
+    fields = col.db.list(
+        f"select flds from notes where mid = ? and id in ({_id_list(note_ids)})", mid)
+    return sorted({i.split(FIELD_SEPARATOR)[title_ord] for i in fields})
@@ -0,0 +1,375 @@
+"""
+Storage for the generation settings of each imported poem, so that a poem
+can later be edited and re-imported without deleting its notes and losing
+their review history. Only a fingerprint of a poem's text is stored; the
+text itself is rebuilt from the notes when it's needed, so a long poem
+doesn't have to be synced twice.
+
+Also here is the poem registry, an index of the poems in the collection
+(their authors, first notes, numbers of notes, and settings), so finding
+out whether a poem exists doesn't need a search through every note's fields.
+It doesn't list every note of a poem, which would make the synced config
+grow with the length of the poems; operations on a whole poem search for
+its notes.
+The registry keeps a digest of the LPCG notes, so it notices when it's
+drifted from them -- for instance, when notes have been deleted or retitled
+in the browser -- and rebuilds itself.
+
+Finally, long imports leave a checkpoint after each batch of notes they
+commit, so an import that was interrupted (say, by Anki crashing) can pick
+up where it left off instead of leaving a partial poem behind.
+
+Records and checkpoints are kept in the collection's config, one key per
+poem, and the registry in a key of its own, so they're synced along with the
+notes themselves.
+"""
+
+import hashlib
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+from .gen_notes import find_poem_notes
+
+CONFIG_PREFIX = "lpcg_poem:"
+#: The poem registry: the entry of each poem, and the _note_digest() of the
+#: LPCG notes it accounts for.
+REGISTRY_KEY = "lpcg_registry"
+CHECKPOINT_PREFIX = "lpcg_checkpoint:"
+NOTE_TYPE = "LPCG 1.0"
+
+
+class PoemRecord(NamedTuple):
+    """
+    The settings a poem's notes were generated with, the import_fingerprint()
+    of the text and settings it was last imported with, and the key of its
+    media file if it's in compact storage (see compact.py).
+    """
+    title: str
+    author: str
+    fingerprint: str
+    context_lines: int
+    recite_lines: int
+    group_lines: int
+    stanza_marker: str
+    text_marker: str
+    poem_key: Optional[str] = None
+
+    @classmethod
+    def create(cls, title: str, author: str, fingerprint: str, context_lines: int,
+               recite_lines: int, group_lines: int, config: Dict[str, Any],
+               poem_key: Optional[str] = None) -> 'PoemRecord':
+        "Create a record, taking the end-of-stanza/text markers from /config/."
+        return cls(title, author, fingerprint, context_lines, recite_lines, group_lines,
+                   config['endOfStanzaMarker'], config['endOfTextMarker'], poem_key)
+
+
+def save_record(col: Any, record: PoemRecord) -> None:
+    "Store /record/, replacing any previous record for a poem of that title."
+    col.set_config(CONFIG_PREFIX + record.title, record._asdict())
+
+
+def load_record(col: Any, title: str) -> Optional[PoemRecord]:
+    "Return the stored record for the poem called /title/, or None if there isn't one."
+    data = col.get_config(CONFIG_PREFIX + title, default=None)
+    return PoemRecord(**data) if data else None
+
+
+class RegistryEntry(NamedTuple):
+    """
+    What the registry knows about one poem: its author, the id of its first
+    note, its number of notes, and its settings. The settings are None if
+    the registry was rebuilt from notes that have no PoemRecord.
+    """
+    title: str
+    author: str
+    first_note_id: int
+    line_count: int
+    context_lines: Optional[int]
+    recite_lines: Optional[int]
+    group_lines: Optional[int]
+
+
+def _note_digest(col: Any) -> List[int]:
+    """
+    Return a digest of the LPCG notes in the collection: their number, and
+    the sums of their ids, modification times and field lengths. It changes
+    whenever LPCG notes are added, deleted, or edited (say, retitled in the
+    browser), even within the second the notes were last changed in.
+    """
+    mid = col.models.id_for_name(NOTE_TYPE)
+    if mid is None:
+        return [0, 0, 0, 0]
+    return list(col.db.first(
+        "select count(), coalesce(sum(id), 0), coalesce(sum(mod), 0), "
+        "coalesce(sum(length(flds)), 0) from notes where mid = ?", mid))
+
+
+def _save_registry(col: Any, poems: Dict[str, Dict[str, Any]],
+                   undoable: bool = False) -> None:
+    "Store the registry entries /poems/, as of the LPCG notes now in the collection."
+    col.set_config(REGISTRY_KEY, {'digest': _note_digest(col), 'poems': poems},
+                   undoable=undoable)
+
+
+def _current_registry(col: Any) -> Dict[str, Dict[str, Any]]:
+    "Return the registry's entries by title, rebuilding it first if it's drifted from the notes."
+    registry = col.get_config(REGISTRY_KEY, default=None)
+    if registry is None or registry['digest'] != _note_digest(col):
+        rebuild_registry(col)
+        registry = col.get_config(REGISTRY_KEY)
+    return registry['poems']
+
+
+def register_notes(col: Any, title: str, author: str, note_ids: List[int],
+                   context_lines: Optional[int], recite_lines: Optional[int],
+                   group_lines: Optional[int]) -> None:
+    """
+    Record in the registry that the poem /title/ now consists of the notes
+    /note_ids/ (already in the collection, and given in sequence order, as
+    add_notes() returns them), replacing any previous entry.
+
+    The registry is taken to have been up to date before the notes were
+    changed, as it is once find_poem() or all_poems() has looked at it; if
+    there's no registry yet, it's built from the notes first.
+    """
+    if not note_ids:
+        return
+    registry = col.get_config(REGISTRY_KEY, default=None)
+    poems = registry['poems'] if registry is not None else _current_registry(col)
+    entry = RegistryEntry(title, author, note_ids[0], len(note_ids),
+                          context_lines, recite_lines, group_lines)
+    _save_registry(col, dict(poems, **{title: entry._asdict()}))
+
+
+def _field_ords(col: Any) -> Dict[str, int]:
+    "Return the index of each field LPCG reads in the notes table's flds column."
+    names = col.models.field_names(col.models.by_name(NOTE_TYPE))
+    return {name: names.index(name) for name in ('Title', 'Author', 'Sequence', 'Line')}
+
+
+def register_poem(col: Any, title: str, author: str, context_lines: Optional[int],
+                  recite_lines: Optional[int], group_lines: Optional[int]) -> None:
+    """
+    Like register_notes(), but search for the poem's notes, for when they
+    were added across several imports (see Checkpoint), so the ids of the
+    ones added last aren't all of them.
+    """
+    ords = _field_ords(col)
+    note_ids = ','.join(str(i) for i in find_poem_notes(col, title))
+    rows = []
+    for nid, flds in col.db.all(f"select id, flds from notes where id in ({note_ids})"):
+        rows.append((int(flds.split('\x1f')[ords['Sequence']]), nid))
+    rows.sort()
+    register_notes(col, title, author, [i[1] for i in rows],
+                   context_lines, recite_lines, group_lines)
+
+
+def rebuild_registry(col: Any) -> None:
+    """
+    Recreate the registry from scratch by reading every LPCG note. Settings
+    are kept from each poem's old entry, or else taken from its PoemRecord
+    where there is one.
+    """
+    registry = col.get_config(REGISTRY_KEY, default=None)
+    settings = {}
+    for title, value in (registry['poems'] if registry else {}).items():
+        settings[title] = (value['context_lines'], value['recite_lines'],
+                           value['group_lines'])
+
+    mid = col.models.id_for_name(NOTE_TYPE)
+    poems: Dict[str, List[Any]] = {}
+    if mid is not None:
+        ords = _field_ords(col)
+        for nid, flds in col.db.all("select id, flds from notes where mid = ?", mid):
+            fields = flds.split('\x1f')
+            try:
+                seq = int(fields[ords['Sequence']])
+            except ValueError:
+                continue  # not a note LPCG generated
+            poems.setdefault(fields[ords['Title']], []).append(
+                (seq, nid, fields[ords['Author']]))
+
+    entries = {}
+    for title, notes in poems.items():
+        notes.sort()
+        if title not in settings:
+            record = load_record(col, title)
+            settings[title] = ((record.context_lines, record.recite_lines,
+                                record.group_lines) if record else (None, None, None))
+        entries[title] = RegistryEntry(title, notes[0][2], notes[0][1], len(notes),
+                                       *settings[title])._asdict()
+    # The registry is only a cache of what's in the notes, so rebuilding it
+    # isn't something to undo.
+    _save_registry(col, entries)
+
+
+def find_poem(col: Any, title: str) -> Optional[RegistryEntry]:
+    """
+    Return the registry entry for the poem called /title/, or None if there's
+    no such poem in the collection. The registry is rebuilt first if the
+    LPCG notes have been added to, deleted, or edited behind its back.
+    """
+    data = _current_registry(col).get(title)
+    return RegistryEntry(**data) if data else None
+
+
+def all_poems(col: Any) -> List[RegistryEntry]:
+    """
+    Return the registry entries of every poem in the collection, sorted by
+    title, rebuilding the registry first if it's drifted from the notes.
+    """
+    return [RegistryEntry(**data) for _, data in sorted(_current_registry(col).items())]
+
+
+def rename_poem_data(col: Any, title: str, new_title: str) -> None:
+    """
+    Move the record, registry entry, and any checkpoint of the poem /title/
+    to /new_title/, once its notes have been retitled. The changes are
+    undoable, so they can be merged into the undo entry of the rename.
+    """
+    record = load_record(col, title)
+    if record is not None:
+        col.remove_config(CONFIG_PREFIX + title)
+        col.set_config(CONFIG_PREFIX + new_title, record._replace(title=new_title)._asdict(),
+                       undoable=True)
+    registry = col.get_config(REGISTRY_KEY, default=None)
+    if registry is not None and title in registry['poems']:
+        poems = dict(registry['poems'])
+        poems[new_title] = dict(poems.pop(title), title=new_title)
+        _save_registry(col, poems, undoable=True)
+    checkpoint = load_checkpoint(col, title)
+    if checkpoint is not None:
+        clear_checkpoint(col, title)
+        save_checkpoint(col, checkpoint._replace(title=new_title))
+
+
+def forget_poem(col: Any, title: str) -> None:
+    """
+    Remove the record, registry entry, and any checkpoint of the deleted
+    poem /title/. Like rename_poem_data(), the changes are undoable.
+    """
+    if load_record(col, title) is not None:
+        col.remove_config(CONFIG_PREFIX + title)
+    registry = col.get_config(REGISTRY_KEY, default=None)
+    if registry is not None and title in registry['poems']:
+        _save_registry(col, {k: v for k, v in registry['poems'].items() if k != title},
+                       undoable=True)
+    clear_checkpoint(col, title)
+
+
+class Checkpoint(NamedTuple):
+    """
+    Progress of an import that hasn't finished: the last sequence number
+    committed to the collection, out of /total/ (None if the import was
+    streamed from a file and didn't know), and a fingerprint of the text
+    and settings, so the import is only resumed with the same ones. If the
+    poem is in compact storage, /poem_key/ is the key of its media file, which
+    the rest of its notes must use too.
+    """
+    title: str
+    sequence: int
+    total: Optional[int]
+    fingerprint: str
+    poem_key: Optional[str] = None
+
+
+class TextDigest:
+    """
+    A hash of the raw text of a poem, built up as the text is read, so that
+    a file only has to be read once to be both imported and fingerprinted.
+    Whitespace at the start and end of the whole text is left out, so a
+    file and the same text typed into the poem editor hash the same.
+    """
+    def __init__(self) -> None:
+        self._hash = hashlib.sha1()
+        self._started = False
+        # Whitespace that's only hashed if more text follows it.
+        self._pending = ""
+
+    def feed(self, source: Iterable[str]) -> Iterator[str]:
+        "Yield the chunks of /source/, adding each to the hash as it goes past."
+        for chunk in source:
+            self._add(chunk)
+            yield chunk
+
+    def _add(self, chunk: str) -> None:
+        if not self._started:
+            chunk = chunk.lstrip()
+            if not chunk:
+                return
+            self._started = True
+        body = chunk.rstrip()
+        if body:
+            self._hash.update((self._pending + body).encode('utf-8'))
+            self._pending = chunk[len(body):]
+        else:
+            self._pending += chunk
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+
+def text_digest(source: Iterable[str]) -> str:
+    "Return the TextDigest of the text given as an iterable of chunks."
+    digest = TextDigest()
+    for _ in digest.feed(source):
+        pass
+    return digest.hexdigest()
+
+
+def digest_fingerprint(digest: str, context_lines: int, recite_lines: int,
+                       group_lines: int, config: Dict[str, Any]) -> str:
+    """
+    Return the import_fingerprint() of a text whose text_digest() is /digest/,
+    without needing the text itself.
+    """
+    settings = (context_lines, recite_lines, group_lines,
+                config['endOfStanzaMarker'], config['endOfTextMarker'],
+                config.get('compactStorage', False))
+    return hashlib.sha1(repr((digest,) + settings).encode('utf-8')).hexdigest()
+
+
+def import_fingerprint(source: Iterable[str], context_lines: int, recite_lines: int,
+                       group_lines: int, config: Dict[str, Any]) -> str:
+    """
+    Return a hash of everything that determines the notes of an import: the
+    raw text, given as an iterable of chunks (e.g., from read_text_file()),
+    the settings, and the end-of-stanza/text markers and storage mode from
+    /config/.
+    """
+    return digest_fingerprint(text_digest(source), context_lines, recite_lines,
+                              group_lines, config)
+
+
+def save_checkpoint(col: Any, checkpoint: Checkpoint) -> None:
+    """
+    Save /checkpoint/, replacing any earlier one of the same title. This is
+    an undo step of its own, for the import to merge into its undo step, so
+    undoing the import also puts back the checkpoint it started from.
+    """
+    col.set_config(CHECKPOINT_PREFIX + checkpoint.title, checkpoint._asdict(),
+                   undoable=True)
+
+
+def load_checkpoint(col: Any, title: str) -> Optional[Checkpoint]:
+    "Return the checkpoint of an unfinished import of /title/, or None."
+    data = col.get_config(CHECKPOINT_PREFIX + title, default=None)
+    return Checkpoint(**data) if data else None
+
+
+def clear_checkpoint(col: Any, title: str) -> None:
+    """
+    Remove the checkpoint of /title/, if any. Like saving one, this is an
+    undo step of its own, which the import merges into its undo step.
+    """
+    if col.get_config(CHECKPOINT_PREFIX + title, default=None) is not None:
+        col.remove_config(CHECKPOINT_PREFIX + title)
+
+
+def committed_sequence(col: Any, checkpoint: Checkpoint) -> int:
+    """
+    Return the sequence number to resume the import in /checkpoint/ after.
+    Checkpoints are saved just after each batch is committed, so if Anki
+    stopped in between, the notes are one batch ahead of the checkpoint;
+    since notes are added in order, counting them tells how far it got.
+    """
+    return max(checkpoint.sequence, len(find_poem_notes(col, checkpoint.title)))
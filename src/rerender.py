@@ -0,0 +1,318 @@
+"""
+Re-render the notes of poems that are already in the collection, after the
+end-of-stanza/text markers in the config have changed or to give a poem
+different generation settings, without deleting the notes and losing their
+review history.
+
+The text of each poem is rebuilt from the Line fields of its notes, in
+sequence order, rather than from its PoemRecord: the notes are what the user
+is actually reviewing, and they may have been edited in the browser since
+the poem was imported (or imported before there were records at all). The
+old markers are swapped for the new ones, and the notes are brought up to
+date with reimport_notes(), which writes back only the notes that change.
+
+    python -m src.rerender collection.anki2
+    python -m src.rerender collection.anki2 --title "My Poem" --context 3
+"""
+
+import argparse
+import sys
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from .compact import poem_key_of, write_poem_file
+from .gen_notes import ReimportResult, find_poem_notes, plan_notes, reimport_notes
+from .poem_store import (RegistryEntry, all_poems, find_poem, load_record, register_notes,
+                         save_record)
+
+#: The field separator in the notes table's flds column.
+FIELD_SEPARATOR = '\x1f'
+
+
+class Markers(NamedTuple):
+    "The end-of-stanza and end-of-text markers a poem's lines were cleansed with."
+    stanza: str
+    text: str
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> 'Markers':
+        return cls(config['endOfStanzaMarker'], config['endOfTextMarker'])
+
+
+def paragraphs(field: str) -> List[str]:
+    "Split a Line or Context field into the text lines it was rendered from."
+    if not field.startswith('<p>') or not field.endswith('</p>'):
+        return [field] if field else []
+    return field[len('<p>'):-len('</p>')].split('</p><p>')
+
+
+def units_from_lines(line_fields: Sequence[str],
+                     group_lines: Optional[int]) -> List[List[str]]:
+    """
+    Return the text lines of each unit (PoemLine) of a poem, given the Line
+    fields of its notes in sequence order. Each Line field starts with its
+    own unit, followed by any further units it recites. If the grouping is
+    unknown, the end of each unit is found by taking the longest run of
+    lines at the end of the Line field that the next note's Line starts with
+    to be lines the next note recites too.
+    """
+    lines = [paragraphs(i) for i in line_fields]
+    if group_lines is not None:
+        return [i[:group_lines] for i in lines]
+    units = []
+    for this, following in zip(lines, lines[1:] + [[]]):
+        overlap = min(len(this) - 1, len(following))
+        while overlap and this[-overlap:] != following[:overlap]:
+            overlap -= 1
+        units.append(this[:len(this) - overlap])
+    return units
+
+
+def _poem_fields(col: Any, title: str,
+                 note_ids: Optional[List[int]]) -> List[Tuple[int, str, str]]:
+    """
+    Return the Sequence, Line, and Context fields of each note of the poem
+    called /title/, in sequence order. The notes are found with a search by
+    title unless their ids are given.
+    """
+    if note_ids is None:
+        note_ids = find_poem_notes(col, title)
+    id_list = ','.join(str(i) for i in note_ids)
+    ords = {name: i for i, name in enumerate(
+        col.models.field_names(col.models.by_name("LPCG 1.0")))}
+    rows = []
+    for _, flds in col.db.all(f"select id, flds from notes where id in ({id_list})"):
+        fields = flds.split(FIELD_SEPARATOR)
+        rows.append((int(fields[ords['Sequence']]), fields[ords['Line']],
+                     fields[ords['Context']]))
+    rows.sort()
+    return rows
+
+
+def poem_units(col: Any, entry: RegistryEntry,
+               note_ids: Optional[List[int]] = None) -> List[List[str]]:
+    """
+    Return the text lines of each unit of the poem in the registry /entry/,
+    rebuilt from the Line fields of its notes with units_from_lines(). The
+    notes are found with a search by title unless their ids are given.
+    """
+    rows = _poem_fields(col, entry.title, note_ids)
+    return units_from_lines([i[1] for i in rows], entry.group_lines)
+
+
+def infer_settings(col: Any, entry: RegistryEntry,
+                   note_ids: Optional[List[int]] = None) -> Tuple[int, int, int]:
+    """
+    Work out the (context, recite, group) settings the poem in the registry
+    /entry/ was imported with from the fields of its notes, for poems that
+    were imported before LPCG 1.5 saved them. The grouping is found as in
+    units_from_lines(), the recitation from the length of the first note's
+    Line field, and the context from the longest Context field, and the
+    result is checked by rendering the poem's notes again with them.
+
+    Raises ValueError if no settings reproduce the notes (e.g., some of
+    them have been edited or deleted in the browser).
+    """
+    rows = _poem_fields(col, entry.title, note_ids)
+    units = units_from_lines([i[1] for i in rows], None)
+    text = [line for unit in units for line in unit]
+    group_lines = max(len(units[0]), 1) if units else 1
+    recite_lines = -(-len(paragraphs(rows[0][1])) // group_lines) if rows else 1
+    longest = max((len(paragraphs(i[2])) for i in rows), default=0)
+    for context_lines in (-(-longest // group_lines), 0):
+        plan = plan_notes(entry.title, entry.author, [], text, 0,
+                          context_lines, group_lines, recite_lines)
+        if (len(plan) == len(rows) and units
+                and all((spec.sequence, spec.fields['Line'], spec.fields['Context']) == row
+                        for spec, row in zip(plan, rows))):
+            return context_lines, recite_lines, group_lines
+    raise ValueError(f'The settings of "{entry.title}" couldn\'t be worked out '
+                     "from its notes, so they must be given.")
+
+
+def _swap_marker(line: str, old: str, new: str) -> str:
+    "Replace the marker /old/ at the end of /line/ (inside any indent span) with /new/."
+    indent_start, indent_end = '<span class="indent">', '</span>'
+    if line.startswith(indent_start) and line.endswith(indent_end):
+        inner = line[len(indent_start):-len(indent_end)]
+        return indent_start + _swap_marker(inner, old, new) + indent_end
+    if old and line.endswith(old):
+        return line[:-len(old)] + new
+    return line
+
+
+def swap_markers(lines: List[str], old: Markers, new: Markers) -> List[str]:
+    """
+    Return cleansed /lines/ with the markers they were cleansed with
+    replaced by /new/ ones. Lines ending in the old end-of-stanza marker are
+    taken to end stanzas, so if it was empty, stanza markers can't be added.
+    """
+    if old == new or not lines:
+        return list(lines)
+    swapped = [_swap_marker(i, old.stanza, new.stanza) for i in lines[:-1]]
+    swapped.append(_swap_marker(lines[-1], old.text, new.text))
+    return swapped
+
+
+def rerender_poem(col: Any, note_constructor: Callable, entry: RegistryEntry,
+                  config: Dict[str, Any], context_lines: Optional[int] = None,
+                  recite_lines: Optional[int] = None, group_lines: Optional[int] = None,
+                  old_markers: Optional[Markers] = None) -> ReimportResult:
+    """
+    Re-render the notes of the poem in the registry /entry/ with the markers
+    in /config/ and the given settings; settings that aren't given stay as
+    they are. The markers the poem currently has are taken from its
+    PoemRecord, or else from /old_markers/, or else assumed to be the ones
+    in /config/ already. The registry entry and any record are updated.
+    Poems in compact storage stay that way, with their media file rewritten.
+
+    If a setting isn't given and the registry doesn't know the poem's
+    current one (e.g., it was imported before LPCG 1.5), the poem's current
+    settings are worked out from its notes with infer_settings(), which
+    raises ValueError if they can't be.
+    """
+    record = load_record(col, entry.title)
+    new_markers = Markers.from_config(config)
+    if record is not None:
+        old_markers = Markers(record.stanza_marker, record.text_marker)
+    elif old_markers is None:
+        old_markers = new_markers
+
+    note_ids = find_poem_notes(col, entry.title)
+    given = (context_lines, recite_lines, group_lines)
+    current = (entry.context_lines, entry.recite_lines, entry.group_lines)
+    if any(g is None and c is None for g, c in zip(given, current)):
+        context, recite, group = infer_settings(col, entry, note_ids)
+        entry = entry._replace(
+            context_lines=entry.context_lines if entry.context_lines is not None else context,
+            recite_lines=entry.recite_lines if entry.recite_lines is not None else recite,
+            group_lines=entry.group_lines if entry.group_lines is not None else group)
+    if context_lines is None:
+        context_lines = entry.context_lines
+    if recite_lines is None:
+        recite_lines = entry.recite_lines
+    if group_lines is None:
+        group_lines = entry.group_lines
+    # Each setting was either given, known to the registry, or inferred above.
+    assert (context_lines is not None and recite_lines is not None
+            and group_lines is not None)
+
+    units = poem_units(col, entry, note_ids)
+    old_text = [line for unit in units for line in unit]
+    old_group_lines = entry.group_lines or (len(units[0]) if units else 1)
+    first = col.get_note(entry.first_note_id)
+    deck_id = col.db.scalar("select did from cards where nid = ? limit 1", first.id)
+    text = swap_markers(old_text, old_markers, new_markers)
+    key = ((record.poem_key if record is not None else None)
+           or poem_key_of(first['Context']))
+    if key is not None:
+        write_poem_file(col, key, text, group_lines, context_lines)
+
+    result = reimport_notes(
+        col, note_constructor, entry.title, entry.author, first.tags, text, old_text,
+        deck_id, context_lines, group_lines, recite_lines, old_group_lines,
+        note_ids=note_ids, poem_key=key)
+    register_notes(col, entry.title, entry.author, [n.id for n in result.notes],
+                   context_lines, recite_lines, group_lines)
+    if record is not None:
+        save_record(col, record._replace(
+            context_lines=context_lines, recite_lines=recite_lines,
+            group_lines=group_lines, stanza_marker=new_markers.stanza,
+            text_marker=new_markers.text, poem_key=key))
+    return result
+
+
+def rerender_all(col: Any, note_constructor: Callable, config: Dict[str, Any],
+                 old_markers: Optional[Markers] = None,
+                 on_poem: Optional[Callable[[int, int], None]] = None,
+                 on_skip: Optional[Callable[[RegistryEntry, str], None]] = None,
+                 ) -> List[Tuple[RegistryEntry, ReimportResult]]:
+    """
+    Re-render every poem in the collection with the markers in /config/,
+    keeping each poem's settings, and return the registry entry and result
+    for each. Poems whose settings aren't saved have them worked out from
+    their notes; those for which that fails are left alone, and passed to
+    on_skip(entry, reason) if given. If given, on_poem(done, total) is
+    called after each poem.
+    """
+    entries = all_poems(col)
+    results = []
+    for done, entry in enumerate(entries, start=1):
+        try:
+            results.append((entry, rerender_poem(col, note_constructor, entry, config,
+                                                 old_markers=old_markers)))
+        except ValueError as e:
+            if on_skip is not None:
+                on_skip(entry, str(e))
+        if on_poem is not None:
+            on_poem(done, len(entries))
+    return results
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    "Entry point for the command-line re-renderer. Returns the exit status."
+    # pylint: disable=import-outside-toplevel
+    from anki.collection import Collection
+    from anki.notes import Note
+    from .cli import add_config_arguments, config_from_args
+
+    parser = argparse.ArgumentParser(
+        prog="python -m src.rerender",
+        description="Re-render the notes of LPCG poems in an Anki collection.")
+    parser.add_argument('collection', help="path to the collection (.anki2) file")
+    parser.add_argument('--title', help="poem to re-render (default: all poems)")
+    parser.add_argument('--context', type=int, dest='context_lines',
+                        help="new lines of context (--title only)")
+    parser.add_argument('--recite', type=int, dest='recite_lines',
+                        help="new lines to recite (--title only)")
+    parser.add_argument('--group', type=int, dest='group_lines',
+                        help="new lines in groups of (--title only)")
+    parser.add_argument('--old-stanza-marker',
+                        help="end-of-stanza marker of poems imported before LPCG 1.5")
+    parser.add_argument('--old-text-marker',
+                        help="end-of-text marker of poems imported before LPCG 1.5")
+    add_config_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.title is None and (args.context_lines, args.recite_lines,
+                               args.group_lines) != (None, None, None):
+        parser.error("--context, --recite, and --group can only be used with --title")
+
+    try:
+        config = config_from_args(args)
+    except (OSError, ValueError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    old_markers = None
+    if args.old_stanza_marker is not None or args.old_text_marker is not None:
+        defaults = Markers.from_config(config)
+        old_markers = Markers(
+            defaults.stanza if args.old_stanza_marker is None else args.old_stanza_marker,
+            defaults.text if args.old_text_marker is None else args.old_text_marker)
+
+    col = Collection(args.collection)
+    try:
+        if args.title is not None:
+            entry = find_poem(col, args.title)
+            if entry is None:
+                print(f'error: there\'s no poem called "{args.title}"', file=sys.stderr)
+                return 1
+            results = [(entry, rerender_poem(
+                col, Note, entry, config, args.context_lines, args.recite_lines,
+                args.group_lines, old_markers))]
+        else:
+            results = rerender_all(
+                col, Note, config, old_markers,
+                on_skip=lambda entry, reason: print(f"skipped: {reason}", file=sys.stderr))
+    except ValueError as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        col.close()
+
+    for entry, result in results:
+        print(f'"{entry.title}": {result.updated} notes updated, {result.added} added, '
+              f"{result.removed} removed, {result.unchanged} unchanged")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+"""
+Lightweight instrumentation for finding out where an import spends its time.
+
+A StageTimer records the wall-clock time spent in named stages (parsing,
+building notes, adding them to the collection, and so on). Timers are cheap
+enough to leave in place permanently; a disabled timer does nothing at all.
+When the logImportTimings option is on, each import's timings are appended
+to a log file, and when profileImports is on, a cProfile capture of the
+import is saved as a .prof file for closer inspection (e.g., with snakeviz).
+"""
+
+import cProfile
+from contextlib import contextmanager
+import datetime
+import os
+import re
+import time
+from typing import Dict, Iterator, Optional
+
+
+class StageTimer:
+    "Accumulates the time spent in each named stage of an operation."
+    def __init__(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+        self.stages: Dict[str, float] = {}
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        """
+        Time the body of the with-statement as /stage/. Time spent in a stage
+        that's entered more than once is added up.
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stages[stage] = self.stages.get(stage, 0.0) + elapsed
+
+    @property
+    def total(self) -> float:
+        return sum(self.stages.values())
+
+    def format(self) -> str:
+        "Describe the timings on one line, in the order the stages were entered."
+        return ", ".join(f"{stage} {seconds:.3f} s" for stage, seconds in self.stages.items())
+
+
+#: Timer to use when the caller doesn't want timings.
+NULL_TIMER = StageTimer(enabled=False)
+
+
+def user_files_path(*parts: str) -> str:
+    """
+    Return a path in the add-on's user_files directory, where files that
+    should survive add-on updates are kept, creating directories as needed.
+    """
+    path = os.path.join(os.path.dirname(__file__), 'user_files', *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def log_timings(path: str, label: str, timer: StageTimer) -> None:
+    "Append a timestamped line describing /timer/'s stages to the log at /path/."
+    timestamp = datetime.datetime.now().isoformat(timespec='seconds')
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(f"{timestamp}\t{label}\ttotal {timer.total:.3f} s\t{timer.format()}\n")
+
+
+def profile_path(label: str) -> str:
+    "Return a new .prof file path in user_files for an import called /label/."
+    timestamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    safe_label = re.sub(r'[^\w-]+', '_', label).strip('_')[:50]
+    return user_files_path('profiles', f"{timestamp}-{safe_label}.prof")
+
+
+@contextmanager
+def profiled(path: Optional[str]) -> Iterator[None]:
+    """
+    Profile the body of the with-statement with cProfile and save the results
+    to /path/. If path is None, do nothing. Only the current thread is profiled.
+    """
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
@@ -0,0 +1,35 @@
+import pytest
+
+
+@pytest.fixture
+def open_collection():
+    """
+    A function that opens the Anki collection at a path, creating it if
+    need be. Collections still open at the end of the test are closed.
+    Tests using this are skipped if the anki package isn't installed.
+    """
+    pytest.importorskip("anki")
+    # pylint: disable=import-outside-toplevel
+    from anki.collection import Collection
+
+    opened = []
+
+    def open_(path):
+        col = Collection(str(path))
+        opened.append(col)
+        return col
+
+    yield open_
+    for col in opened:
+        col.close()
+
+
+@pytest.fixture
+def anki_col(tmp_path, open_collection):
+    "A new collection in tmp_path with the LPCG note type added."
+    # pylint: disable=import-outside-toplevel
+    from src import models
+
+    col = open_collection(tmp_path / "collection.anki2")
+    models.add_note_type(col)
+    return col
@@ -0,0 +1,197 @@
+import os
+from textwrap import dedent
+
+import pytest
+
+# pylint: disable=unused-wildcard-import
+from src.batch_import import *
+
+from src.poem_store import (Checkpoint, find_poem, import_fingerprint, load_checkpoint,
+                             load_record, save_checkpoint)
+
+from .test_gen_notes import (MOCK_CLEANSE_CONFIG, MockCollection, MockNote, fixed_batch_size,
+                             test_poem)
+
+
+@pytest.fixture
+def poem_dir(tmp_path):
+    (tmp_path / "Samuel Longfellow - 'Tis Winter.txt").write_text(test_poem, encoding='utf-8')
+    (tmp_path / "Unknown - Untitled.txt").write_text(dedent("""
+        # Title: Headers Win
+        # Author: Someone Else
+        A short poem
+        of two lines
+        """).strip(), encoding='utf-8')
+    (tmp_path / "notes.md").write_text("Not a poem", encoding='utf-8')
+    sub = tmp_path / "sub"
+    sub.mkdir()
+    (sub / "Anonymous - Empty.txt").write_text("# nothing here\n", encoding='utf-8')
+    return tmp_path
+
+
+def test_find_text_files(poem_dir):
+    files = find_text_files([str(poem_dir)])
+    assert [os.path.relpath(i, poem_dir) for i in files] == [
+        "Samuel Longfellow - 'Tis Winter.txt",
+        "Unknown - Untitled.txt",
+        os.path.join("sub", "Anonymous - Empty.txt"),
+    ]
+
+
+@pytest.mark.parametrize("pattern,stem,expected", [
+    ("{author} - {title}", "Frost - Fire and Ice", ("Fire and Ice", "Frost")),
+    ("{title}", "Fire and Ice", ("Fire and Ice", "")),
+    ("{title} ({author})", "Fire and Ice", ("Fire and Ice", "")),
+])
+def test_identify_from_filename(tmp_path, pattern, stem, expected):
+    path = tmp_path / f"{stem}.txt"
+    path.write_text("Some fire, some ice\n", encoding='utf-8')
+    source = identify(str(path), filename_regex(pattern))
+    assert (source.title, source.author) == expected
+
+
+def test_identify_from_header(poem_dir):
+    source = identify(str(poem_dir / "Unknown - Untitled.txt"),
+                      filename_regex("{author} - {title}"))
+    assert (source.title, source.author) == ("Headers Win", "Someone Else")
+
+
+def test_import_files(poem_dir):
+    col = MockCollection()
+    pattern = filename_regex("{author} - {title}")
+    sources = [identify(i, pattern) for i in find_text_files([str(poem_dir)])]
+    progress = []
+    results = import_files(col, MockNote, sources, MOCK_CLEANSE_CONFIG, ["poem"], 1,
+                           context_lines=2, group_lines=1, recite_lines=1, max_workers=0,
+                           on_file=lambda done, total: progress.append((done, total))).files
+
+    assert [(r.source.title, r.notes_added, r.skipped) for r in results] == [
+        ("'Tis Winter", 16, None),
+        ("Headers Win", 2, None),
+        ("Empty", 0, "no text to import"),
+    ]
+    assert progress == [(1, 3), (2, 3), (3, 3)]
+    assert len(col.notes) == 18
+    assert col.notes[16]['Author'] == "Someone Else"
+    assert col.notes[17]['Line'] == "<p>of two linesX</p>"
+    assert col.undo_entries == ["Import Lyrics/Poetry"]
+    record = load_record(col, "Headers Win")
+    assert record.author == "Someone Else"
+    assert record.fingerprint == import_fingerprint(
+        [(poem_dir / "Unknown - Untitled.txt").read_text(encoding='utf-8')],
+        2, 1, 1, MOCK_CLEANSE_CONFIG)
+    assert load_record(col, "Empty") is None
+
+    # A second import skips everything that's already there.
+    results = import_files(col, MockNote, sources[:2], MOCK_CLEANSE_CONFIG, ["poem"], 1,
+                           context_lines=2, group_lines=1, recite_lines=1,
+                           max_workers=0).files
+    assert [r.skipped for r in results] == ["a poem with this title already exists"] * 2
+    assert len(col.notes) == 18
+    assert "skipped \"'Tis Winter\"" in format_summary(results, 0.5)
+
+
+def test_import_files_resumes_interrupted_import(poem_dir):
+    col = MockCollection()
+    pattern = filename_regex("{author} - {title}")
+    sources = [identify(str(poem_dir / "Samuel Longfellow - 'Tis Winter.txt"), pattern)]
+    args = (MOCK_CLEANSE_CONFIG, ["poem"], 1)
+    settings = dict(context_lines=2, group_lines=1, recite_lines=1, max_workers=0)
+    import_files(col, MockNote, sources, *args, **settings)
+
+    # Pretend the import stopped after ten notes, before their checkpoint was saved.
+    col.notes = col.notes[:10]
+    fingerprint = import_fingerprint([test_poem], 2, 1, 1, MOCK_CLEANSE_CONFIG)
+    save_checkpoint(col, Checkpoint("'Tis Winter", 5, 16, fingerprint))
+
+    results = import_files(col, MockNote, sources, *args,
+                           **dict(settings, context_lines=3)).files
+    assert results[0].skipped == ("an interrupted import of this title used a "
+                                  "different text or settings")
+    assert len(col.notes) == 10
+
+    results = import_files(col, MockNote, sources, *args, **settings).files
+    assert (results[0].notes_added, results[0].skipped) == (6, None)
+    assert [n['Sequence'] for n in col.notes] == [str(i) for i in range(1, 17)]
+    assert load_checkpoint(col, "'Tis Winter") is None
+    assert find_poem(col, "'Tis Winter").line_count == 16
+
+
+def test_import_files_cancels(poem_dir):
+    col = MockCollection()
+    pattern = filename_regex("{author} - {title}")
+    sources = [identify(i, pattern) for i in find_text_files([str(poem_dir)])]
+    progress = []
+    with pytest.raises(ImportCancelled):
+        import_files(col, MockNote, sources, MOCK_CLEANSE_CONFIG, ["poem"], 1,
+                     context_lines=2, group_lines=1, recite_lines=1, max_workers=0,
+                     on_file=lambda done, total: progress.append(done),
+                     want_cancel=lambda: len(progress) == 1)
+    assert col.notes == []
+    assert load_record(col, "'Tis Winter") is None
+    assert (col.undo_entries, col.redo_entries) == ([], [])
+
+
+def test_import_files_cancels_within_a_file(poem_dir, fixed_batch_size):
+    col = MockCollection()
+    pattern = filename_regex("{author} - {title}")
+    sources = [identify(i, pattern) for i in find_text_files([str(poem_dir)])]
+    checks = []
+
+    def want_cancel():
+        checks.append(len(col.notes))
+        return len(col.notes) == 10
+
+    with pytest.raises(ImportCancelled):
+        import_files(col, MockNote, sources, MOCK_CLEANSE_CONFIG, ["poem"], 1,
+                     context_lines=2, group_lines=1, recite_lines=1, max_workers=0,
+                     want_cancel=want_cancel)
+    # It's checked before each file, and before each batch of the first one.
+    assert checks == [0, 0, 5, 10]
+    assert col.notes == []
+    assert load_checkpoint(col, "'Tis Winter") is None
+    assert (col.undo_entries, col.redo_entries) == ([], [])
+
+
+def test_render_files_in_process_pool(poem_dir):
+    pattern = filename_regex("{author} - {title}")
+    sources = [identify(i, pattern) for i in find_text_files([str(poem_dir)])]
+    pooled = list(render_files(sources, MOCK_CLEANSE_CONFIG, 2, 1, 1, max_workers=2))
+    serial = list(render_files(sources, MOCK_CLEANSE_CONFIG, 2, 1, 1))
+    # Pooled results come back in whatever order they finish.
+    pooled.sort(key=lambda i: sources.index(i.source))
+    assert [i.fields for i in pooled] == [i.fields for i in serial]
+    assert len(pooled[0].fields) == 16
+
+
+@pytest.mark.parametrize("max_workers", [0, 2])
+def test_import_files_skips_unreadable_file(poem_dir, max_workers):
+    (poem_dir / "Nobody - Garbled.txt").write_bytes(b"caf\xe9 au lait\n")
+    col = MockCollection()
+    pattern = filename_regex("{author} - {title}")
+    sources = [PoemFile(str(poem_dir / "Nobody - Garbled.txt"), "Garbled", "Nobody"),
+               identify(str(poem_dir / "Samuel Longfellow - 'Tis Winter.txt"), pattern)]
+    results = import_files(col, MockNote, sources, MOCK_CLEANSE_CONFIG, ["poem"], 1,
+                           context_lines=2, group_lines=1, recite_lines=1,
+                           max_workers=max_workers).files
+    assert results[0].notes_added == 0
+    assert results[0].skipped.startswith("couldn't read the file: ")
+    assert (results[1].notes_added, results[1].skipped) == (16, None)
+
+
+def test_import_files_leaves_one_undo_step(poem_dir, anki_col):
+    from anki.notes import Note  # pylint: disable=import-outside-toplevel
+
+    col = anki_col
+    pattern = filename_regex("{author} - {title}")
+    sources = [identify(i, pattern) for i in find_text_files([str(poem_dir)])]
+    batch = import_files(col, Note, sources, MOCK_CLEANSE_CONFIG, ["poem"], 1,
+                         context_lines=2, group_lines=1, recite_lines=1, max_workers=0)
+    # Clearing the checkpoints afterwards mustn't become a step of its own,
+    # and the import's entry can still be merged into, as the dialog does.
+    assert col.undo_status().undo == "Import Lyrics/Poetry"
+    assert col.merge_undo_entries(batch.undo_entry).note
+    assert col.undo_status().undo == "Import Lyrics/Poetry"
+    assert load_checkpoint(col, "'Tis Winter") is None
+    col.undo()
+    assert col.note_count() == 0
@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+pytest.importorskip("anki")
+
+# pylint: disable=wrong-import-position
+from src.cli import generate_notes, load_config, main
+
+from .test_gen_notes import test_poem
+
+
+def test_generate_notes_into_new_collection(tmp_path, capsys, open_collection):
+    poem = tmp_path / "poem.txt"
+    poem.write_text(test_poem, encoding='utf-8')
+    col_path = str(tmp_path / "collection.anki2")
+
+    assert main([col_path, str(poem), "--title", "'Tis Winter", "--tags", "poem winter",
+                 "--deck", "Poetry", "--context", "3", "--workers", "0"]) == 0
+    assert "Imported 1 of 1 files (16 notes)" in capsys.readouterr().out
+
+    col = open_collection(col_path)
+    nids = col.find_notes('"note:LPCG 1.0" "Title:\'Tis Winter"')
+    assert len(nids) == 16
+    note = col.get_note(nids[0])
+    assert note.tags == ["poem", "winter"]
+    assert note['Context'] == "<p>[Beginning]</p>"
+    assert col.decks.name(col.get_card(note.card_ids()[0]).did) == "Poetry"
+    col.close()
+
+    results = generate_notes(col_path, [str(poem)], title="'Tis Winter", max_workers=0)
+    assert results[0].skipped == "a poem with this title already exists"
+
+
+@pytest.mark.parametrize("meta", [False, True])
+def test_load_config(tmp_path, meta):
+    options = {'endOfStanzaMarker': " S", 'defaultLinesOfContext': 4}
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps({'config': options} if meta else options), encoding='utf-8')
+    config = load_config(str(path), text_marker=" T")
+    assert config['endOfStanzaMarker'] == " S"
+    assert config['endOfTextMarker'] == " T"
+    assert config['defaultLinesOfContext'] == 4
+    assert config['defaultLinesToRecite'] == load_config()['defaultLinesToRecite']
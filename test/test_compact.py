@@ -0,0 +1,158 @@
+import json
+import shutil
+import subprocess
+
+import pytest
+
+# pylint: disable=unused-wildcard-import
+from src.compact import *
+
+from src.gen_notes import Poem, add_notes, cleanse_text, context_placeholder, plan_notes
+from src.poem_store import load_record
+
+from .test_gen_notes import MOCK_CLEANSE_CONFIG, MockCollection, mock_note, test_poem
+
+
+def test_compact_notes(mock_note):
+    add_notes(**mock_note)
+    full = mock_note['col'].notes
+    col = MockCollection()
+    key = new_poem_key()
+    add_notes(**dict(mock_note, col=col), poem_key=key)
+
+    assert len(col.notes) == len(full)
+    for compact, normal in zip(col.notes, full):
+        assert poem_key_of(compact['Context']) == key
+        assert poem_key_of(normal['Context']) is None
+        assert dict(compact.properties, Context='') == dict(normal.properties, Context='')
+
+
+@pytest.mark.parametrize("context_lines,group_lines", [(0, 1), (2, 1), (3, 2)])
+def test_storage_report(context_lines, group_lines):
+    lines = cleanse_text(test_poem, MOCK_CLEANSE_CONFIG)
+    plan = plan_notes("'Tis Winter", "Samuel Longfellow", [], lines, 1,
+                      context_lines, group_lines, 2, new_poem_key())
+    assert plan.field_bytes() == sum(
+        len(value.encode('utf-8')) for spec in plan for value in spec.fields.values())
+
+    report = storage_report("'Tis Winter", "Samuel Longfellow", lines,
+                            context_lines, group_lines, 2)
+    assert report.compact_bytes == plan.field_bytes()
+    assert report.file_bytes == len(poem_file_data(lines, group_lines, context_lines))
+    assert report.saved_bytes == report.full_bytes - report.compact_bytes > 0
+
+
+@pytest.fixture
+def node():
+    path = shutil.which('node')
+    if path is None:
+        pytest.skip("node isn't installed")
+    return path
+
+
+@pytest.mark.parametrize("context_lines,group_lines", [(0, 1), (2, 1), (1, 3), (4, 2)])
+def test_context_script_matches_poem(node, context_lines, group_lines):
+    "The template renders the same context from the media file as LPCG would have."
+    pytest.importorskip("anki")
+    from src.models import CONTEXT_SCRIPT  # pylint: disable=import-outside-toplevel
+
+    lines = cleanse_text(test_poem, MOCK_CLEANSE_CONFIG)
+    poem = Poem(lines, group_lines)
+    script = CONTEXT_SCRIPT.strip()[len('<script>'):-len('</script>')]
+    key = new_poem_key()
+    harness = """
+        var data = %s;
+        var rendered = [];
+        var render = function (sequence) {
+            var marker = {nodeValue: 'lpcg:%s', parentNode: {replaceChild: function (html) {
+                rendered[sequence - 1] = html;
+            }}};
+            var walker = {done: false, currentNode: marker, nextNode: function () {
+                var more = !this.done;
+                this.done = true;
+                return more;
+            }};
+            var document = {
+                body: null,
+                createTreeWalker: function () { return walker; },
+                createElement: function () { return {content: null, set innerHTML(html) {
+                    this.content = html;
+                }}; },
+            };
+            var NodeFilter = {SHOW_COMMENT: 128};
+            var fetch = function (url) {
+                if (url !== '%s') throw new Error('fetched ' + url);
+                return Promise.resolve({json: function () { return data; }});
+            };
+            %s
+        };
+        for (var seq = 1; seq <= %i; seq++) {
+            render(seq);
+        }
+        setTimeout(function () { console.log(JSON.stringify(rendered)); }, 0);
+    """ % (poem_file_data(lines, group_lines, context_lines).decode('utf-8'),
+           key, poem_file_name(key),
+           script.replace("'{{Sequence}}'", 'sequence'), len(poem))
+
+    output = subprocess.run([node, '-e', harness], capture_output=True, check=True,
+                            encoding='utf-8').stdout
+    assert json.loads(output) == [
+        line.fields(context_lines, 1)['Context'] for line in poem]
+
+
+def test_write_poem_file(tmp_path, anki_col):
+    col = anki_col
+    key = new_poem_key()
+    assert key != new_poem_key()
+    name = poem_file_name(key)
+    assert write_poem_file(col, key, ["One", "Two"], 1, 2) == key
+    assert write_poem_file(col, key, ["One", "Two"], 1, 2) == key
+    write_poem_file(col, key, ["One", "Three"], 1, 2)
+    with open(tmp_path / "collection.media" / name, encoding='utf-8') as f:
+        assert json.load(f)['lines'] == ["One", "Three"]
+    assert sorted(p.name for p in (tmp_path / "collection.media").iterdir()) == [name]
+
+
+def test_compact_import_from_command_line(tmp_path, open_collection):
+    from src.cli import main  # pylint: disable=import-outside-toplevel
+
+    poem = tmp_path / "poem.txt"
+    poem.write_text(test_poem, encoding='utf-8')
+    col_path = str(tmp_path / "collection.anki2")
+    assert main([col_path, str(poem), "--title", "'Tis Winter", "--compact",
+                 "--workers", "0"]) == 0
+
+    col = open_collection(col_path)
+    contexts = {col.get_note(i)['Context']
+                for i in col.find_notes('"note:LPCG 1.0"')}
+    key = load_record(col, "'Tis Winter").poem_key
+    assert contexts == {context_placeholder(key)}
+    assert col.media.have(poem_file_name(key))
+
+
+def test_renamed_poem_keeps_its_media_file(tmp_path, open_collection):
+    # pylint: disable=import-outside-toplevel
+    from anki.notes import Note
+    from src.cli import main
+    from src.poem_ops import rename_poem
+    from src.rerender import rerender_poem
+    from src.poem_store import find_poem
+
+    poem = tmp_path / "poem.txt"
+    poem.write_text(test_poem, encoding='utf-8')
+    col_path = str(tmp_path / "collection.anki2")
+    assert main([col_path, str(poem), "--title", "Winter", "--compact", "--workers", "0"]) == 0
+    col = open_collection(col_path)
+    rename_poem(col, "Winter", "Renamed")
+    key = load_record(col, "Renamed").poem_key
+    rerender_poem(col, Note, find_poem(col, "Renamed"), MOCK_CLEANSE_CONFIG)
+    assert load_record(col, "Renamed").poem_key == key
+    col.close()
+
+    # A new poem with the old title gets a file of its own.
+    poem.write_text("One\nTwo", encoding='utf-8')
+    assert main([col_path, str(poem), "--title", "Winter", "--compact", "--workers", "0"]) == 0
+    col = open_collection(col_path)
+    assert load_record(col, "Winter").poem_key != key
+    with open(tmp_path / "collection.media" / poem_file_name(key), encoding='utf-8') as f:
+        assert len(json.load(f)['lines']) == len(cleanse_text(test_poem, MOCK_CLEANSE_CONFIG))
@@ -0,0 +1,81 @@
+import csv
+import io
+import json
+
+import pytest
+
+# pylint: disable=unused-wildcard-import
+from src.export import *
+from src.gen_notes import cleanse_text, plan_notes, stream_notes
+
+from .test_gen_notes import MOCK_CLEANSE_CONFIG, test_poem
+
+
+@pytest.mark.parametrize("context_lines,group_lines,recite_lines", [
+    (2, 1, 1), (0, 1, 1), (3, 2, 2), (20, 3, 0), (1, 4, 5),
+])
+def test_stream_notes_matches_plan(context_lines, group_lines, recite_lines):
+    text = cleanse_text(test_poem, MOCK_CLEANSE_CONFIG)
+    args = ("'Tis Winter", "Samuel Longfellow", ["poem"])
+    settings = (1, context_lines, group_lines, recite_lines)
+    assert list(stream_notes(*args, iter(text), *settings)) == \
+        list(plan_notes(*args, text, *settings))
+
+
+@pytest.mark.parametrize("delimiter", [',', '\t'])
+def test_write_notes(delimiter):
+    text = cleanse_text(test_poem.replace("snow", 'snow, "deep"'), MOCK_CLEANSE_CONFIG)
+    specs = list(plan_notes("'Tis Winter", "Samuel Longfellow", ["poem", "winter"],
+                            text, 1, 2, 1, 2))
+    out = io.StringIO(newline='')
+    assert write_notes(out, iter(specs), delimiter, deck="Poetry") == 16
+
+    lines = out.getvalue().splitlines(keepends=True)
+    headers = [i for i in lines if i.startswith('#')]
+    assert "#notetype:LPCG 1.0\n" in headers
+    assert "#tags column:7\n" in headers
+    assert "#deck column:8\n" in headers
+    rows = list(csv.reader(lines[len(headers):], delimiter=delimiter))
+    assert len(rows) == 16
+    assert rows[0][:5] == [specs[0].fields['Line'], "<p>[Beginning]</p>",
+                           "'Tis Winter", "Samuel Longfellow", "1"]
+    assert rows[0][6] == "poem winter"
+    assert {row[7] for row in rows} == {"Poetry"}
+    assert rows[-1][5] == ""  # no Prompt on the last line
+
+
+def test_export_file_imports_into_anki(tmp_path, anki_col):
+    from anki.collection import ImportCsvRequest
+
+    source = tmp_path / "poem.txt"
+    source.write_text(test_poem, encoding='utf-8')
+    out = str(tmp_path / "poem.tsv")
+    assert export_file(str(source), out, "'Tis Winter", "", ["poem"],
+                       MOCK_CLEANSE_CONFIG, 2, 1, 1, deck="Poetry") == 16
+
+    col = anki_col
+    assert col.decks.id_for_name("Poetry") is None
+    col.import_csv(ImportCsvRequest(path=out, metadata=col.get_csv_metadata(out, None)))
+    nids = col.find_notes('"note:LPCG 1.0" "Title:\'Tis Winter"')
+    assert len(nids) == 16
+    note = col.get_note(min(nids))
+    assert note['Sequence'] == "1"
+    assert note['Context'] == "<p>[Beginning]</p>"
+    assert note.tags == ["poem"]
+    assert col.decks.name(col.get_card(note.card_ids()[0]).did) == "Poetry"
+
+
+def test_main_reads_config(tmp_path, capsys):
+    source = tmp_path / "poem.txt"
+    source.write_text(test_poem, encoding='utf-8')
+    config = tmp_path / "meta.json"
+    config.write_text(json.dumps({'config': {'defaultLinesInGroupsOf': 2}}),
+                      encoding='utf-8')
+    out = tmp_path / "poem.csv"
+    assert main([str(source), str(out), "--title", "Winter", "--config", str(config),
+                 "--text-marker", " END"]) == 0
+    assert "Wrote 8 notes" in capsys.readouterr().out
+
+    assert main([str(source), str(out), "--title", "Winter",
+                 "--config", str(tmp_path / "missing.json")]) == 1
+    assert "error:" in capsys.readouterr().err
@@ -1,10 +1,14 @@
+import io
+import pickle
+import re
 from textwrap import dedent
-from typing import Sequence
 
 import pytest
 
 # pylint: disable=unused-wildcard-import
 from src.gen_notes import *
+from src.gen_notes import _poemlines_from_textlines
+from src.timing import StageTimer
 
 
 MOCK_CLEANSE_CONFIG = {'endOfTextMarker': 'X', 'endOfStanzaMarker': 'Y'}
@@ -12,18 +16,6 @@ INDENT_HTML_START = '<span class="indent">'
 INDENT_HTML_END = '</span>'
 
 
-@pytest.mark.parametrize("n,expected", [
-    (2, ((1, 2), (3, 4), (5, 6))),
-    (3, ((1, 2, 3), (4, 5, 6))),
-    (4, ((1, 2, 3, 4), (5, 6, None, None))),
-])
-def test_groups_of_n(n: int, expected: Sequence[int]):
-    original_iterable = (1, 2, 3, 4, 5, 6)
-    grouped = groups_of_n(original_iterable, n)
-    for actual, exp in zip(grouped, expected):
-        assert actual == exp
-
-
 class TestCleanseText:
     def test_cleanse(self):
         limerick = dedent("""
@@ -94,8 +86,106 @@ class TestCleanseText:
 
         assert result[0] == "Here is a line"
         assert result[1] == "And a second line.X"
+
+
+    def test_escaped_comment_character(self):
+        lyrics = dedent(r"""
+        \# Intro
+        Play it in F\# minor # capo 2
+            \#blessed \\# not a comment either
+        """).strip()
+        result = cleanse_text(lyrics, MOCK_CLEANSE_CONFIG)
+
+        assert result[0] == "# Intro"
+        assert result[1] == "Play it in F# minor"
+        assert result[2] == f"{INDENT_HTML_START}#blessed \\# not a comment eitherX{INDENT_HTML_END}"
+
+
+    def test_long_lines_lex_in_linear_time(self):
+        # These took quadratic time with the regex this lexer replaced.
+        line = "a" + " " * 200000 + "b"
+        assert cleanse_text(line, MOCK_CLEANSE_CONFIG) == [line + "X"]
+        assert cleanse_text("a" + "\\#" * 100000, MOCK_CLEANSE_CONFIG) == ["a" + "#" * 100000 + "X"]
+
+
+    def test_only_comments(self):
+        assert cleanse_text("# nothing\n\n# to see here\n", MOCK_CLEANSE_CONFIG) == []
+
+
+    def test_cleanse_lines_from_file(self):
+        source = io.StringIO(test_poem)
+        assert list(cleanse_lines(source, MOCK_CLEANSE_CONFIG)) == \
+            cleanse_text(test_poem, MOCK_CLEANSE_CONFIG)
+
+
+    def test_cleanse_lines_from_mapped_file(self, tmp_path):
+        path = tmp_path / "poem.txt"
+        text = test_poem.replace("snow", "snöw — ❄") + "\r\nNo final newline"
+        path.write_bytes(text.encode('utf-8'))
+        for chunk_size in (1, 2, 7, 64, 1 << 20):
+            chunks = list(read_text_file(str(path), chunk_size))
+            assert ''.join(chunks) == text
+            assert list(cleanse_lines(chunks, MOCK_CLEANSE_CONFIG)) == \
+                cleanse_text(text, MOCK_CLEANSE_CONFIG)
+
+        (tmp_path / "empty.txt").write_bytes(b"")
+        assert list(read_text_file(str(tmp_path / "empty.txt"))) == []
+
+
+    def test_cleanse_lines_from_list_of_lines(self):
+        assert list(cleanse_lines(['a', '', 'b'], MOCK_CLEANSE_CONFIG)) == ["aY", "bX"]
+        assert list(cleanse_lines(['a', '', '', 'b', ''], MOCK_CLEANSE_CONFIG)) == \
+            cleanse_text("a\n\n\nb\n", MOCK_CLEANSE_CONFIG)
+
+
+    def test_cleanse_lines_is_lazy(self):
+        consumed = []
+        def source():
+            for line in ["First line", "", "# comment", "Second line", "Third line"]:
+                consumed.append(line)
+                yield line + "\n"
+
+        lines = cleanse_lines(source(), MOCK_CLEANSE_CONFIG)
+        assert next(lines) == "First lineY"
+        assert len(consumed) == 4
+        assert next(lines) == "Second line"
+        assert len(consumed) == 5
+        assert list(lines) == ["Third lineX"]
     
 
+class TestIncrementalCleanser:
+    def test_matches_cleanse_text(self):
+        cleanser = IncrementalCleanser(MOCK_CLEANSE_CONFIG)
+        edits = [
+            test_poem,
+            test_poem.replace("keen air", "keen cold air"),
+            test_poem.replace("\n\n", "\n\n\n# a comment\n\n", 1),
+            test_poem.replace("\n", "\r\n"),
+            "\n\n  First line indented\n\nSecond\n\n",
+            "# only a comment",
+            "",
+            test_poem,
+        ]
+        for text in edits:
+            assert cleanser.update(text) == cleanse_text(text, MOCK_CLEANSE_CONFIG)
+
+    def test_reuses_unchanged_stanzas(self, monkeypatch):
+        cleanser = IncrementalCleanser(MOCK_CLEANSE_CONFIG)
+        cleanser.update(test_poem)
+        lexed = []
+        original = IncrementalCleanser._lex_block
+        monkeypatch.setattr(IncrementalCleanser, '_lex_block',
+                            lambda self, block: lexed.append(block) or original(self, block))
+        cleanser.update(test_poem.replace("keen air", "keen cold air"))
+        assert len(lexed) == 1 and "keen cold air" in lexed[0]
+
+    def test_line_index(self):
+        cleanser = IncrementalCleanser(MOCK_CLEANSE_CONFIG)
+        assert cleanser.line_index(0) == -1
+        cleanser.update("# comment\nFirst\nSecond\n\n\nThird\n# comment")
+        assert [cleanser.line_index(i) for i in range(8)] == [0, 0, 1, 2, 2, 2, 2, 2]
+
+
 test_poem = dedent("""
     # Samuel Longfellow
     'Tis winter now; the fallen snow
@@ -120,31 +210,124 @@ test_poem = dedent("""
     """).strip()
 
 
+MOCK_FIELDS = ['Title', 'Author', 'Sequence', 'Context', 'Line', 'Prompt']
+
+
 class MockModel:
     def __init__(self):
         self.properties = {}
+        self.lookups = 0
 
     def __call__(self):
         return self.properties
 
     def by_name(self, name):
+        self.lookups += 1
         return self
 
+    def id_for_name(self, name):
+        return 1
+
+    def field_names(self, model):
+        return MOCK_FIELDS
+
+
+class MockDB:
+    "Answers the only queries LPCG makes directly: summarizing and reading its notes and decks."
+    def __init__(self, collection):
+        self.collection = collection
+
+    def scalar(self, sql, *args):
+        if 'from cards' in sql:
+            return next(n.deck_id for n in self.collection.notes if n.id == args[0])
+        return len(self.collection.notes)
+
+    def first(self, sql, *args):
+        assert "sum(mod)" in sql
+        # A note's contents stand in for its modification time.
+        notes = self.collection.notes
+        return (len(notes), sum(n.id for n in notes),
+                sum(hash(tuple(sorted(n.properties.items()))) for n in notes),
+                sum(len('\x1f'.join(n.properties.values())) for n in notes))
+
+    def all(self, sql, *args):
+        notes = self.collection.notes
+        match = re.search(r'where id in \((.*)\)', sql)
+        if match:
+            ids = {int(i) for i in match.group(1).split(',') if i}
+            notes = [n for n in notes if n.id in ids]
+        # The flds column has every field, empty if it was never set.
+        return [(n.id, '\x1f'.join(n.properties.get(f, "") for f in MOCK_FIELDS))
+                for n in notes]
+
 
 class MockCollection:
     def __init__(self):
         self.notes = []
-
-    def addNote(self, note):
-        self.notes.append(note)
-
-    @property
-    def models(self):
-        return MockModel()
+        self.decks = []
+        self.batches = 0
+        self.undo_entries = []
+        self.undo_snapshots = []
+        self.redo_entries = []
+        self.models = MockModel()
+        self.updated = []
+        self.config = {}
+        self.db = MockDB(self)
+
+    def add_notes(self, requests):
+        for request in requests:
+            request.note.id = len(self.notes) + 1
+            request.note.deck_id = request.deck_id
+            self.notes.append(request.note)
+            self.decks.append(request.deck_id)
+        self.batches += 1
+
+    def remove_notes(self, note_ids):
+        self.notes = [n for n in self.notes if n.id not in note_ids]
+        self.redo_entries = []
+
+    def update_notes(self, notes):
+        self.updated.extend(notes)
+
+    def get_note(self, note_id):
+        note = next(n for n in self.notes if n.id == note_id)
+        # Like a note loaded from a real collection, it has every field.
+        for field in MOCK_FIELDS:
+            note.properties.setdefault(field, "")
+        return note
+
+    def set_config(self, key, value, undoable=False):
+        self.config[key] = value
+
+    def get_config(self, key, default=None):
+        return self.config.get(key, default)
+
+    def remove_config(self, key):
+        del self.config[key]
+
+    def all_config(self):
+        return dict(self.config)
+
+    def find_notes(self, query):
+        title = re.sub(r'\\(.)', r'\1', re.search(r'"Title:(.*)"$', query).group(1))
+        return [n.id for n in self.notes if n['Title'] == title]
+
+    def add_custom_undo_entry(self, name):
+        self.undo_entries.append(name)
+        self.undo_snapshots.append((list(self.notes), dict(self.config)))
+        return len(self.undo_entries)
+
+    def undo(self):
+        self.redo_entries.append(self.undo_entries.pop())
+        self.notes, self.config = self.undo_snapshots.pop()
+
+    def merge_undo_entries(self, target):
+        assert target == len(self.undo_entries)
 
 
 class MockNote:
     def __init__(self, collection, ntype):
+        self.id = 0
         self.collection = collection
         self.note_type = ntype
         self.tags = []
@@ -180,7 +363,7 @@ def mock_note():
 
 def test_render_default_settings(mock_note):
     col = mock_note['col']
-    num_added = add_notes(**mock_note)
+    num_added = len(add_notes(**mock_note).note_ids)
 
     assert num_added == 16
     assert len(col.notes) == 16
@@ -205,11 +388,108 @@ def test_render_default_settings(mock_note):
     assert 'Prompt' not in col.notes[3]
 
 
+@pytest.fixture
+def fixed_batch_size(monkeypatch):
+    "Add notes in batches of exactly five, however fast the mock collection is."
+    for name in ('ADD_BATCH_SIZE', 'MIN_BATCH_SIZE', 'MAX_BATCH_SIZE'):
+        monkeypatch.setattr(f'src.gen_notes.{name}', 5)
+
+
+def test_add_notes_in_batches(mock_note, fixed_batch_size):
+    col = mock_note['col']
+    num_added = len(add_notes(**mock_note).note_ids)
+
+    assert num_added == 16
+    assert [n['Sequence'] for n in col.notes] == [str(i) for i in range(1, 17)]
+    assert col.decks == [mock_note['deck_id']] * 16
+    assert col.batches == 4
+    assert col.models.lookups == 1
+    assert col.undo_entries == ["Import Lyrics/Poetry"]
+
+
+class MockOldCollection(MockCollection):
+    "A collection from before Anki 23.10, which can only add one note at a time."
+    def __getattribute__(self, name):
+        if name == 'add_notes':
+            raise AttributeError(name)
+        return super().__getattribute__(name)
+
+    def add_note(self, note, deck_id):
+        MockCollection.add_notes(self, [AddNoteRequest(note=note, deck_id=deck_id)])
+
+
+def test_add_notes_without_batch_api(mock_note, fixed_batch_size):
+    col = mock_note['col'] = MockOldCollection()
+    assert len(add_notes(**mock_note).note_ids) == 16
+    assert [n['Sequence'] for n in col.notes] == [str(i) for i in range(1, 17)]
+    assert col.decks == [mock_note['deck_id']] * 16
+    assert col.undo_entries == ["Import Lyrics/Poetry"]
+
+
+def test_add_notes_reports_progress_and_cancels(mock_note, fixed_batch_size):
+    col = mock_note['col']
+    progress = []
+    with pytest.raises(ImportCancelled):
+        add_notes(**mock_note,
+                  on_batch=lambda added, total: progress.append((added, total)),
+                  want_cancel=lambda: len(progress) == 2)
+
+    assert progress == [(5, 16), (10, 16)]
+    assert col.notes == []
+    assert col.undo_entries == []
+    assert col.redo_entries == []
+
+    col = mock_note['col'] = MockCollection()
+    add_notes(**mock_note, on_batch=lambda added, total: progress.append((added, total)))
+    assert progress[2:] == [(5, 16), (10, 16), (15, 16), (16, 16)]
+    assert len(col.notes) == 16
+
+
+def test_add_notes_streams_text(mock_note, fixed_batch_size):
+    lines = mock_note['text']
+    read = []
+
+    def source():
+        for line in lines:
+            read.append(line)
+            yield line
+
+    progress = []
+    mock_note['text'] = source()
+    add_notes(**mock_note, on_batch=lambda added, total: progress.append((added, total, len(read))))
+    # The text is read only as far as each batch needs.
+    assert progress == [(5, None, 5), (10, None, 10), (15, None, 15), (16, None, 16)]
+    assert [n['Sequence'] for n in mock_note['col'].notes] == [str(i) for i in range(1, 17)]
+
+
+def test_batch_sizer(monkeypatch):
+    monkeypatch.setattr('src.gen_notes.ADD_BATCH_SIZE', 500)
+    sizer = BatchSizer()
+    sizer.record(500, TARGET_BATCH_SECONDS / 1.5)
+    assert sizer.size == 750
+    sizer.record(750, 0.0)
+    assert sizer.size == 1500
+    sizer.record(1500, TARGET_BATCH_SECONDS * 100)
+    assert sizer.size == 750
+    for _ in range(10):
+        sizer.record(sizer.size, TARGET_BATCH_SECONDS / 10)
+    assert sizer.size == MAX_BATCH_SIZE
+    for _ in range(10):
+        sizer.record(sizer.size, TARGET_BATCH_SECONDS * 10)
+    assert sizer.size == MIN_BATCH_SIZE
+
+
+def test_add_notes_times_stages(mock_note):
+    timer = StageTimer()
+    add_notes(**mock_note, timer=timer)
+    assert list(timer.stages) == ["build notes", "insert notes"]
+
+
 ### GROUPS ###
 def test_render_groups_of_two(mock_note):
     col = mock_note['col']
     mock_note['group_lines'] = 2
-    num_added = add_notes(**mock_note)
+    num_added = len(add_notes(**mock_note).note_ids)
 
     assert num_added == 8
     assert len(col.notes) == 8
@@ -239,7 +519,7 @@ def test_render_groups_of_two(mock_note):
 def test_render_groups_of_three(mock_note):
     col = mock_note['col']
     mock_note['group_lines'] = 3
-    num_added = add_notes(**mock_note)
+    num_added = len(add_notes(**mock_note).note_ids)
 
     assert num_added == 6
     assert len(col.notes) == 6
@@ -275,7 +555,7 @@ def test_render_groups_of_three(mock_note):
 def test_render_three_context_lines(mock_note):
     col = mock_note['col']
     mock_note['context_lines'] = 3
-    num_added = add_notes(**mock_note)
+    num_added = len(add_notes(**mock_note).note_ids)
 
     assert num_added == 16
     assert len(col.notes) == 16
@@ -317,7 +597,7 @@ def test_render_three_context_lines(mock_note):
 def test_render_two_recitation_lines(mock_note):
     col = mock_note['col']
     mock_note['recite_lines'] = 2
-    num_added = add_notes(**mock_note)
+    num_added = len(add_notes(**mock_note).note_ids)
 
     # Unlike grouping, having more recitation lines involves overlap,
     # so there are still 16 notes.
@@ -369,7 +649,7 @@ def test_render_increase_all_options(mock_note):
     mock_note['context_lines'] = 3
     mock_note['recite_lines'] = 2
     mock_note['group_lines'] = 2
-    num_added = add_notes(**mock_note)
+    num_added = len(add_notes(**mock_note).note_ids)
 
     # Only grouping reduces the number; the other parameters cause only
     # additional overlap.
@@ -458,3 +738,132 @@ def test_render_increase_all_options(mock_note):
         "<p>And keep us through life's wintry days.X</p>"
     )
     assert col.notes[7]['Prompt'] == "[...2]"
+
+
+### LONG TEXTS ###
+def test_render_huge_context_without_recursion(mock_note):
+    """
+    Windows are sliced out of a flat array of lines, so neither the length of
+    the poem nor the number of context lines is limited by the recursion limit.
+    """
+    col = mock_note['col']
+    mock_note['text'] = [f"Line {i}" for i in range(1, 1501)]
+    mock_note['context_lines'] = 1500
+    mock_note['recite_lines'] = 5
+    num_added = len(add_notes(**mock_note).note_ids)
+
+    assert num_added == 1500
+    assert col.notes[-1]['Context'] == "<p>[Beginning]</p>" + ''.join(
+        f"<p>Line {i}</p>" for i in range(1, 1500))
+    assert col.notes[-1]['Line'] == "<p>Line 1500</p>"
+    assert col.notes[-3]['Line'] == "<p>Line 1498</p><p>Line 1499</p><p>Line 1500</p>"
+    assert col.notes[-3]['Prompt'] == "[...3]"
+
+
+def test_poem_line_navigation():
+    poem = _poemlines_from_textlines(["A", "B", "C", "D", "E"], 2)
+
+    assert len(poem) == 3
+    assert [line.seq for line in poem] == [1, 2, 3]
+    assert poem[0].predecessor.seq == 0
+    assert isinstance(poem[0].predecessor, Beginning)
+    with pytest.raises(AssertionError):
+        poem[0].predecessor.fields(2, 1, poem_key="0123456789ab")
+    assert poem[0].successor.seq == 2
+    assert poem[-1].successor is None
+    assert poem[-1].text_lines == ["E"]
+    assert [line.text_lines for line in poem[:2]] == [["A", "B"], ["C", "D"]]
+    with pytest.raises(IndexError):
+        poem[3]  # pylint: disable=pointless-statement
+
+
+def test_match_units():
+    old = [("a",), ("b",), ("c",), ("d",)]
+    assert match_units(old, old) == [0, 1, 2, 3]
+    assert match_units(old, [("a",), ("B",), ("c",), ("d",)]) == [0, 1, 2, 3]
+    assert match_units(old, [("a",), ("b",), ("new",), ("c",), ("d",)]) == [0, 1, None, 2, 3]
+    assert match_units(old, [("a",), ("c",), ("d",)]) == [0, 2, 3]
+    assert match_units(old, [("x",), ("y",), ("z",), ("w",), ("v",)]) == [0, 1, 2, 3, None]
+
+
+class TestReimport:
+    @pytest.fixture
+    def imported(self, mock_note):
+        add_notes(**mock_note)
+        for n in mock_note['col'].notes:
+            n.tags = ["reviewed"]
+        mock_note['col'].undo_entries.clear()
+        args = dict(mock_note)
+        args['old_text'] = args['text']
+        args['old_group_lines'] = args['group_lines']
+        return args
+
+    def test_unchanged(self, imported):
+        col = imported['col']
+        result = reimport_notes(**imported)
+        assert result[:4] == (0, 0, 0, 16)
+        assert result.notes == col.notes
+        assert not col.updated
+        assert not col.undo_entries
+
+    def test_typo_fix_updates_neighbouring_notes(self, imported):
+        col = imported['col']
+        ids = [n.id for n in col.notes]
+        text = list(imported['text'])
+        text[5] = text[5].replace("keen air", "keen cold air")
+        imported['text'] = text
+
+        result = reimport_notes(**imported)
+        # The line itself and the notes that show it as context are updated.
+        assert result[:4] == (0, 3, 0, 13)
+        assert [n.id for n in col.notes] == ids
+        assert [n['Sequence'] for n in col.updated] == ["6", "7", "8"]
+        assert "keen cold air" in col.updated[0]['Line']
+        assert all(n.tags == ["reviewed"] for n in col.notes)
+        assert col.undo_entries == ["Update Lyrics/Poetry"]
+
+    def test_inserted_and_removed_lines(self, imported):
+        col = imported['col']
+        text = list(imported['text'])
+        text.insert(2, "A brand new line")
+        del text[10]
+        imported['text'] = text
+
+        result = reimport_notes(**imported)
+        assert result.added == 1 and result.removed == 1
+        assert len(col.notes) == 16
+        assert sorted(int(n['Sequence']) for n in col.notes) == list(range(1, 17))
+        new_note = next(n for n in col.notes if n['Line'] == "<p>A brand new line</p>")
+        assert new_note['Sequence'] == "3"
+        assert new_note.tags == imported['tags']
+
+    def test_regroup(self, imported):
+        col = imported['col']
+        imported['group_lines'] = 2
+        result = reimport_notes(**imported)
+        assert result.removed == 8 and result.added == 0
+        assert len(col.notes) == 8
+        assert all(n['Line'].count('<p>') == 2 for n in col.notes)
+        assert all(n['Prompt'] == "[...2]" for n in col.notes)
+
+
+@pytest.mark.parametrize("context_lines,group_lines,recite_lines", [
+    (2, 1, 1), (0, 1, 1), (3, 2, 2), (20, 3, 0), (1, 4, 5),
+])
+def test_note_plan(context_lines, group_lines, recite_lines):
+    text = cleanse_text(test_poem.replace("snow", "snöw ❄"), MOCK_CLEANSE_CONFIG)
+    plan = plan_notes("'Tis Winter", "Samuel Longfellow", ["poem"], text, 1,
+                      context_lines, group_lines, recite_lines)
+    specs = list(plan)
+    assert len(plan) == len(specs) == -(-16 // group_lines)
+    assert plan[-1] == specs[-1] and plan[1:3] == specs[1:3]
+    assert [i.sequence for i in specs] == list(range(1, len(specs) + 1))
+    assert plan.field_bytes() == sum(
+        len(value.encode('utf-8')) for spec in specs for value in spec.fields.values())
+    assert pickle.loads(pickle.dumps(specs)) == specs
+
+    note = MockNote(None, None)
+    specs[0].apply(note)
+    assert note.tags == ["poem"]
+    assert note['Title'] == "'Tis Winter"
+    assert note['Sequence'] == "1"
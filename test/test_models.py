@@ -0,0 +1,63 @@
+import pytest
+
+pytest.importorskip("anki")
+
+# pylint: disable=wrong-import-position
+from src import models
+
+
+def test_fingerprint_covers_definition(monkeypatch):
+    original = models.LpcgOne.fingerprint()
+    assert original == models.LpcgOne.fingerprint()
+
+    monkeypatch.setattr(models.LpcgOne, 'styling', models.LpcgOne.styling + ".x {}")
+    assert models.LpcgOne.fingerprint() != original
+    monkeypatch.undo()
+
+    monkeypatch.setattr(models.LpcgOne.LpcgOneTemplate, 'back', "{{Line}}")
+    assert models.LpcgOne.fingerprint() != original
+
+
+def test_add_note_type_records_fingerprint(tmp_path, open_collection):
+    col = open_collection(tmp_path / "collection.anki2")
+    assert not models.LpcgOne.in_collection(col)
+    models.add_note_type(col)
+    assert models.LpcgOne.in_collection(col)
+    assert col.get_config(models.FINGERPRINT_KEY) == models.LpcgOne.fingerprint()
+
+
+def test_export_fields_match_note_type():
+    from src.export import FIELDS
+    assert FIELDS == models.LpcgOne.fields
+
+
+def test_note_migrations():
+    assert models.LpcgOne.note_migrations("none") == [models.migrate_fill_prompt]
+    assert models.LpcgOne.note_migrations("1.3.0") == []
+    assert models.LpcgOne.note_migrations(models.LpcgOne.version) == []
+
+
+def test_migrate_notes_in_batches(anki_col, monkeypatch):
+    monkeypatch.setattr(models, 'MIGRATION_BATCH_SIZE', 2)
+    col = anki_col
+    model = col.models.by_name(models.LpcgOne.name)
+    lines = ["<p>One</p>", "<p>One</p><p>Two</p>", "<p>A</p><p>B</p><p>C</p>",
+             "<p>Done</p><p>Already</p>", "<p>Last</p>"]
+    for seq, line in enumerate(lines, start=1):
+        note = col.new_note(model)
+        note['Line'] = line
+        note['Sequence'] = str(seq)
+        if seq == 4:
+            note['Prompt'] = "[...custom]"
+        col.add_note(note, 1)
+
+    progress = []
+    changed = models.migrate_notes(col, models.LpcgOne,
+                                   models.LpcgOne.note_migrations("none"),
+                                   on_batch=lambda done, total: progress.append((done, total)))
+    assert changed == 2
+    assert progress == [(2, 5), (4, 5), (5, 5)]
+    prompts = {col.get_note(nid)['Sequence']: col.get_note(nid)['Prompt']
+               for nid in col.find_notes(f'"note:{models.LpcgOne.name}"')}
+    assert prompts == {'1': "", '2': "[...2]", '3': "[...3]", '4': "[...custom]", '5': ""}
+    assert col.undo_status().undo == "Upgrade LPCG Notes"
@@ -0,0 +1,118 @@
+import pytest
+
+# pylint: disable=unused-wildcard-import
+from src.poem_ops import *
+
+from src.gen_notes import add_notes, cleanse_text
+from src.poem_store import (PoemRecord, all_poems, find_poem, import_fingerprint, load_record,
+                            register_notes, save_record)
+from src.rerender import Markers
+
+from .test_gen_notes import MOCK_CLEANSE_CONFIG, test_poem
+
+CONFIG = {'endOfStanzaMarker': " ⊗", 'endOfTextMarker': " □"}
+
+
+@pytest.mark.parametrize("config", [MOCK_CLEANSE_CONFIG, CONFIG])
+def test_source_text_round_trip(config):
+    text = test_poem + "\n\n\tAn indented line with a \\# in it\nand # a comment"
+    lines = cleanse_text(text, config)
+    assert cleanse_text(source_text(lines, Markers.from_config(config)), config) == lines
+
+
+@pytest.fixture
+def col(anki_col):
+    "A collection with two poems in it, Winter (the test poem) and Other."
+    from anki.notes import Note  # pylint: disable=import-outside-toplevel
+
+    col = anki_col
+    for title, text in (("Winter", test_poem), ("Other", "One\nTwo")):
+        added = add_notes(col, Note, title, "Author", ["poem"], cleanse_text(text, CONFIG),
+                          1, 2, 1, 1)
+        register_notes(col, title, "Author", added.note_ids, 2, 1, 1)
+        save_record(col, PoemRecord.create(
+            title, "Author", import_fingerprint([text], 2, 1, 1, CONFIG), 2, 1, 1, CONFIG))
+    return col
+
+
+def test_fetch_poem_in_numeric_order(col):
+    notes = fetch_poem(col, "Winter")
+    assert [n.sequence for n in notes] == list(range(1, 17))
+    assert notes[9].fields['Line'] == "<p>And skies are chill, and frosts are keen,</p>"
+    assert notes[0].tags == ["poem"]
+    with pytest.raises(ValueError):
+        fetch_poem(col, "Missing")
+
+
+def test_poem_text(col):
+    text = poem_text(col, "Winter", CONFIG)
+    assert cleanse_text(text, CONFIG) == cleanse_text(test_poem, CONFIG)
+    assert text.count("\n\n") == 3
+
+
+def test_rename_poem(col):
+    with pytest.raises(ValueError):
+        rename_poem(col, "Winter", "Other")
+    assert rename_poem(col, "Winter", "Winter (Longfellow) $1") == 16
+    assert col.undo_status().undo == "Rename Poem"
+    assert find_poem(col, "Winter") is None
+    assert load_record(col, "Winter") is None
+    assert load_record(col, "Winter (Longfellow) $1").fingerprint == \
+        import_fingerprint([test_poem], 2, 1, 1, CONFIG)
+    assert {n.fields['Title'] for n in fetch_poem(col, "Winter (Longfellow) $1")} \
+        == {"Winter (Longfellow) $1"}
+
+    col.undo()
+    assert find_poem(col, "Winter (Longfellow) $1") is None
+    assert find_poem(col, "Winter").line_count == 16
+    assert load_record(col, "Winter").title == "Winter"
+
+
+@pytest.mark.parametrize("title", ["A Poem: (Draft) [1]?", "*.+ \\ |^$"])
+def test_rename_poem_with_punctuation(col, title):
+    assert rename_poem(col, "Winter", title) == 16
+    assert rename_poem(col, title, "Winter, Again") == 16
+    assert {n.fields['Title'] for n in fetch_poem(col, "Winter, Again")} == {"Winter, Again"}
+    assert col.undo_status().undo == "Rename Poem"
+
+
+def test_move_and_retag_poem(col):
+    deck_id = col.decks.id("Poetry")
+    assert move_poem(col, "Winter", deck_id) == 16
+    assert col.undo_status().undo == "Move Poem"
+    assert set(col.db.list("select did from cards")) == {1, deck_id}
+    assert len(col.find_cards('"deck:Poetry"')) == 16
+
+    assert retag_poem(col, "Winter", add=["winter", "longfellow"], remove=["poem"]) == 16
+    assert col.undo_status().undo == "Retag Poem"
+    assert {tuple(n.tags) for n in fetch_poem(col, "Winter")} == {("longfellow", "winter")}
+    assert {tuple(n.tags) for n in fetch_poem(col, "Other")} == {("poem",)}
+
+
+def test_delete_poem(col):
+    all_ids = col.find_notes("")
+    assert titles_of_notes(col, all_ids) == ["Other", "Winter"]
+    assert delete_poem(col, "Winter") == 16
+    assert col.undo_status().undo == "Delete Poem"
+    assert col.note_count() == 2
+    assert load_record(col, "Winter") is None
+    assert [i.title for i in all_poems(col)] == ["Other"]
+
+    col.undo()
+    assert find_poem(col, "Winter").line_count == 16
+    assert load_record(col, "Winter") is not None
+
+
+def test_delete_poem_trashes_media_file(col):
+    # pylint: disable=import-outside-toplevel
+    from anki.notes import Note
+    from src.compact import new_poem_key, poem_file_name, poem_key_of, write_poem_file
+
+    lines = cleanse_text(test_poem, CONFIG)
+    key = write_poem_file(col, new_poem_key(), lines, 1, 2)
+    added = add_notes(col, Note, "Compact", "", [], lines, 1, 2, 1, 1, poem_key=key)
+    register_notes(col, "Compact", "", added.note_ids, 2, 1, 1)
+    assert poem_key_of(col.get_note(added.note_ids[0])['Context']) == key
+    assert col.media.have(poem_file_name(key))
+    assert delete_poem(col, "Compact") == 16
+    assert not col.media.have(poem_file_name(key))
@@ -0,0 +1,225 @@
+import pytest
+
+# pylint: disable=unused-wildcard-import
+from src.gen_notes import add_notes
+from src.poem_store import *
+
+from .test_gen_notes import (MOCK_CLEANSE_CONFIG, MockCollection, MockNote, fixed_batch_size,
+                             mock_note, test_poem)
+
+
+@pytest.fixture
+def registered(mock_note):
+    col = mock_note['col']
+    added = add_notes(**mock_note)
+    register_notes(col, mock_note['title'], mock_note['author'], added.note_ids, 2, 1, 1)
+    return mock_note
+
+
+def test_record_roundtrip():
+    col = MockCollection()
+    fingerprint = import_fingerprint(["One\n\nTwo"], 2, 1, 1, MOCK_CLEANSE_CONFIG)
+    record = PoemRecord.create("Poem", "Me", fingerprint, 2, 1, 1, MOCK_CLEANSE_CONFIG)
+    save_record(col, record)
+    assert load_record(col, "Poem") == record
+    assert load_record(col, "Other") is None
+    assert (record.stanza_marker, record.text_marker) == ("Y", "X")
+
+
+def test_find_registered_poem(registered):
+    col = registered['col']
+    entry = find_poem(col, registered['title'])
+    assert entry.author == registered['author']
+    assert entry.first_note_id == col.notes[0].id
+    assert entry.line_count == 16
+    assert (entry.context_lines, entry.recite_lines, entry.group_lines) == (2, 1, 1)
+    assert find_poem(col, "Some Other Poem") is None
+
+
+def test_registry_built_from_existing_notes(mock_note):
+    col = mock_note['col']
+    add_notes(**mock_note)  # e.g., imported before the registry existed
+    entry = find_poem(col, mock_note['title'])
+    assert entry.line_count == 16
+    assert entry.context_lines is None
+    assert entry.first_note_id == col.notes[0].id
+
+
+def test_registry_rebuilt_after_drift(registered):
+    col = registered['col']
+    title = registered['title']
+    find_poem(col, title)
+    col.remove_notes([n.id for n in col.notes])
+    assert find_poem(col, title) is None
+
+    # Retitling notes doesn't change how many there are or their ids, but
+    # it does change their modification times.
+    add_notes(**registered)
+    assert find_poem(col, title).line_count == 16
+    for n in col.notes:
+        n['Title'] = "Renamed"
+    assert find_poem(col, title) is None
+    assert find_poem(col, "Renamed").line_count == 16
+
+
+def test_registry_lookups_dont_search(registered, monkeypatch):
+    col = registered['col']
+    find_poem(col, registered['title'])
+    monkeypatch.setattr(col, 'find_notes', lambda query: pytest.fail("searched"))
+    monkeypatch.setattr(col.db, 'all', lambda *args: pytest.fail("rebuilt"))
+    assert find_poem(col, registered['title']) is not None
+    assert find_poem(col, "Missing") is None
+
+
+def test_registry_kept_up_to_date_by_register_notes(registered, monkeypatch):
+    col = registered['col']
+    find_poem(col, registered['title'])
+    other = dict(registered, title="Another Poem")
+    added = add_notes(**other)
+    register_notes(col, "Another Poem", "", added.note_ids, 2, 1, 1)
+    monkeypatch.setattr(col.db, 'all', lambda *args: pytest.fail("rebuilt"))
+    assert [i.title for i in all_poems(col)] == ["'Tis Winter", "Another Poem"]
+
+
+def test_resume_interrupted_import(mock_note, fixed_batch_size):
+    col = mock_note['col']
+    title = mock_note['title']
+    fingerprint = import_fingerprint(["some text"], 2, 1, 1, MOCK_CLEANSE_CONFIG)
+
+    def crash_after_two_batches(added, total):
+        if added == 10:
+            raise SystemExit  # Anki quit before the checkpoint was saved
+        save_checkpoint(col, Checkpoint(title, added, total, fingerprint))
+
+    with pytest.raises(SystemExit):
+        add_notes(**mock_note, on_batch=crash_after_two_batches)
+    checkpoint = load_checkpoint(col, title)
+    assert checkpoint == Checkpoint(title, 5, 16, fingerprint)
+    assert committed_sequence(col, checkpoint) == 10
+
+    assert len(add_notes(**mock_note, start_seq=10).note_ids) == 6
+    assert [n['Sequence'] for n in col.notes] == [str(i) for i in range(1, 17)]
+    clear_checkpoint(col, title)
+    assert load_checkpoint(col, title) is None
+
+
+def test_import_fingerprint():
+    fingerprint = import_fingerprint(["One\n", "Two\n"], 2, 1, 1, MOCK_CLEANSE_CONFIG)
+    assert fingerprint == import_fingerprint(["One\nTwo\n"], 2, 1, 1, MOCK_CLEANSE_CONFIG)
+    assert fingerprint != import_fingerprint(["One\nTwo\n"], 3, 1, 1, MOCK_CLEANSE_CONFIG)
+    assert fingerprint != import_fingerprint(["One\nTwo\n"], 2, 1, 1, dict(
+        MOCK_CLEANSE_CONFIG, endOfTextMarker="Z"))
+
+
+def test_digest_fingerprint_matches_import_fingerprint():
+    digest = TextDigest()
+    chunks = list(digest.feed(iter(["One\n", "Two\n"])))
+    assert chunks == ["One\n", "Two\n"]
+    assert digest.hexdigest() == text_digest(["One\nTwo\n"])
+    assert (digest_fingerprint(digest.hexdigest(), 2, 1, 1, MOCK_CLEANSE_CONFIG)
+            == import_fingerprint(["One\nTwo\n"], 2, 1, 1, MOCK_CLEANSE_CONFIG))
+
+
+def test_text_digest_ignores_surrounding_whitespace():
+    # As read from a file, in chunks that split the whitespace up.
+    from_file = text_digest(["\n  ", "\nOne\n", " \n\nTwo", "\n", "\n", " "])
+    assert from_file == text_digest(["One\n \n\nTwo"])
+    assert from_file != text_digest(["One\n\nTwo"])
+
+
+def test_registry_rebuild_leaves_undo_alone(anki_col):
+    """
+    Rebuilding the registry after notes were deleted or retitled in the
+    browser must notice the change, and mustn't add an undo step in front
+    of the user's own.
+    """
+    # pylint: disable=import-outside-toplevel
+    from anki.notes import Note
+    from src.gen_notes import cleanse_text
+
+    col = anki_col
+    text = cleanse_text(test_poem, MOCK_CLEANSE_CONFIG)
+    for title in ("Winter", "Other"):
+        added = add_notes(col, Note, title, "", [], text, 1, 2, 1, 1)
+        register_notes(col, title, "", added.note_ids, 2, 1, 1)
+    assert find_poem(col, "Other") is not None
+
+    col.remove_notes(col.find_notes('"Title:Other"'))
+    undo = col.undo_status().undo
+    assert find_poem(col, "Other") is None
+    assert col.undo_status().undo == undo
+
+    note = col.get_note(find_poem(col, "Winter").first_note_id)
+    note['Title'] = "Retitled"
+    col.update_note(note)
+    assert find_poem(col, "Retitled").line_count == 1
+    assert find_poem(col, "Winter").line_count == 15
+
+
+def test_import_dialog_steps_leave_one_undo_step(anki_col):
+    """
+    Run the steps of the import dialog's operations against a real collection:
+    saving checkpoints, the registry and the record after adding the notes
+    mustn't stop the final merge into the import's undo entry from working.
+    """
+    # pylint: disable=import-outside-toplevel
+    from anki.notes import Note
+    from src.gen_notes import cleanse_text, reimport_notes
+
+    col = anki_col
+    text = cleanse_text(test_poem, MOCK_CLEANSE_CONFIG)
+    fingerprint = import_fingerprint([test_poem], 2, 1, 1, MOCK_CLEANSE_CONFIG)
+    added = add_notes(col, Note, "Winter", "Author", ["poem"], text, 1, 2, 1, 1,
+                      on_batch=lambda done, total: save_checkpoint(
+                          col, Checkpoint("Winter", done, total, fingerprint)))
+    register_poem(col, "Winter", "Author", 2, 1, 1)
+    save_record(col, PoemRecord.create("Winter", "Author", fingerprint, 2, 1, 1,
+                                       MOCK_CLEANSE_CONFIG))
+    clear_checkpoint(col, "Winter")
+    assert col.merge_undo_entries(added.undo_entry).note
+    assert col.undo_status().undo == "Import Lyrics/Poetry"
+    assert not col.db.scalar("select count() from config where key like 'lpcg_checkpoint%'")
+
+    revised = text[:-1] + ["A new last lineX"]
+    result = reimport_notes(col, Note, "Winter", "Author", ["poem"], revised, text,
+                            1, 2, 1, 1, 1)
+    register_notes(col, "Winter", "Author", [n.id for n in result.notes], 2, 1, 1)
+    save_record(col, PoemRecord.create(
+        "Winter", "Author", import_fingerprint(["\n".join(revised)], 2, 1, 1,
+                                               MOCK_CLEANSE_CONFIG),
+        2, 1, 1, MOCK_CLEANSE_CONFIG))
+    assert col.merge_undo_entries(result.undo_entry).note
+    assert col.undo_status().undo == "Update Lyrics/Poetry"
+
+    col.undo()
+    assert col.undo_status().undo == "Import Lyrics/Poetry"
+    col.undo()
+    assert col.note_count() == 0
+    # Undoing the import doesn't bring back its checkpoint.
+    assert load_checkpoint(col, "Winter") is None
+
+
+def test_cancelled_import_leaves_no_undo_step(anki_col, fixed_batch_size):
+    # pylint: disable=import-outside-toplevel
+    from anki.notes import Note
+    from src.gen_notes import ImportCancelled, cleanse_text
+
+    col = anki_col
+    fingerprint = import_fingerprint([test_poem], 2, 1, 1, MOCK_CLEANSE_CONFIG)
+    interrupted = Checkpoint("Winter", 0, 16, fingerprint)
+    save_checkpoint(col, interrupted)
+    undo_before = col.undo_status().undo
+    progress = []
+
+    def on_batch(added, total):
+        progress.append(added)
+        save_checkpoint(col, Checkpoint("Winter", added, total, fingerprint))
+
+    with pytest.raises(ImportCancelled):
+        add_notes(col, Note, "Winter", "Author", ["poem"],
+                  cleanse_text(test_poem, MOCK_CLEANSE_CONFIG), 1, 2, 1, 1,
+                  on_batch=on_batch, want_cancel=lambda: len(progress) == 2)
+    assert col.note_count() == 0
+    assert col.undo_status().undo == undo_before
+    assert not col.undo_status().redo
+    assert load_checkpoint(col, "Winter") == interrupted
@@ -0,0 +1,140 @@
+import pytest
+
+# pylint: disable=unused-wildcard-import
+from src.rerender import *
+
+from src.gen_notes import add_notes, cleanse_text
+from src.poem_store import (PoemRecord, find_poem, import_fingerprint, load_record,
+                             register_notes, save_record)
+
+from .test_gen_notes import (MOCK_CLEANSE_CONFIG, MOCK_FIELDS, MockCollection, MockNote, mock_note,
+                             test_poem)
+
+NEW_MARKERS_CONFIG = {'endOfStanzaMarker': " ⊗", 'endOfTextMarker': " □"}
+
+
+def generate(mock_note, config=MOCK_CLEANSE_CONFIG, **settings):
+    "Return the fields of the notes LPCG would generate for the test poem from scratch."
+    col = MockCollection()
+    args = dict(mock_note, col=col, text=cleanse_text(test_poem, config), **settings)
+    add_notes(**args)
+    return [dict(dict.fromkeys(MOCK_FIELDS, ""), **n.properties) for n in col.notes]
+
+
+@pytest.fixture
+def imported(mock_note):
+    "The test poem, imported with a record and registered, with recite_lines=2."
+    col = mock_note['col']
+    mock_note['recite_lines'] = 2
+    added = add_notes(**mock_note)
+    register_notes(col, mock_note['title'], mock_note['author'], added.note_ids, 2, 2, 1)
+    save_record(col, PoemRecord.create(
+        mock_note['title'], mock_note['author'],
+        import_fingerprint([test_poem], 2, 2, 1, MOCK_CLEANSE_CONFIG), 2, 2, 1,
+        MOCK_CLEANSE_CONFIG))
+    return mock_note
+
+
+def fields_of(col):
+    return [dict(dict.fromkeys(MOCK_FIELDS, ""), **n.properties)
+            for n in sorted(col.notes, key=lambda n: int(n['Sequence']))]
+
+
+@pytest.mark.parametrize("group_lines", [2, None])
+def test_units_from_lines(group_lines):
+    lines = ["<p>A</p><p>B</p><p>C</p><p>D</p>", "<p>C</p><p>D</p><p>E</p>", "<p>E</p>"]
+    assert units_from_lines(lines, group_lines) == [["A", "B"], ["C", "D"], ["E"]]
+
+
+def test_poem_units(imported):
+    col = imported['col']
+    units = poem_units(col, find_poem(col, imported['title']))
+    assert [line for unit in units for line in unit] == \
+        cleanse_text(test_poem, MOCK_CLEANSE_CONFIG)
+
+
+def test_swap_markers():
+    lines = ["one", "two Y", '<span class="indent">three Y</span>', "four X"]
+    assert swap_markers(lines, Markers("Y", "X"), Markers(" S", "")) == [
+        "one", "two  S", '<span class="indent">three  S</span>', "four "]
+
+
+def test_rerender_new_markers(imported):
+    col = imported['col']
+    result = rerender_poem(col, MockNote, find_poem(col, imported['title']), NEW_MARKERS_CONFIG)
+
+    expected = generate(imported, NEW_MARKERS_CONFIG, recite_lines=2)
+    assert fields_of(col) == expected
+    # Only notes showing the end of a stanza in their Context or Line change.
+    changed = sum(1 for old, new in zip(generate(imported, recite_lines=2), expected)
+                  if old != new)
+    assert (result.updated, result.added, result.removed) == (changed, 0, 0)
+    assert 0 < changed < len(expected)
+    record = load_record(col, imported['title'])
+    assert (record.stanza_marker, record.text_marker) == (" ⊗", " □")
+
+
+def test_rerender_new_settings(imported):
+    col = imported['col']
+    ids = [n.id for n in col.notes]
+    result = rerender_poem(col, MockNote, find_poem(col, imported['title']),
+                           MOCK_CLEANSE_CONFIG, context_lines=3, recite_lines=1)
+    assert fields_of(col) == generate(imported, context_lines=3, recite_lines=1)
+    assert [n.id for n in col.notes] == ids  # review history is kept
+    assert result.added == result.removed == 0
+    entry = find_poem(col, imported['title'])
+    assert (entry.context_lines, entry.recite_lines, entry.group_lines) == (3, 1, 1)
+
+
+def test_rerender_regroup_without_record(mock_note):
+    col = mock_note['col']
+    add_notes(**mock_note)  # imported before records and settings were kept
+    entry = find_poem(col, mock_note['title'])
+    result = rerender_poem(col, MockNote, entry, MOCK_CLEANSE_CONFIG)
+    assert result.updated == result.added == result.removed == 0  # settings were inferred
+
+    result = rerender_poem(col, MockNote, entry, NEW_MARKERS_CONFIG, 2, 1, 2,
+                           old_markers=Markers.from_config(MOCK_CLEANSE_CONFIG))
+    assert fields_of(col) == generate(mock_note, NEW_MARKERS_CONFIG, group_lines=2)
+    assert len(col.notes) == 8
+    assert result.removed == 8
+    assert all(n.deck_id == mock_note['deck_id'] for n in col.notes)
+
+
+@pytest.mark.parametrize("context_lines, recite_lines, group_lines",
+                         [(2, 1, 1), (3, 2, 1), (1, 1, 2), (0, 1, 1), (2, 3, 2), (1, 0, 1)])
+def test_infer_settings(mock_note, context_lines, recite_lines, group_lines):
+    col = mock_note['col']
+    add_notes(**dict(mock_note, context_lines=context_lines, recite_lines=recite_lines,
+                     group_lines=group_lines))
+    entry = find_poem(col, mock_note['title'])
+    context, recite, group = infer_settings(col, entry)
+    assert group == group_lines
+    # Settings that can't be told apart render the same notes.
+    assert generate(mock_note, context_lines=context, recite_lines=recite,
+                    group_lines=group) == \
+        generate(mock_note, context_lines=context_lines, recite_lines=recite_lines,
+                 group_lines=group_lines)
+
+
+def test_infer_settings_of_edited_poem(mock_note):
+    col = mock_note['col']
+    add_notes(**mock_note)
+    col.notes[3]['Context'] = "<p>Edited</p>"
+    with pytest.raises(ValueError):
+        infer_settings(col, find_poem(col, mock_note['title']))
+
+
+def test_rerender_all(imported):
+    col = imported['col']
+    other = dict(imported, title="Another Poem")
+    added = add_notes(**other)
+    register_notes(col, "Another Poem", other['author'], added.note_ids, 2, 2, 1)
+    progress = []
+    results = rerender_all(col, MockNote, NEW_MARKERS_CONFIG,
+                           old_markers=Markers.from_config(MOCK_CLEANSE_CONFIG),
+                           on_poem=lambda done, total: progress.append((done, total)))
+    assert [entry.title for entry, _ in results] == ["'Tis Winter", "Another Poem"]
+    assert progress == [(1, 2), (2, 2)]
+    assert not any('X' in n['Line'] or 'Y' in n['Line'] for n in col.notes)
+    assert any('⊗' in n['Line'] for n in col.notes)
@@ -0,0 +1,41 @@
+import pstats
+
+# pylint: disable=unused-wildcard-import
+from src.timing import *
+
+
+def test_stage_timer_accumulates():
+    timer = StageTimer()
+    with timer.span("parse"):
+        pass
+    with timer.span("insert"):
+        pass
+    with timer.span("parse"):
+        pass
+
+    assert list(timer.stages) == ["parse", "insert"]
+    assert timer.total == sum(timer.stages.values())
+    assert timer.format().startswith("parse 0.0")
+
+
+def test_disabled_timer_records_nothing():
+    with NULL_TIMER.span("parse"):
+        pass
+    assert NULL_TIMER.stages == {}
+
+
+def test_log_and_profile(tmp_path):
+    timer = StageTimer()
+    with timer.span("parse"):
+        pass
+    log = tmp_path / "timings.log"
+    log_timings(str(log), "My Poem", timer)
+    log_timings(str(log), "Another Poem", timer)
+    lines = log.read_text(encoding='utf-8').splitlines()
+    assert len(lines) == 2
+    assert "\tMy Poem\ttotal " in lines[0]
+
+    prof = tmp_path / "import.prof"
+    with profiled(str(prof)):
+        sorted(range(1000), reverse=True)
+    assert pstats.Stats(str(prof)).total_calls > 0